@@ -0,0 +1,168 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# bit i of an activity bitset is month i since January 2005, bit 0 is the lowest bit of the first byte
+ACTIVITY_START_YEAR = 2005
+# index of the lowest set bit of every byte value, -1 for 0
+LOWEST_BIT = np.array([(value & -value).bit_length() - 1 for value in range(256)], dtype=np.int64)
+# index of the highest set bit of every byte value, -1 for 0
+HIGHEST_BIT = np.array([value.bit_length() - 1 for value in range(256)], dtype=np.int64)
+
+
+def month_index(year, month):
+    return (year - ACTIVITY_START_YEAR) * 12 + month - 1
+
+
+def year_month(index):
+    return ACTIVITY_START_YEAR + index // 12, index % 12 + 1
+
+
+def _combine_chunks(array):
+    return array.combine_chunks() if isinstance(array, pa.ChunkedArray) else array
+
+
+def _month_index_bits(month_indexes, byte_count):
+    month_indexes = _combine_chunks(month_indexes)
+    values = pc.list_flatten(month_indexes).to_numpy(zero_copy_only=False).astype(np.int64)
+    rows = pc.list_parent_indices(month_indexes).to_numpy(zero_copy_only=False)
+    bits = np.zeros((len(month_indexes), byte_count), dtype=np.uint8)
+    np.bitwise_or.at(bits, (rows, values >> 3), np.left_shift(1, values & 7).astype(np.uint8))
+    return bits
+
+
+def pack_bits(bits):
+    """Return a uint8 matrix with one row per user as binary array of activity bitsets, see unpack_bitsets"""
+    bits = np.ascontiguousarray(bits, dtype=np.uint8)
+    offsets = np.arange(bits.shape[0] + 1, dtype=np.int32) * bits.shape[1]
+    return pa.Array.from_buffers(pa.binary(), bits.shape[0], [None, pa.py_buffer(offsets), pa.py_buffer(bits)])
+
+
+def pack_month_indexes(month_indexes, byte_count):
+    """Pack a list array of month indexes into a binary array of activity bitsets with byte_count bytes"""
+    return pack_bits(_month_index_bits(month_indexes, byte_count))
+
+
+def add_month_indexes(bitsets, month_indexes, byte_count):
+    """Set the bits of a list array of month indexes in the activity bitsets and pad them to byte_count bytes.
+
+    A null bitset has no active months, a null list of month indexes keeps the bitset. Returns a binary array.
+    """
+    previous_bits = unpack_bitsets(bitsets)
+    bits = _month_index_bits(month_indexes, max(byte_count, previous_bits.shape[1]))
+    bits[:, : previous_bits.shape[1]] |= previous_bits
+    return pack_bits(bits)
+
+
+def unpack_bitsets(bitsets):
+    """Return the activity bitsets of a binary array as uint8 matrix with one row per user.
+
+    Bitsets written in earlier months are shorter, they are padded with inactive months, null is never active.
+    """
+    bitsets = _combine_chunks(bitsets).cast(pa.binary())
+    lengths = pc.fill_null(pc.binary_length(bitsets), 0).to_numpy(zero_copy_only=False)
+    bits = np.zeros((len(bitsets), lengths.max(initial=0)), dtype=np.uint8)
+    if not lengths.any():
+        return bits
+    offsets = np.frombuffer(bitsets.buffers()[1], dtype=np.int32, count=len(bitsets) + 1, offset=bitsets.offset * 4)
+    data = np.frombuffer(bitsets.buffers()[2], dtype=np.uint8)
+    for length in np.unique(lengths[lengths > 0]):
+        rows = np.flatnonzero(lengths == length)
+        bits[rows, :length] = data[offsets[rows, None] + np.arange(length)]
+    return bits
+
+
+def is_active(bits, month_indexes):
+    """Return if the users are active in a month, month_indexes is one index or an index per user"""
+    month_indexes = np.broadcast_to(np.asarray(month_indexes, dtype=np.int64), (bits.shape[0],))
+    if bits.shape[1] == 0:
+        return np.zeros(bits.shape[0], dtype=bool)
+    in_range = (month_indexes >= 0) & (month_indexes < bits.shape[1] * 8)
+    byte_indexes = np.where(in_range, month_indexes >> 3, 0)
+    active = (bits[np.arange(bits.shape[0]), byte_indexes] >> (month_indexes & 7).astype(np.uint8)) & 1
+    return in_range & (active == 1)
+
+
+def first_month_indexes(bits):
+    """Return the month index of the first activity of every user, -1 for users without activity"""
+    if bits.shape[1] == 0:
+        return np.full(bits.shape[0], -1, dtype=np.int64)
+    nonzero = bits != 0
+    first_bytes = nonzero.argmax(axis=1)
+    first_months = first_bytes * 8 + LOWEST_BIT[bits[np.arange(bits.shape[0]), first_bytes]]
+    return np.where(nonzero.any(axis=1), first_months, -1)
+
+
+def last_month_indexes(bits):
+    """Return the month index of the last activity of every user, -1 for users without activity"""
+    if bits.shape[1] == 0:
+        return np.full(bits.shape[0], -1, dtype=np.int64)
+    nonzero = bits[:, ::-1] != 0
+    last_bytes = bits.shape[1] - 1 - nonzero.argmax(axis=1)
+    last_months = last_bytes * 8 + HIGHEST_BIT[bits[np.arange(bits.shape[0]), last_bytes]]
+    return np.where(nonzero.any(axis=1), last_months, -1)
+
+
+def get_month_count(bits):
+    """Number of months up to the last month in which any user was active"""
+    return int(last_month_indexes(bits).max(initial=-1)) + 1
+
+
+def active_users_per_month(bits, month_count=None):
+    month_count = get_month_count(bits) if month_count is None else month_count
+    return np.array([np.count_nonzero(is_active(bits, month)) for month in range(month_count)], dtype=np.int64)
+
+
+def new_users_per_month(bits, month_count=None):
+    """Number of users that are active for the first time in every month"""
+    month_count = get_month_count(bits) if month_count is None else month_count
+    first_months = first_month_indexes(bits)
+    return np.bincount(first_months[first_months >= 0], minlength=month_count)[:month_count]
+
+
+def retention(bits, max_offset, month_count=None):
+    """Return a matrix of the users of every first-seen cohort that are active again after 0 to max_offset months.
+
+    Row c, column k is the number of users whose first month is c and that are active in month c + k, column 0
+    is the size of the cohort. Months after month_count are counted as inactive.
+    """
+    month_count = get_month_count(bits) if month_count is None else month_count
+    first_months = first_month_indexes(bits)
+    in_cohort = first_months >= 0
+    cohorts = first_months[in_cohort]
+    cohort_bits = bits[in_cohort]
+    counts = np.zeros((month_count, max_offset + 1), dtype=np.int64)
+    for offset in range(max_offset + 1):
+        active = is_active(cohort_bits, cohorts + offset) & (cohorts + offset < month_count)
+        counts[:, offset] = np.bincount(cohorts[active], minlength=month_count)[:month_count]
+    return counts
+
+
+def reactivated_users_per_month(bits, inactive_months=12, month_count=None):
+    """Number of users that are active in a month after at least inactive_months months without activity"""
+    month_count = get_month_count(bits) if month_count is None else month_count
+    last_active = np.full(bits.shape[0], -1, dtype=np.int64)
+    reactivated = np.zeros(month_count, dtype=np.int64)
+    for month in range(month_count):
+        active = is_active(bits, month)
+        reactivated[month] = np.count_nonzero(active & (last_active >= 0) & (month - last_active > inactive_months))
+        last_active[active] = month
+    return reactivated
+
+
+def churned_users_per_month(bits, inactive_months=12, month_count=None):
+    """Number of users whose activity in a month is followed by at least inactive_months months without activity.
+
+    The attrition rate is this divided by active_users_per_month. For the last inactive_months months it isn't
+    known yet, they are -1.
+    """
+    month_count = get_month_count(bits) if month_count is None else month_count
+    next_active = np.full(bits.shape[0], np.iinfo(np.int64).max, dtype=np.int64)
+    churned = np.full(month_count, -1, dtype=np.int64)
+    for month in reversed(range(month_count)):
+        active = is_active(bits, month)
+        if month + inactive_months < month_count:
+            # without a later activity next_active is larger than every month
+            churned[month] = np.count_nonzero(active & (next_active - month > inactive_months))
+        next_active[active] = month
+    return churned
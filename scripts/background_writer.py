@@ -0,0 +1,48 @@
+import queue
+import threading
+import time
+
+
+class BackgroundWriter:
+    """Run write jobs in submission order on a background thread, so parsing continues while a batch is written.
+
+    The queue is bounded and submit blocks while it is full. So besides the batch that is being written,
+    at most max_queued_jobs batches wait in memory. Writing Parquet releases the GIL, so a thread is enough.
+    """
+
+    def __init__(self, max_queued_jobs=2):
+        self.jobs = queue.Queue(maxsize=max_queued_jobs)
+        self.error = None
+        # time the parser was blocked because the queue was full
+        self.wait_time = 0.0
+        self.thread = threading.Thread(target=self._run, name="background-writer", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while (job := self.jobs.get()) is not None:
+            # after an error the remaining jobs are dropped, but the queue is still drained so submit can't block
+            if self.error is not None:
+                continue
+            try:
+                job()
+            except BaseException as e:
+                self.error = e
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def submit(self, job):
+        """Queue a job, raises the error of a previously failed job"""
+        self._raise_error()
+        start_time = time.perf_counter()
+        self.jobs.put(job)
+        self.wait_time += time.perf_counter() - start_time
+
+    def close(self):
+        """Wait until all queued jobs are done"""
+        start_time = time.perf_counter()
+        self.jobs.put(None)
+        self.thread.join()
+        self.wait_time += time.perf_counter() - start_time
+        self._raise_error()
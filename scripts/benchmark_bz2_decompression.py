@@ -0,0 +1,58 @@
+import argparse
+import bz2
+import os
+import time
+
+from osm_input import ParallelBZ2Reader
+
+
+def read_all(file_handle, read_size=1024 * 1024):
+    """Read a file handle until the end and return the number of bytes read."""
+    total_bytes = 0
+    while chunk := file_handle.read(read_size):
+        total_bytes += len(chunk)
+    return total_bytes
+
+
+def benchmark(name, open_file, compressed_size):
+    """Time reading the whole decompressed file and print the throughput."""
+    start_time = time.perf_counter()
+    with open_file() as file_handle:
+        decompressed_size = read_all(file_handle)
+    elapsed_time = time.perf_counter() - start_time
+    print(
+        f"{name:>24}: {elapsed_time:8.2f}s, "
+        f"{decompressed_size / elapsed_time / 1e6:8.1f} MB/s decompressed, "
+        f"{compressed_size / elapsed_time / 1e6:8.1f} MB/s compressed"
+    )
+    return decompressed_size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare plain bz2.open with the parallel bz2 block decompression")
+    parser.add_argument("bz2_path", help="Path to a .bz2 file, e.g. discussions-latest.osm.bz2")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        nargs="+",
+        default=[os.cpu_count()],
+        help="Number of worker processes to benchmark (default: number of CPUs)",
+    )
+    args = parser.parse_args()
+
+    compressed_size = os.path.getsize(args.bz2_path)
+    print(f"Benchmarking {args.bz2_path} ({compressed_size / 1e6:.1f} MB compressed)")
+
+    expected_size = benchmark("bz2.open", lambda: bz2.open(args.bz2_path, "rb"), compressed_size)
+    for workers in args.workers:
+        decompressed_size = benchmark(
+            f"parallel ({workers} workers)",
+            lambda workers=workers: ParallelBZ2Reader(open(args.bz2_path, "rb"), workers),
+            compressed_size,
+        )
+        if decompressed_size != expected_size:
+            raise ValueError(f"Decompressed size mismatch: {decompressed_size} != {expected_size}")
+
+
+if __name__ == "__main__":
+    main()
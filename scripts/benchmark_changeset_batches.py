@@ -0,0 +1,163 @@
+import argparse
+import multiprocessing
+import queue
+import random
+import resource
+import time
+
+import pyarrow as pa
+from changeset_osm_to_raw_data import CHANGESET_SCHEMA, DISCUSSION_SCHEMA, ChangesetParser
+
+
+class ColumnList(list):
+    """Python list with the buffer interface used by the parser"""
+
+    def compact(self):
+        pass
+
+
+class ListChangesetParser(ChangesetParser):
+    """The previous accumulation in Python lists with a dict per changeset for the tags"""
+
+    def _init_changeset_data(self):
+        self.changeset_id = ColumnList()
+        self.year = ColumnList()
+        self.month = ColumnList()
+        self.edit_count = ColumnList()
+        self.user_name = ColumnList()
+        self.tags = ColumnList()
+        self.bottom_left_lon = ColumnList()
+        self.bottom_left_lat = ColumnList()
+        self.top_right_lon = ColumnList()
+        self.top_right_lat = ColumnList()
+
+    def _init_discussion_data(self):
+        self.discussion_changeset_id = ColumnList()
+        self.discussion_date = ColumnList()
+        self.discussion_user_name = ColumnList()
+        self.discussion_text = ColumnList()
+
+    def _changeset_table(self):
+        changeset_data_dict = {
+            "changeset_id": self.changeset_id,
+            "year": self.year,
+            "month": self.month,
+            "edit_count": self.edit_count,
+            "user_name": self.user_name,
+            "tags": self.tags,
+            "bottom_left_lon": self.bottom_left_lon,
+            "bottom_left_lat": self.bottom_left_lat,
+            "top_right_lon": self.top_right_lon,
+            "top_right_lat": self.top_right_lat,
+        }
+        return pa.table(changeset_data_dict, schema=self.changeset_schema)
+
+    def _discussion_table(self):
+        discussion_data_dict = {
+            "changeset_id": self.discussion_changeset_id,
+            "date": self.discussion_date,
+            "user_name": self.discussion_user_name,
+            "text": self.discussion_text,
+        }
+        return pa.table(discussion_data_dict, schema=self.discussion_schema)
+
+
+def timed_batches(parser_class):
+    """Create a parser subclass that only converts the batches to Arrow tables and times the conversion."""
+
+    class TimedParser(parser_class):
+        conversion_time = 0.0
+
+        def _save_changeset_batch(self):
+            if not self.changeset_id:
+                return
+            start_time = time.perf_counter()
+            self._changeset_table()
+            self.conversion_time += time.perf_counter() - start_time
+            self._init_changeset_data()
+            self.changeset_batch_count += 1
+
+        def _save_discussion_batch(self):
+            if not self.discussion_changeset_id:
+                return
+            start_time = time.perf_counter()
+            self._discussion_table()
+            self.conversion_time += time.perf_counter() - start_time
+            self._init_discussion_data()
+            self.discussion_batch_count += 1
+
+    return TimedParser
+
+
+def iter_synthetic_changesets(changeset_count, seed=0):
+    """Yield changeset records with a tag and comment distribution similar to the real dump."""
+    rng = random.Random(seed)
+    tag_keys = ["created_by", "comment", "source", "imagery_used", "hashtags", "locale", "host", "changesets_count"]
+    for changeset_id in range(1, changeset_count + 1):
+        attribs = {
+            "id": str(changeset_id),
+            "created_at": f"20{10 + changeset_id * 15 // changeset_count:02d}-{changeset_id % 12 + 1:02d}-01T10:00:00Z",
+            "user": f"user_{rng.randrange(2_000_000)}",
+            "num_changes": str(rng.randrange(500)),
+            "min_lat": "51.5288506",
+            "min_lon": "-0.1465242",
+            "max_lat": "51.5288620",
+            "max_lon": "-0.1464925",
+        }
+        tags = {key: f"value of {key} {rng.randrange(100_000)}" for key in tag_keys[: rng.randint(1, len(tag_keys))]}
+        comments = []
+        if changeset_id % 50 == 0:
+            comments.append(({"user": "reviewer", "date": "2020-01-01T00:00:00Z"}, "Thanks for the edit " * 3))
+        yield attribs, tags, comments
+
+
+def run_benchmark(parser_class, changeset_count, batch_size, result_queue):
+    changeset_parser = timed_batches(parser_class)(
+        changeset_batch_size=batch_size,
+        discussion_batch_size=batch_size,
+        changeset_output_path=None,
+        discussion_output_path=None,
+        changeset_schema=CHANGESET_SCHEMA,
+        discussion_schema=DISCUSSION_SCHEMA,
+    )
+    start_time = time.perf_counter()
+    for attribs, tags, comments in iter_synthetic_changesets(changeset_count):
+        changeset_parser._process_changeset(attribs, tags, comments)
+    changeset_parser.finalize()
+    total_time = time.perf_counter() - start_time
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    result_queue.put((peak_rss_mb, changeset_parser.conversion_time, total_time))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare peak RSS and Arrow conversion time of list based and typed buffer based changeset batches"
+    )
+    parser.add_argument("--changesets", type=int, default=5_000_000, help="Number of synthetic changesets")
+    parser.add_argument("--batch-size", type=int, default=1_000_000, help="Changeset batch size (default: 1_000_000)")
+    args = parser.parse_args()
+
+    # run every variant in a fresh process, so the peak RSS is not influenced by the other one
+    context = multiprocessing.get_context("spawn")
+    for name, parser_class in [("python lists", ListChangesetParser), ("typed buffers", ChangesetParser)]:
+        result_queue = context.Queue()
+        process = context.Process(
+            target=run_benchmark, args=(parser_class, args.changesets, args.batch_size, result_queue)
+        )
+        process.start()
+        while True:
+            try:
+                peak_rss_mb, conversion_time, total_time = result_queue.get(timeout=1)
+                break
+            except queue.Empty:
+                if process.exitcode is not None:
+                    raise RuntimeError(f"The {name} benchmark process failed") from None
+        process.join()
+        print(
+            f"{name:>14}: peak RSS {peak_rss_mb:8.0f} MB, batch conversion {conversion_time:6.2f}s, "
+            f"total {total_time:6.2f}s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import duckdb
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from changeset_osm_to_raw_data import CHANGESET_SCHEMA
+from changeset_raw_data_to_data import create_organised_team_lookup_table, enrich_year_months, get_column_expressions
+from spatial_key import get_bbox_filter_sql, get_spatial_key_ranges
+
+# bounding box of Germany
+DEFAULT_BBOX = [5.87, 47.27, 15.04, 55.06]
+# centres of the synthetic clusters of changesets, most of them in Europe like in the real data
+CLUSTER_CENTRES = [
+    (10.0, 51.0),
+    (2.3, 48.9),
+    (-0.1, 51.5),
+    (12.5, 41.9),
+    (21.0, 52.2),
+    (-3.7, 40.4),
+    (-74.0, 40.7),
+    (-99.1, 19.4),
+    (77.2, 28.6),
+    (139.7, 35.7),
+    (36.8, -1.3),
+    (-46.6, -23.5),
+]
+
+
+def write_synthetic_raw_changesets(raw_path, changeset_count, year, month, seed=0):
+    """Write a year-month of raw changesets without tags, with small bboxes around a few clusters and anywhere."""
+    rng = np.random.default_rng(seed)
+    centres = np.array(CLUSTER_CENTRES)[rng.integers(len(CLUSTER_CENTRES), size=changeset_count)]
+    lon = np.clip(centres[:, 0] + rng.normal(0, 4, changeset_count), -179.9, 179.9)
+    lat = np.clip(centres[:, 1] + rng.normal(0, 3, changeset_count), -89.9, 89.9)
+    anywhere = rng.random(changeset_count) < 0.2
+    lon[anywhere] = rng.uniform(-179.9, 179.9, np.count_nonzero(anywhere))
+    lat[anywhere] = rng.uniform(-89.9, 89.9, np.count_nonzero(anywhere))
+    size = rng.exponential(0.01, changeset_count)
+    empty_tags = pa.MapArray.from_arrays(
+        pa.array(np.zeros(changeset_count + 1, dtype=np.int32)), pa.array([], pa.string()), pa.array([], pa.string())
+    )
+    table = pa.table(
+        {
+            "changeset_id": np.arange(1, changeset_count + 1, dtype=np.int64),
+            "year": np.full(changeset_count, year, dtype=np.int16),
+            "month": np.full(changeset_count, month, dtype=np.int8),
+            "edit_count": rng.integers(1, 500, changeset_count, dtype=np.int32),
+            "user_name": pa.array([f"user_{user}" for user in rng.integers(100_000, size=changeset_count)]),
+            "bottom_left_lon": lon - size,
+            "bottom_left_lat": lat - size,
+            "top_right_lon": lon + size,
+            "top_right_lat": lat + size,
+            "tags": empty_tags,
+        },
+        schema=CHANGESET_SCHEMA,
+    )
+    pq.write_to_dataset(table, raw_path, partition_cols=["year", "month"])
+
+
+def count_matching_row_groups(enriched_path, ranges):
+    """Count the row groups whose spatial_key min/max statistics overlap any of the key ranges"""
+    matching_count = total_count = 0
+    for file_path in Path(enriched_path).glob("year=*/month=*/*.parquet"):
+        metadata = pq.ParquetFile(file_path).metadata
+        column_index = metadata.schema.to_arrow_schema().get_field_index("spatial_key")
+        for row_group_index in range(metadata.num_row_groups):
+            statistics = metadata.row_group(row_group_index).column(column_index).statistics
+            total_count += 1
+            if statistics is None or not statistics.has_min_max:
+                matching_count += 1
+            elif any(first_key <= statistics.max and statistics.min <= last_key for first_key, last_key in ranges):
+                matching_count += 1
+    return matching_count, total_count
+
+
+def time_query(enriched_path, where_sql, repeat):
+    sql_query = f"""
+        SELECT count(*), sum(edit_count)
+        FROM read_parquet('{enriched_path}/year=*/month=*/*.parquet', hive_partitioning = false)
+        WHERE {where_sql}
+    """
+    best_time = float("inf")
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = duckdb.sql(sql_query).fetchone()
+        best_time = min(best_time, time.perf_counter() - start_time)
+    return best_time, result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare a bounding box query on enriched changesets in input order and sorted by spatial_key"
+    )
+    parser.add_argument(
+        "--raw-path",
+        default=None,
+        help="Raw changeset dataset to enrich the year-month of, e.g. changeset_data_raw (default: synthetic data)",
+    )
+    parser.add_argument("--year", type=int, default=2024, help="Year of the enriched year-month (default: 2024)")
+    parser.add_argument("--month", type=int, default=6, help="Month of the enriched year-month (default: 6)")
+    parser.add_argument(
+        "--changesets", type=int, default=2_000_000, help="Number of synthetic changesets (default: 2_000_000)"
+    )
+    parser.add_argument(
+        "--bbox",
+        type=float,
+        nargs=4,
+        default=DEFAULT_BBOX,
+        metavar=("MIN_LON", "MIN_LAT", "MAX_LON", "MAX_LAT"),
+        help="Bounding box of the query (default: Germany)",
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="Run every query this often and keep the fastest")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        raw_path = args.raw_path
+        if raw_path is None:
+            raw_path = Path(temp_dir) / "raw"
+            write_synthetic_raw_changesets(raw_path, args.changesets, args.year, args.month)
+        create_organised_team_lookup_table()
+        expressions = get_column_expressions(spatial_key=True)
+        for name, sort_by_spatial_key in [("input_order", False), ("spatial_key_order", True)]:
+            enrich_year_months(
+                raw_path,
+                Path(temp_dir) / name,
+                [(args.year, args.month)],
+                expressions,
+                sort_by_spatial_key=sort_by_spatial_key,
+            )
+
+        min_lon, min_lat, max_lon, max_lat = args.bbox
+        ranges = get_spatial_key_ranges(*args.bbox)
+        mid_pos_sql = (
+            f"mid_pos_x BETWEEN {round(min_lon + 180)} AND {round(max_lon + 180)} "
+            f"AND mid_pos_y BETWEEN {round(min_lat + 90)} AND {round(max_lat + 90)}"
+        )
+        print(f"Bounding box {args.bbox}, {len(ranges)} spatial_key ranges")
+        for name, enriched_dir, where_sql in [
+            ("input order, mid_pos", "input_order", mid_pos_sql),
+            ("input order, spatial_key", "input_order", get_bbox_filter_sql(*args.bbox)),
+            ("sorted, spatial_key", "spatial_key_order", get_bbox_filter_sql(*args.bbox)),
+        ]:
+            enriched_path = Path(temp_dir) / enriched_dir
+            best_time, (changesets, edits) = time_query(enriched_path, where_sql, args.repeat)
+            matching_count, total_count = count_matching_row_groups(enriched_path, ranges)
+            print(
+                f"{name:>25}: {best_time * 1000:8.1f} ms, {changesets} changesets, {edits} edits, "
+                f"{matching_count}/{total_count} row groups overlap the key ranges"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+import argparse
+import re
+import time
+from datetime import UTC, datetime
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from osm_input import ParallelBZ2Reader
+
+BLOCK_INDEX_SCHEMA = pa.schema(
+    [
+        pa.field("block_bit_offset", pa.int64()),
+        pa.field("decompressed_offset", pa.int64()),
+        pa.field("first_changeset_id", pa.int64()),
+        pa.field("first_created_at", pa.timestamp("s", tz="UTC")),
+    ]
+)
+
+# a start tag that is split over two blocks doesn't match, so the first changeset of a block is the first one
+# whose start tag is completely inside it, its attributes are matched on their own in any order
+CHANGESET_START_TAG_PATTERN = re.compile(rb"<changeset\s[^>]*>")
+ID_ATTRIBUTE_PATTERN = re.compile(rb'\bid="(\d+)"')
+CREATED_AT_ATTRIBUTE_PATTERN = re.compile(rb'\bcreated_at="([^"]+)"')
+
+
+def get_block_index_path(changeset_path):
+    return f"{changeset_path}.index.parquet"
+
+
+def find_first_changeset(data):
+    """Return the id and created_at of the first complete changeset start tag in the data, None if there is none"""
+    for start_tag in CHANGESET_START_TAG_PATTERN.finditer(data):
+        id_match = ID_ATTRIBUTE_PATTERN.search(start_tag.group())
+        created_at_match = CREATED_AT_ATTRIBUTE_PATTERN.search(start_tag.group())
+        if id_match is not None and created_at_match is not None:
+            created_at = datetime.fromisoformat(created_at_match.group(1).decode()[:-1] + "+00:00")
+            return int(id_match.group(1)), created_at
+    return None
+
+
+def build_block_index(changeset_path, workers=1):
+    """Decompress the changeset dump block by block and return the block index as Arrow table.
+
+    Every row maps the bit offset of a bz2 block (and its decompressed offset) to the id and created_at
+    of the first changeset that starts in the block. Blocks without the start of a changeset are left out.
+    """
+    columns = {name: [] for name in BLOCK_INDEX_SCHEMA.names}
+    decompressed_offset = 0
+    with ParallelBZ2Reader(open(changeset_path, "rb"), workers) as reader:
+        for start_bit, data in reader.blocks:
+            first_changeset = find_first_changeset(data)
+            if first_changeset is not None:
+                columns["block_bit_offset"].append(start_bit)
+                columns["decompressed_offset"].append(decompressed_offset)
+                columns["first_changeset_id"].append(first_changeset[0])
+                columns["first_created_at"].append(first_changeset[1])
+            decompressed_offset += len(data)
+    return pa.table(columns, schema=BLOCK_INDEX_SCHEMA)
+
+
+def find_start_position(block_index, min_changeset_id=None, since=None):
+    """Return the input position of the last block that starts before the given changeset id or month.
+
+    since is a (year, month) tuple. The returned position can be passed to open_input, None means that
+    reading has to start at the beginning of the file.
+    """
+    if min_changeset_id is not None:
+        mask = pc.less_equal(block_index["first_changeset_id"], min_changeset_id)
+    else:
+        since_start = pa.scalar(datetime(since[0], since[1], 1, tzinfo=UTC), pa.timestamp("s", tz="UTC"))
+        mask = pc.less(block_index["first_created_at"], since_start)
+    blocks = block_index.filter(mask)
+    if blocks.num_rows == 0:
+        return None
+    last_block = blocks.slice(blocks.num_rows - 1).to_pylist()[0]
+    return {
+        "decompressed_offset": last_block["decompressed_offset"],
+        "block_bit_offset": last_block["block_bit_offset"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build a sidecar index that maps the bz2 blocks of the changeset dump to their first changeset"
+    )
+    parser.add_argument("changeset_path", help="Path to the OSM changeset .bz2 file")
+    parser.add_argument("--output", help="Path of the index file (default: <changeset_path>.index.parquet)")
+    parser.add_argument(
+        "--workers", type=int, default=1, help="Decompress the bz2 blocks with this many worker processes (default: 1)"
+    )
+    args = parser.parse_args()
+
+    start_time = time.time()
+    block_index = build_block_index(args.changeset_path, args.workers)
+    output_path = args.output or get_block_index_path(args.changeset_path)
+    pq.write_table(block_index, output_path)
+    elapsed_time = time.time() - start_time
+    print(
+        f"Saved the index of {block_index.num_rows} blocks to {output_path} "
+        f"in {int(elapsed_time // 60)}:{int(elapsed_time % 60):02d} minutes"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+import argparse
+import time
+from datetime import datetime
+from pathlib import Path
+
+import duckdb
+import pyarrow as pa
+import pyarrow.parquet as pq
+from activity_bitsets import ACTIVITY_START_YEAR, add_month_indexes, month_index
+from changeset_osm_to_raw_data import parse_year_month
+
+USER_DIM_FILE = "user_dim.parquet"
+USER_DIM_SCHEMA = pa.schema(
+    [
+        pa.field("user_id", pa.int32()),
+        pa.field("user_name", pa.string()),
+        pa.field("first_active_month", pa.date32()),
+        pa.field("last_active_month", pa.date32()),
+        pa.field("changeset_count", pa.int64()),
+        pa.field("edit_count", pa.int64()),
+        pa.field("changeset_comment_count", pa.int64()),
+        pa.field("note_comment_count", pa.int64()),
+        # activity bitset of the months with changesets, see activity_bitsets.py
+        pa.field("changeset_months", pa.binary()),
+    ]
+)
+ACTIVITY_COLUMNS = ["changeset_count", "edit_count", "changeset_comment_count", "note_comment_count"]
+# the last month (YYYY-MM) of the activity in the user dimension, the months after it are added by the next update
+LAST_MONTH_METADATA_KEY = b"last_month"
+
+
+def next_month(year_month):
+    year, month = year_month
+    return (year, month + 1) if month < 12 else (year + 1, 1)
+
+
+def get_activity_sql(
+    changeset_data_path, changeset_comments_data_path, notes_comments_data_path, last_month, after_month=None
+):
+    """Generate the SQL query of the activity of every user name per month in the three datasets.
+
+    Only the months after after_month up to last_month, both (year, month) tuples, are included. The changeset
+    partitions of the other months are skipped, the comments are filtered by the row group statistics.
+    """
+    end_year, end_month = next_month(last_month)
+    changeset_filter = f"(year, month) < ({end_year}, {end_month})"
+    comment_filter = f"< TIMESTAMPTZ '{end_year}-{end_month:02d}-01 00:00:00+00'"
+    if after_month is None:
+        changeset_filters = [changeset_filter]
+        comment_filters = [comment_filter]
+    else:
+        start_year, start_month = next_month(after_month)
+        changeset_filters = [f"(year, month) >= ({start_year}, {start_month})", changeset_filter]
+        comment_filters = [f">= TIMESTAMPTZ '{start_year}-{start_month:02d}-01 00:00:00+00'", comment_filter]
+    return f"""
+        SELECT user_name, make_date(year::INTEGER, month::INTEGER, 1) as month,
+            count(*) as changeset_count, sum(edit_count) as edit_count,
+            0 as changeset_comment_count, 0 as note_comment_count
+        FROM read_parquet('{changeset_data_path}/year=*/month=*/*.parquet', hive_partitioning = true)
+        WHERE {" AND ".join(changeset_filters)}
+        GROUP BY ALL
+        UNION ALL
+        SELECT user_name, date_trunc('month', date AT TIME ZONE 'UTC')::DATE as month,
+            0, 0, count(*), 0
+        FROM read_parquet('{changeset_comments_data_path}/*.parquet')
+        WHERE {" AND ".join(f"date {condition}" for condition in comment_filters)}
+        GROUP BY ALL
+        UNION ALL
+        SELECT user_name, date_trunc('month', timestamp AT TIME ZONE 'UTC')::DATE as month,
+            0, 0, 0, count(*)
+        FROM read_parquet('{notes_comments_data_path}/*.parquet')
+        WHERE {" AND ".join(f"timestamp {condition}" for condition in comment_filters)}
+        GROUP BY ALL
+    """
+
+
+def read_user_dim(user_dim_path):
+    user_dim_file = Path(user_dim_path) / USER_DIM_FILE
+    if not user_dim_file.exists():
+        return USER_DIM_SCHEMA.empty_table()
+    metadata = pq.read_schema(user_dim_file).metadata
+    return pq.read_table(user_dim_file, schema=USER_DIM_SCHEMA).replace_schema_metadata(metadata)
+
+
+def get_last_month(user_dim_schema):
+    """Return the last month of the activity in the user dimension as (year, month) tuple, None if it is empty"""
+    metadata = user_dim_schema.metadata or {}
+    if LAST_MONTH_METADATA_KEY not in metadata:
+        return None
+    return parse_year_month(metadata[LAST_MONTH_METADATA_KEY].decode())
+
+
+def get_user_dim_last_month(user_dim_path):
+    """Return the last month of the activity in the user dimension directory, see get_last_month"""
+    user_dim_file = Path(user_dim_path) / USER_DIM_FILE
+    if not user_dim_file.exists():
+        return None
+    return get_last_month(pq.read_schema(user_dim_file))
+
+
+def update_user_dim(previous_user_dim, activity_sql, last_month):
+    """Return the user dimension with the activity of activity_sql added to previous_user_dim.
+
+    The activity must only cover the months after the last month of previous_user_dim up to last_month, which
+    becomes the new last month, see get_activity_sql. The totals are added, the first and last active months
+    extended and the changeset months set in the changeset_months bitsets, which all get the length of last_month.
+    The users of previous_user_dim keep their user_id, new user names get the ids after the largest one,
+    ordered by their first active month and name.
+    """
+    connection = duckdb.connect()
+    connection.register("previous_user_dim", previous_user_dim)
+    totals_sql = ", ".join(f"sum({column})::BIGINT as {column}" for column in ACTIVITY_COLUMNS)
+    connection.execute(f"""
+        CREATE TEMP TABLE user_activity AS
+        SELECT user_name, min(month) as first_active_month, max(month) as last_active_month, {totals_sql},
+            list(DISTINCT date_diff('month', DATE '{ACTIVITY_START_YEAR}-01-01', month))
+                FILTER (WHERE changeset_count > 0 AND year(month) >= {ACTIVITY_START_YEAR}) as changeset_month_indexes
+        FROM ({activity_sql})
+        WHERE user_name IS NOT NULL
+        GROUP BY user_name
+    """)
+    merge_sql = ", ".join(
+        [
+            "least(previous.first_active_month, activity.first_active_month) as first_active_month",
+            "greatest(previous.last_active_month, activity.last_active_month) as last_active_month",
+            *(
+                f"coalesce(previous.{column}, 0) + coalesce(activity.{column}, 0) as {column}"
+                for column in ACTIVITY_COLUMNS
+            ),
+        ]
+    )
+    user_dim = connection.sql(f"""
+        WITH new_users AS (
+            SELECT user_name, (SELECT coalesce(max(user_id), 0) FROM previous_user_dim)
+                + row_number() OVER (ORDER BY first_active_month, user_name) as user_id
+            FROM user_activity ANTI JOIN previous_user_dim USING (user_name)
+        )
+        SELECT coalesce(previous.user_id, new_users.user_id)::INTEGER as user_id,
+            coalesce(previous.user_name, activity.user_name) as user_name, {merge_sql},
+            activity.changeset_month_indexes, previous.changeset_months
+        FROM user_activity activity
+        FULL JOIN previous_user_dim previous USING (user_name)
+        LEFT JOIN new_users USING (user_name)
+        ORDER BY user_id
+    """)
+    user_dim = pa.table(user_dim.arrow())
+    changeset_months = add_month_indexes(
+        user_dim["changeset_months"], user_dim["changeset_month_indexes"], month_index(*last_month) // 8 + 1
+    )
+    user_dim = user_dim.drop_columns(["changeset_month_indexes", "changeset_months"])
+    user_dim = user_dim.append_column("changeset_months", changeset_months).cast(USER_DIM_SCHEMA)
+    return user_dim.replace_schema_metadata({LAST_MONTH_METADATA_KEY: f"{last_month[0]}-{last_month[1]:02d}"})
+
+
+def write_user_dim(user_dim_path, user_dim):
+    user_dim_file = Path(user_dim_path) / USER_DIM_FILE
+    user_dim_file.parent.mkdir(parents=True, exist_ok=True)
+    temp_file = user_dim_file.with_name(f"{user_dim_file.name}.tmp")
+    pq.write_table(user_dim, temp_file)
+    temp_file.replace(user_dim_file)
+
+
+def add_user_id_column(data_path, user_dim):
+    """Add the user_id column to the Parquet files of a dataset that don't have it yet.
+
+    The ids of a user never change, so the files that already have the column are up to date.
+    Returns the number of rewritten files.
+    """
+    connection = duckdb.connect()
+    connection.register("user_dim", user_dim.select(["user_name", "user_id"]))
+    rewritten_count = 0
+    for data_file in sorted(Path(data_path).rglob("*.parquet")):
+        if "user_id" in pq.read_schema(data_file).names:
+            continue
+        temp_file = data_file.with_name(f"{data_file.name}.tmp")
+        # the rows without a match are returned after the matched rows of a chunk, sort them back into place
+        connection.execute(f"""
+            COPY (
+                SELECT data.* EXCLUDE (file_row_number), user_dim.user_id
+                FROM read_parquet('{data_file}', hive_partitioning = false, file_row_number = true) data
+                LEFT JOIN user_dim ON data.user_name = user_dim.user_name
+                ORDER BY data.file_row_number
+            ) TO '{temp_file}' (FORMAT PARQUET);
+        """)
+        temp_file.replace(data_file)
+        rewritten_count += 1
+    return rewritten_count
+
+
+def get_previous_month():
+    now = datetime.now()
+    return (now.year, now.month - 1) if now.month > 1 else (now.year - 1, 12)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Add the activity of the months since the last update to the user dimension that maps every "
+        "user name to a stable integer user_id, and add the user_id column to the changeset comments and notes "
+        "comments datasets"
+    )
+    parser.add_argument("changeset_data_path", help="Path to the (raw or enriched) changeset dataset directory")
+    parser.add_argument("changeset_comments_data_path", help="Path to the changeset comments dataset directory")
+    parser.add_argument("notes_comments_data_path", help="Path to the notes comments dataset directory")
+    parser.add_argument("user_dim_path", help="Path to the user dimension directory, updated in place")
+    parser.add_argument(
+        "--last-month",
+        type=parse_year_month,
+        default=None,
+        help="Add the activity up to this month (YYYY-MM), the months after the last update have to be complete "
+        "in the datasets (default: the month before the current one)",
+    )
+    args = parser.parse_args()
+    last_month = args.last_month or get_previous_month()
+
+    start_time = time.time()
+    previous_user_dim = read_user_dim(args.user_dim_path)
+    previous_last_month = get_last_month(previous_user_dim.schema)
+    if previous_last_month is not None and previous_last_month >= last_month:
+        print(
+            f"The user dimension already contains the activity up to {previous_last_month[0]}-{previous_last_month[1]:02d}"
+        )
+        user_dim = previous_user_dim
+    else:
+        activity_sql = get_activity_sql(
+            args.changeset_data_path,
+            args.changeset_comments_data_path,
+            args.notes_comments_data_path,
+            last_month,
+            after_month=previous_last_month,
+        )
+        user_dim = update_user_dim(previous_user_dim, activity_sql, last_month)
+        write_user_dim(args.user_dim_path, user_dim)
+        print(
+            f"Saved {user_dim.num_rows} users ({user_dim.num_rows - previous_user_dim.num_rows} new) with the activity "
+            f"up to {last_month[0]}-{last_month[1]:02d} to {args.user_dim_path}"
+        )
+
+    # the user_id column of changeset_data is added by the enrichment, see changeset_raw_data_to_data.py --user-dim
+    for data_path in [args.changeset_comments_data_path, args.notes_comments_data_path]:
+        rewritten_count = add_user_id_column(data_path, user_dim)
+        print(f"Added the user_id column to {rewritten_count} files of {data_path}")
+
+    elapsed_time = time.time() - start_time
+    print(f"Updated the user dimension in {int(elapsed_time // 60)}:{int(elapsed_time % 60):02d} minutes")
+
+
+if __name__ == "__main__":
+    main()
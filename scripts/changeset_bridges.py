@@ -0,0 +1,39 @@
+from pathlib import Path
+
+import duckdb
+from enrichment_manifest import partition_key
+
+BRIDGE_FILE = "bridge.parquet"
+# enriched list columns that get a bridge table with one row per changeset and distinct value
+BRIDGE_COLUMNS = ["all_tags", "hashtags", "imagery_used", "source"]
+
+
+def get_bridge_sql(changesets_sql, column):
+    """Generate the SQL query of the bridge table of a list column of one enriched year-month.
+
+    The rows are sorted by value, so the row group statistics of the Parquet file let a query for some values
+    skip the other row groups. year and month are the hive partition columns like in the enriched changesets.
+    """
+    return f"""
+        SELECT changeset_id, user_id, edit_count, value
+        FROM (
+            SELECT changeset_id, user_id, edit_count, unnest(list_distinct({column})) as value
+            FROM {changesets_sql}
+        )
+        ORDER BY value, changeset_id
+    """
+
+
+def write_year_month_bridges(enriched_path, bridge_path, year, month):
+    """Write the bridge tables of an enriched year-month to bridge_path/<column>, replacing the previous ones.
+
+    The enriched changesets need the user_id column, see --user-dim of changeset_raw_data_to_data.py.
+    """
+    partition_dir = Path(enriched_path) / partition_key(year, month)
+    changesets_sql = f"read_parquet('{partition_dir}/*.parquet', hive_partitioning = false)"
+    for column in BRIDGE_COLUMNS:
+        bridge_file = Path(bridge_path) / column / partition_key(year, month) / BRIDGE_FILE
+        bridge_file.parent.mkdir(parents=True, exist_ok=True)
+        temp_file = bridge_file.with_name(f"{bridge_file.name}.tmp")
+        duckdb.sql(f"COPY ({get_bridge_sql(changesets_sql, column)}) TO '{temp_file}' (FORMAT PARQUET)")
+        temp_file.replace(bridge_file)
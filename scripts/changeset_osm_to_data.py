@@ -0,0 +1,170 @@
+import argparse
+import shutil
+import sys
+import time
+from pathlib import Path
+
+from changeset_osm_to_raw_data import CHANGESET_SCHEMA, DISCUSSION_SCHEMA, ChangesetParser
+from changeset_raw_data_to_data import (
+    TokenCache,
+    create_organised_team_lookup_table,
+    enrich_record_batches,
+    get_column_expressions,
+)
+from changeset_rollups import write_rollups
+from changeset_sketches import write_sketches
+from osm_xml import XML_BACKENDS
+
+
+def parse_file_enriched(
+    file_path,
+    parser_kwargs,
+    decompression_workers=None,
+    decompressor=None,
+    token_cache_path=None,
+    rollup_path=None,
+    sketch_path=None,
+):
+    """Parse the dump and write the enriched changesets of changeset_raw_data_to_data.py instead of the raw ones.
+
+    DuckDB applies the enrichment SQL to the Arrow batches of ChangesetParser.iter_changeset_batches, so the raw
+    changesets are neither written to nor read from disk. With rollup_path and sketch_path, the monthly rollups and
+    sketches of all year-months are written there afterwards. Returns the number of changesets.
+    """
+    create_organised_team_lookup_table()
+    expressions = get_column_expressions()
+    token_cache = TokenCache(token_cache_path)
+    changeset_parser = ChangesetParser(**parser_kwargs)
+    batch_reader = changeset_parser.changeset_batch_reader(file_path, decompression_workers, decompressor)
+    # DuckDB only creates the output directory itself
+    Path(parser_kwargs["changeset_output_path"]).parent.mkdir(parents=True, exist_ok=True)
+    enrich_record_batches(batch_reader, parser_kwargs["changeset_output_path"], expressions, token_cache)
+    changeset_parser.finalize()
+    token_cache.save()
+    if rollup_path is not None:
+        write_rollups(parser_kwargs["changeset_output_path"], rollup_path)
+    if sketch_path is not None:
+        write_sketches(parser_kwargs["changeset_output_path"], sketch_path)
+    return changeset_parser.changeset_count
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Parse OSM changesets (with discussions) and write the enriched changesets of "
+        "changeset_raw_data_to_data.py for all months in one pass, without writing the raw changesets"
+    )
+    parser.add_argument(
+        "changeset_path",
+        help="Path to the OSM changeset file (bz2, gzip, zstd or uncompressed) or - to read it from stdin",
+    )
+    parser.add_argument("changeset_output_path", help="Path to the output directory for the enriched changeset data")
+    parser.add_argument("discussion_output_path", help="Path to the output directory for discussion data")
+    parser.add_argument(
+        "--changeset-batch-size",
+        type=int,
+        default=None,
+        help="Number of changesets to process in each batch (default: 1_000_000, no limit with --batch-memory-mb)",
+    )
+    parser.add_argument(
+        "--discussion-batch-size",
+        type=int,
+        default=None,
+        help="Number of discussion comments to process in each batch "
+        "(default: 1_000_000, no limit with --batch-memory-mb)",
+    )
+    parser.add_argument(
+        "--batch-memory-mb",
+        type=float,
+        default=None,
+        help="Hand a changeset or discussion batch on once its buffered columns take this many MB "
+        "instead of after a fixed number of rows",
+    )
+    parser.add_argument("--overwrite", action="store_true", help="Delete output directories if they exist")
+    parser.add_argument(
+        "--comments-ignore-current-month",
+        action="store_true",
+        help="Skip processing discussion comments created in the current month (useful for avoiding incomplete data)",
+    )
+    parser.add_argument(
+        "--decompression-workers",
+        type=int,
+        default=None,
+        help="Decompress bz2 blocks in parallel with this many worker processes (default: single threaded bz2)",
+    )
+    parser.add_argument(
+        "--decompressor",
+        default=None,
+        help='External command that decompresses the input from stdin to stdout, e.g. "lbzip2 -dc"',
+    )
+    parser.add_argument(
+        "--xml-backend",
+        choices=XML_BACKENDS,
+        default="etree",
+        help="XML parser backend, expat fills the columns without building Elements (default: etree)",
+    )
+    parser.add_argument(
+        "--token-cache",
+        default=None,
+        help="Token cache of changeset_raw_data_to_data.py (default: no cache)",
+    )
+    parser.add_argument(
+        "--rollup-path",
+        default=None,
+        help="Write the monthly rollups of changeset_raw_data_to_data.py to this directory (default: no rollups)",
+    )
+    parser.add_argument(
+        "--sketch-path",
+        default=None,
+        help="Write the contributor and top-K sketches of changeset_raw_data_to_data.py to this directory "
+        "(default: no sketches)",
+    )
+
+    args = parser.parse_args()
+    default_batch_size = 1_000_000 if args.batch_memory_mb is None else sys.maxsize
+    if args.changeset_batch_size is None:
+        args.changeset_batch_size = default_batch_size
+    if args.discussion_batch_size is None:
+        args.discussion_batch_size = default_batch_size
+    if args.decompressor and args.decompression_workers:
+        parser.error("--decompressor can't be combined with --decompression-workers")
+
+    for output_path in (Path(args.changeset_output_path), Path(args.discussion_output_path)):
+        if output_path.exists():
+            if args.overwrite:
+                print(f"Removing existing directory: {output_path}")
+                shutil.rmtree(output_path)
+            else:
+                raise FileExistsError(
+                    f"Output directory '{output_path}' already exists. Use --overwrite to delete it or choose a different path."
+                )
+
+    print(f"Processing and enriching {args.changeset_path}...")
+    start_time = time.time()
+    parser_kwargs = {
+        "changeset_batch_size": args.changeset_batch_size,
+        "discussion_batch_size": args.discussion_batch_size,
+        "changeset_output_path": args.changeset_output_path,
+        "discussion_output_path": args.discussion_output_path,
+        "changeset_schema": CHANGESET_SCHEMA,
+        "discussion_schema": DISCUSSION_SCHEMA,
+        "ignore_current_month": args.comments_ignore_current_month,
+        "xml_backend": args.xml_backend,
+        "batch_memory_mb": args.batch_memory_mb,
+    }
+    changeset_count = parse_file_enriched(
+        args.changeset_path,
+        parser_kwargs,
+        decompression_workers=args.decompression_workers,
+        decompressor=args.decompressor,
+        token_cache_path=args.token_cache,
+        rollup_path=args.rollup_path,
+        sketch_path=args.sketch_path,
+    )
+    print(f"Enriched {changeset_count} changesets")
+
+    elapsed_time = time.time() - start_time
+    print(f"Processing completed in {int(elapsed_time // 60)}:{int(elapsed_time % 60):02d} minutes")
+
+
+if __name__ == "__main__":
+    main()
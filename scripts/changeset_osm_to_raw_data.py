@@ -1,14 +1,70 @@
 import argparse
-import bz2
+import gzip
+import io
+import json
+import multiprocessing
+import queue
 import shutil
 import sys
 import time
-import xml.etree.ElementTree as ET
+import urllib.request
+from collections import deque
 from datetime import datetime
 from pathlib import Path
 
 import pyarrow as pa
+import pyarrow.compute as pc
 import pyarrow.parquet as pq
+from background_writer import BackgroundWriter
+from build_bz2_block_index import find_start_position, get_block_index_path
+from checkpoint import (
+    CHECKPOINT_FILE,
+    read_checkpoint,
+    remove_unsaved_batches,
+    resume_position,
+    stream_checkpoint,
+    write_checkpoint,
+)
+from column_buffers import (
+    COMPACT_INTERVAL,
+    MEMORY_CHECK_INTERVAL,
+    FloatBuffer,
+    MapBuffer,
+    NumberBuffer,
+    StringBuffer,
+    TimestampBuffer,
+    buffers_nbytes,
+)
+from ingest_metrics import IngestMetrics, write_metrics_report
+from osm_input import STDIN_PATH, input_compressed_size, open_input, resync_stream
+from osm_xml import XML_BACKENDS, iter_changesets
+from partitioned_writer import DEFAULT_ROW_GROUP_SIZE, PartitionedParquetWriter
+
+CHANGESET_SCHEMA = pa.schema(
+    [
+        pa.field("changeset_id", pa.int64()),
+        pa.field("year", pa.int16()),
+        pa.field("month", pa.int8()),
+        pa.field("edit_count", pa.int32()),
+        pa.field("user_name", pa.string()),
+        pa.field("bottom_left_lon", pa.float64()),
+        pa.field("bottom_left_lat", pa.float64()),
+        pa.field("top_right_lon", pa.float64()),
+        pa.field("top_right_lat", pa.float64()),
+        pa.field("tags", pa.map_(pa.string(), pa.string())),
+    ]
+)
+
+REPLICATION_STATE_FILE = "_replication_state.json"
+
+DISCUSSION_SCHEMA = pa.schema(
+    [
+        pa.field("changeset_id", pa.int64()),
+        pa.field("date", pa.timestamp("us", tz="UTC")),
+        pa.field("user_name", pa.string()),
+        pa.field("text", pa.string()),
+    ]
+)
 
 
 class ChangesetParser:
@@ -21,17 +77,67 @@ class ChangesetParser:
         changeset_schema,
         discussion_schema,
         ignore_current_month=False,
+        worker_id=None,
+        xml_backend="etree",
+        checkpoint_path=None,
+        writer_queue_size=0,
+        one_file_per_month=False,
+        row_group_size=DEFAULT_ROW_GROUP_SIZE,
+        min_changeset_id=0,
+        since=None,
+        metrics=None,
+        batch_memory_mb=None,
     ):
         self.changeset_batch_size = changeset_batch_size
         self.discussion_batch_size = discussion_batch_size
+        # with a memory budget a batch is also saved once its buffered columns reach it, this is checked
+        # (after compacting the strings into Arrow arrays) every MEMORY_CHECK_INTERVAL rows
+        self.batch_memory_bytes = None if batch_memory_mb is None else int(batch_memory_mb * 1024 * 1024)
+        self.compact_interval = COMPACT_INTERVAL if batch_memory_mb is None else MEMORY_CHECK_INTERVAL
         self.changeset_output_path = changeset_output_path
         self.discussion_output_path = discussion_output_path
         self.changeset_schema = changeset_schema
         self.discussion_schema = discussion_schema
+        self.xml_backend = xml_backend
         self.changeset_count = 0
         self.changeset_batch_count = 0
         self.discussion_count = 0
         self.discussion_batch_count = 0
+        # workers of a sharded run write into the same directories, so their file names need to be unique
+        self.file_prefix = "part-" if worker_id is None else f"part-w{worker_id}-"
+
+        # a checkpoint is written after every saved batch, the file handle of the input is needed for its position
+        self.checkpoint_path = checkpoint_path
+        self.input_handle = None
+        self.last_changeset_id = 0
+        self.last_comment = (0, -1)
+        # changesets and comments up to these ones were already saved before resuming
+        self.saved_changeset_id = 0
+        self.saved_comment = (0, -1)
+        self.checkpoint = {
+            "changeset": stream_checkpoint(None, last_changeset_id=0, batch_count=0, count=0),
+            "discussion": stream_checkpoint(None, last_comment=(0, -1), batch_count=0, count=0),
+        }
+
+        # with a writer queue the batches are written on a background thread while parsing continues
+        self.writer = BackgroundWriter(writer_queue_size) if writer_queue_size > 0 else None
+        self.start_time = time.perf_counter()
+        self.conversion_time = 0.0
+        self.write_time = 0.0
+        # keep one open file per month instead of writing new files for every batch
+        self.partition_writer = None
+        if one_file_per_month:
+            self.partition_writer = PartitionedParquetWriter(
+                changeset_output_path, changeset_schema, row_group_size=row_group_size, file_prefix=self.file_prefix
+            )
+
+        # changesets before this id or (year, month) are skipped, since is replaced by the id of its first changeset
+        self.min_changeset_id = min_changeset_id
+        self.since = since
+        # an IngestMetrics instance that times the parse loop for the metrics report
+        self.metrics = metrics
+        # while iter_changeset_batches runs, the changeset batches are collected here instead of being written
+        self.changeset_batches = None
 
         self.ignore_current_month = ignore_current_month
         if self.ignore_current_month:
@@ -43,54 +149,137 @@ class ChangesetParser:
         self._init_discussion_data()
 
     def _init_changeset_data(self):
-        self.changeset_id = []
-        self.year = []
-        self.month = []
-        self.edit_count = []
-        self.user_name = []
-        self.tags = []
-        self.bottom_left_lon = []
-        self.bottom_left_lat = []
-        self.top_right_lon = []
-        self.top_right_lat = []
+        self.changeset_id = NumberBuffer("q", pa.int64())
+        self.year = NumberBuffer("h", pa.int16())
+        self.month = NumberBuffer("b", pa.int8())
+        self.edit_count = NumberBuffer("i", pa.int32())
+        self.user_name = StringBuffer()
+        self.tags = MapBuffer()
+        self.bottom_left_lon = FloatBuffer()
+        self.bottom_left_lat = FloatBuffer()
+        self.top_right_lon = FloatBuffer()
+        self.top_right_lat = FloatBuffer()
 
     def _init_discussion_data(self):
-        self.discussion_changeset_id = []
-        self.discussion_date = []
-        self.discussion_user_name = []
-        self.discussion_text = []
+        self.discussion_changeset_id = NumberBuffer("q", pa.int64())
+        self.discussion_date = TimestampBuffer()
+        self.discussion_user_name = StringBuffer()
+        self.discussion_text = StringBuffer()
 
-    def _save_changeset_batch(self):
-        """Save current changeset batch to disk and clear changeset data"""
-        if not self.changeset_id:
-            return
+    def _changeset_nbytes(self):
+        """Estimated memory of the buffered changeset columns"""
+        return buffers_nbytes(
+            self.changeset_id,
+            self.year,
+            self.month,
+            self.edit_count,
+            self.user_name,
+            self.tags,
+            self.bottom_left_lon,
+            self.bottom_left_lat,
+            self.top_right_lon,
+            self.top_right_lat,
+        )
+
+    def _discussion_nbytes(self):
+        """Estimated memory of the buffered discussion columns"""
+        return buffers_nbytes(
+            self.discussion_changeset_id, self.discussion_date, self.discussion_user_name, self.discussion_text
+        )
 
+    def _changeset_table(self):
+        """Convert the buffered changeset columns to an Arrow table"""
         changeset_data_dict = {
-            "changeset_id": self.changeset_id,
-            "year": self.year,
-            "month": self.month,
-            "edit_count": self.edit_count,
-            "user_name": self.user_name,
-            "tags": self.tags,
-            "bottom_left_lon": self.bottom_left_lon,
-            "bottom_left_lat": self.bottom_left_lat,
-            "top_right_lon": self.top_right_lon,
-            "top_right_lat": self.top_right_lat,
+            "changeset_id": self.changeset_id.to_arrow(),
+            "year": self.year.to_arrow(),
+            "month": self.month.to_arrow(),
+            "edit_count": self.edit_count.to_arrow(),
+            "user_name": self.user_name.to_arrow(),
+            "tags": self.tags.to_arrow(),
+            "bottom_left_lon": self.bottom_left_lon.to_arrow(),
+            "bottom_left_lat": self.bottom_left_lat.to_arrow(),
+            "top_right_lon": self.top_right_lon.to_arrow(),
+            "top_right_lat": self.top_right_lat.to_arrow(),
         }
-        changeset_table = pa.table(changeset_data_dict, schema=self.changeset_schema)
+        return pa.table(changeset_data_dict, schema=self.changeset_schema)
 
-        # Save as partitioned dataset
+    def _discussion_table(self):
+        """Convert the buffered discussion columns to an Arrow table"""
+        discussion_data_dict = {
+            "changeset_id": self.discussion_changeset_id.to_arrow(),
+            "date": self.discussion_date.to_arrow(),
+            "user_name": self.discussion_user_name.to_arrow(),
+            "text": self.discussion_text.to_arrow(),
+        }
+        return pa.table(discussion_data_dict, schema=self.discussion_schema)
+
+    def _write_changeset_table(self, changeset_table, batch_number):
+        """Write a changeset batch as partitioned dataset"""
+        if self.partition_writer is not None:
+            self.partition_writer.write_table(changeset_table)
+            return
         pq.write_to_dataset(
             changeset_table,
             root_path=self.changeset_output_path,
             partition_cols=["year", "month"],
-            basename_template=f"part-{self.changeset_batch_count}-{{i}}.parquet",
+            basename_template=f"{self.file_prefix}{batch_number}-{{i}}.parquet",
             existing_data_behavior="overwrite_or_ignore",
         )
 
+    def _write_discussion_table(self, discussion_table, batch_number):
+        """Write a discussion batch as single file"""
+        discussion_dir = Path(self.discussion_output_path)
+        discussion_dir.mkdir(parents=True, exist_ok=True)
+        discussion_file = discussion_dir / f"{self.file_prefix}{batch_number}.parquet"
+        pq.write_table(discussion_table, discussion_file)
+
+    def _write_batch(self, write_table, table, batch_number, stream, batch_checkpoint):
+        """Write a batch and afterwards its checkpoint, on the background writer if there is one"""
+
+        def write():
+            start_time = time.perf_counter()
+            write_table(table, batch_number)
+            self.write_time += time.perf_counter() - start_time
+            self._save_checkpoint(stream, batch_checkpoint)
+
+        if self.writer is None:
+            write()
+        else:
+            self.writer.submit(write)
+
+    def _save_changeset_batch(self):
+        """Save current changeset batch to disk and clear changeset data"""
+        if not self.changeset_id:
+            return
+
+        start_time = time.perf_counter()
+        changeset_table = self._changeset_table()
+        self.conversion_time += time.perf_counter() - start_time
+
         self._init_changeset_data()
+        if self.changeset_batches is not None:
+            self.changeset_batches.extend(changeset_table.to_batches())
+            self.changeset_batch_count += 1
+            print(f"Parsed changeset batch {self.changeset_batch_count} with {changeset_table.num_rows} changesets")
+            sys.stdout.flush()
+            return
+        self._write_batch(
+            self._write_changeset_table,
+            changeset_table,
+            self.changeset_batch_count,
+            "changeset",
+            stream_checkpoint(
+                self.input_handle,
+                last_changeset_id=self.last_changeset_id,
+                batch_count=self.changeset_batch_count + 1,
+                count=self.changeset_count,
+            ),
+        )
         self.changeset_batch_count += 1
-        print(f"Saved changeset batch {self.changeset_batch_count}, processed {self.changeset_count} changesets total")
+        print(
+            f"Saved changeset batch {self.changeset_batch_count} with {changeset_table.num_rows} changesets "
+            f"({changeset_table.nbytes / 1024 / 1024:.1f} MB), processed {self.changeset_count} changesets total"
+        )
         sys.stdout.flush()
 
     def _save_discussion_batch(self):
@@ -98,35 +287,88 @@ class ChangesetParser:
         if not self.discussion_changeset_id:
             return
 
-        discussion_data_dict = {
-            "changeset_id": self.discussion_changeset_id,
-            "date": self.discussion_date,
-            "user_name": self.discussion_user_name,
-            "text": self.discussion_text,
-        }
-        discussion_table = pa.table(discussion_data_dict, schema=self.discussion_schema)
-
-        discussion_dir = Path(self.discussion_output_path)
-        discussion_dir.mkdir(parents=True, exist_ok=True)
-        discussion_file = discussion_dir / f"part-{self.discussion_batch_count}.parquet"
-        pq.write_table(discussion_table, discussion_file)
+        start_time = time.perf_counter()
+        discussion_table = self._discussion_table()
+        self.conversion_time += time.perf_counter() - start_time
 
         self._init_discussion_data()
+        self._write_batch(
+            self._write_discussion_table,
+            discussion_table,
+            self.discussion_batch_count,
+            "discussion",
+            stream_checkpoint(
+                self.input_handle,
+                last_comment=self.last_comment,
+                batch_count=self.discussion_batch_count + 1,
+                count=self.discussion_count,
+            ),
+        )
         self.discussion_batch_count += 1
-        print(f"Saved discussion batch {self.discussion_batch_count}, processed {self.discussion_count} comments total")
+        print(
+            f"Saved discussion batch {self.discussion_batch_count} with {discussion_table.num_rows} comments "
+            f"({discussion_table.nbytes / 1024 / 1024:.1f} MB), processed {self.discussion_count} comments total"
+        )
         sys.stdout.flush()
 
+    def _save_checkpoint(self, stream, batch_checkpoint):
+        """Update the checkpoint of one output stream after its batch was written"""
+        if self.checkpoint_path is None:
+            return
+        self.checkpoint[stream] = batch_checkpoint
+        write_checkpoint(self.checkpoint_path, self.checkpoint)
+
+    def _resume_from_checkpoint(self):
+        """Restore the state of the checkpoint and remove batch files that were written after it.
+
+        Returns the input position to continue from. The changesets in the dump are ordered by id, so
+        the changesets and comments up to the last saved ones are skipped after resuming.
+        """
+        if self.partition_writer is not None:
+            raise ValueError("Resuming isn't possible when writing one file per month, the open files are incomplete")
+        self.checkpoint = read_checkpoint(self.checkpoint_path)
+        changeset_checkpoint = self.checkpoint["changeset"]
+        discussion_checkpoint = self.checkpoint["discussion"]
+        self.saved_changeset_id = self.last_changeset_id = changeset_checkpoint["last_changeset_id"]
+        self.saved_comment = self.last_comment = tuple(discussion_checkpoint["last_comment"])
+        self.changeset_batch_count = changeset_checkpoint["batch_count"]
+        self.changeset_count = changeset_checkpoint["count"]
+        self.discussion_batch_count = discussion_checkpoint["batch_count"]
+        self.discussion_count = discussion_checkpoint["count"]
+        remove_unsaved_batches(
+            self.changeset_output_path, rf"{self.file_prefix}(\d+)-\d+\.parquet", self.changeset_batch_count
+        )
+        remove_unsaved_batches(
+            self.discussion_output_path, rf"{self.file_prefix}(\d+)\.parquet", self.discussion_batch_count
+        )
+        print(
+            f"Resuming after changeset {self.saved_changeset_id} and the comments of changeset {self.saved_comment[0]}"
+        )
+        return resume_position(self.checkpoint)
+
     def _parse_timestamp(self, timestamp_str):
         """Parse ISO 8601 timestamp string to datetime object"""
         return datetime.fromisoformat(timestamp_str[:-1] + "+00:00")
 
-    def _process_changeset(self, elem):
-        """Process a single changeset element"""
-        self.changeset_count += 1
-
+    def _process_changeset(self, attribs, tags, comments):
+        """Process a single changeset with its tags and discussion comments"""
         # Get changeset attributes
-        attribs = elem.attrib
         changeset_id = int(attribs.get("id"))
+        self.last_changeset_id = changeset_id
+        if changeset_id < self.min_changeset_id:
+            return
+        if self.since is not None:
+            created_at = self._parse_timestamp(attribs.get("created_at"))
+            if (created_at.year, created_at.month) < self.since:
+                return
+            self.min_changeset_id = changeset_id
+            self.since = None
+        if changeset_id <= self.saved_changeset_id:
+            # the changeset was already saved before resuming, only some of its comments may be missing
+            self._process_comments(changeset_id, comments)
+            return
+
+        self.changeset_count += 1
         created_at = self._parse_timestamp(attribs.get("created_at"))
 
         # Store basic changeset data
@@ -150,91 +392,555 @@ class ChangesetParser:
         self.top_right_lon.append(float(max_lon) if max_lon else None)
         self.top_right_lat.append(float(max_lat) if max_lat else None)
 
-        # Extract tags
-        tags_dict = {}
-        for child in elem:
-            if child.tag == "tag":
-                key = child.attrib.get("k", "")
-                value = child.attrib.get("v", "")
-                tags_dict[key] = value
-        self.tags.append(tags_dict)
-
-        # Extract discussion comments
-        for child in elem:
-            if child.tag == "discussion":
-                for comment_elem in child:
-                    if comment_elem.tag == "comment":
-                        comment_attribs = comment_elem.attrib
-                        comment_date = self._parse_timestamp(comment_attribs.get("date"))
-
-                        if (
-                            self.ignore_current_month
-                            and comment_date.year == self.current_year
-                            and comment_date.month == self.current_month
-                        ):
-                            continue
-
-                        self.discussion_count += 1
-
-                        comment_text = ""
-                        for text_elem in comment_elem:
-                            if text_elem.tag == "text":
-                                comment_text = text_elem.text or ""
-                                break
-
-                        # Store discussion data
-                        self.discussion_changeset_id.append(changeset_id)
-                        self.discussion_date.append(comment_date)
-                        self.discussion_user_name.append(comment_attribs.get("user", ""))
-                        self.discussion_text.append(comment_text)
-
-                        # Check if we need to save discussion batch
-                        if len(self.discussion_changeset_id) >= self.discussion_batch_size:
-                            self._save_discussion_batch()
+        self.tags.append(tags)
+
+        self._process_comments(changeset_id, comments)
 
         # Check if we need to save changeset batch
         if len(self.changeset_id) >= self.changeset_batch_size:
             self._save_changeset_batch()
+        elif len(self.changeset_id) % self.compact_interval == 0:
+            self.user_name.compact()
+            self.tags.compact()
+            if self.batch_memory_bytes is not None and self._changeset_nbytes() >= self.batch_memory_bytes:
+                self._save_changeset_batch()
 
-        # Clear the element to free memory
-        elem.clear()
+    def _process_comments(self, changeset_id, comments):
+        """Store the discussion comments of a changeset"""
+        for comment_index, (comment_attribs, comment_text) in enumerate(comments):
+            # Skip comments that were already saved before resuming
+            if changeset_id <= self.saved_comment[0] and (changeset_id, comment_index) <= self.saved_comment:
+                continue
+            self.last_comment = (changeset_id, comment_index)
+            comment_date = self._parse_timestamp(comment_attribs.get("date"))
 
-    def parse_file(self, file_path):
-        """Parse OSM changeset bz2 XML file using iterparse for memory efficiency"""
-        with bz2.open(file_path, "rb") as file_handle:
-            context = ET.iterparse(file_handle, events=("end",))
-            for event, elem in context:
-                if elem.tag == "changeset":
-                    self._process_changeset(elem)
+            if (
+                self.ignore_current_month
+                and comment_date.year == self.current_year
+                and comment_date.month == self.current_month
+            ):
+                continue
+
+            self.discussion_count += 1
+
+            # Store discussion data
+            self.discussion_changeset_id.append(changeset_id)
+            self.discussion_date.append(comment_date)
+            self.discussion_user_name.append(comment_attribs.get("user", ""))
+            self.discussion_text.append(comment_text)
+
+            # Check if we need to save discussion batch
+            if len(self.discussion_changeset_id) >= self.discussion_batch_size:
+                self._save_discussion_batch()
+            elif len(self.discussion_changeset_id) % self.compact_interval == 0:
+                self.discussion_user_name.compact()
+                self.discussion_text.compact()
+                if self.batch_memory_bytes is not None and self._discussion_nbytes() >= self.batch_memory_bytes:
+                    self._save_discussion_batch()
+
+    def _batch_save_time(self):
+        """Time the parse loop spent saving batches instead of parsing"""
+        if self.writer is None:
+            return self.conversion_time + self.write_time
+        return self.conversion_time + self.writer.wait_time
+
+    def parse_stream(self, file_handle):
+        """Parse a decompressed OSM changeset XML stream with the selected XML backend"""
+        changesets = iter_changesets(file_handle, self.xml_backend)
+        if self.metrics is not None:
+            self.metrics.process_records(changesets, self._process_changeset, self._batch_save_time)
+            return
+        for attribs, tags, comments in changesets:
+            self._process_changeset(attribs, tags, comments)
+
+    def parse_file(self, file_path, decompression_workers=None, resume=False, start_position=None, decompressor=None):
+        """Parse OSM changeset bz2 XML file, with resume=True it continues after the saved checkpoint
+
+        The file path can also be "-" for stdin or a binary file object, see open_input.
+        A start_position (e.g. from the block index) starts reading in the middle of the file.
+        """
+        position = self._resume_from_checkpoint() if resume else start_position
+        with open_input(file_path, decompression_workers, position, decompressor) as file_handle:
+            self.input_handle = file_handle
+            if self.metrics is not None:
+                compressed_size = input_compressed_size(file_path, decompression_workers, position)
+                file_handle = self.metrics.wrap_input(file_handle, compressed_size)
+            if position is None:
+                self.parse_stream(file_handle)
+            else:
+                self.parse_stream(resync_stream(file_handle, b"<changeset "))
+        self.input_handle = None
+
+    def iter_changeset_batches(self, file_path, decompression_workers=None, decompressor=None):
+        """Parse the file and yield the changesets as Arrow RecordBatches with the changeset schema.
+
+        The changesets are not written to changeset_output_path, but the discussion comments are still
+        written to discussion_output_path, so finalize has to be called after the iteration.
+        """
+        self.changeset_batches = deque()
+        with open_input(file_path, decompression_workers, decompressor=decompressor) as file_handle:
+            self.input_handle = file_handle
+            for attribs, tags, comments in iter_changesets(file_handle, self.xml_backend):
+                self._process_changeset(attribs, tags, comments)
+                while self.changeset_batches:
+                    yield self.changeset_batches.popleft()
+        self.input_handle = None
+        self._save_changeset_batch()
+        yield from self.changeset_batches
+        self.changeset_batches = None
+
+    def changeset_batch_reader(self, file_path, decompression_workers=None, decompressor=None):
+        """Return iter_changeset_batches as pyarrow RecordBatchReader, which DuckDB can scan as a table"""
+        return pa.RecordBatchReader.from_batches(
+            self.changeset_schema, self.iter_changeset_batches(file_path, decompression_workers, decompressor)
+        )
 
     def finalize(self):
         """Save any remaining data in the final batches"""
         self._save_changeset_batch()
         self._save_discussion_batch()
+        writer_wait_time = 0.0
+        if self.writer is not None:
+            self.writer.close()
+            writer_wait_time = self.writer.wait_time
+        if self.partition_writer is not None:
+            start_time = time.perf_counter()
+            self.partition_writer.close()
+            self.write_time += time.perf_counter() - start_time
+        if self.checkpoint_path is not None:
+            Path(self.checkpoint_path).unlink(missing_ok=True)
         print(
             f"Finished processing. Total: {self.changeset_count} changesets in {self.changeset_batch_count} batches, "
             f"{self.discussion_count} comments in {self.discussion_batch_count} batches"
         )
+        self.print_timings(writer_wait_time)
+
+    def print_timings(self, writer_wait_time):
+        """Print how long each stage took, to see if the parsing or the writing is the bottleneck"""
+        total_time = time.perf_counter() - self.start_time
+        parse_time = total_time - self.conversion_time - writer_wait_time
+        if self.writer is None:
+            parse_time -= self.write_time
+            write_stage = f"Parquet writing {self.write_time:.1f}s"
+        else:
+            write_stage = (
+                f"Parquet writing {self.write_time:.1f}s on the background thread, "
+                f"parser waiting for the writer {writer_wait_time:.1f}s"
+            )
+        print(
+            f"Stage timings: XML parsing {parse_time:.1f}s, Arrow conversion {self.conversion_time:.1f}s, {write_stage}"
+        )
+
+    def write_metrics_report(self, metrics_path):
+        """Write the metrics report of this run after finalize"""
+        report = self.metrics.report(
+            {"changesets": self.changeset_count, "comments": self.discussion_count},
+            arrow_build_time=self.conversion_time,
+            parquet_write_time=self.write_time,
+            writer_wait_time=0.0 if self.writer is None else self.writer.wait_time,
+            background_write=self.writer is not None,
+        )
+        write_metrics_report(metrics_path, report)
+
+
+def iter_changeset_shards(file_handle, shard_size):
+    """Split a decompressed changeset XML stream into shards of complete <changeset> elements.
+
+    Every shard starts at a "<changeset " boundary, so it can be parsed on its own after wrapping it
+    in a root element. The text of comments is escaped, so the boundary can't occur inside an element.
+    """
+    buffer = b""
+    started = False
+    while True:
+        chunk = file_handle.read(shard_size)
+        buffer += chunk
+        if not started:
+            first_changeset = buffer.find(b"<changeset ")
+            if first_changeset == -1:
+                if not chunk:
+                    return
+                continue
+            buffer = buffer[first_changeset:]
+            started = True
+
+        if not chunk:
+            root_end = buffer.rfind(b"</osm>")
+            if root_end != -1:
+                buffer = buffer[:root_end]
+            if buffer.strip():
+                yield buffer
+            return
+
+        last_changeset = buffer.rfind(b"<changeset ")
+        if last_changeset > 0:
+            yield buffer[:last_changeset]
+            buffer = buffer[last_changeset:]
+
+
+def _parse_shards_worker(worker_id, shard_queue, result_queue, parser_kwargs):
+    """Parse shards from the queue with an own ChangesetParser until a None shard is received."""
+    try:
+        changeset_parser = ChangesetParser(**parser_kwargs, worker_id=worker_id)
+        while (shard := shard_queue.get()) is not None:
+            changeset_parser.parse_stream(io.BytesIO(b"<osm>" + shard + b"</osm>"))
+        changeset_parser.finalize()
+        result_queue.put((worker_id, changeset_parser.changeset_count, changeset_parser.discussion_count, None))
+    except Exception as e:
+        result_queue.put((worker_id, 0, 0, repr(e)))
+        raise
+
+
+def parse_file_sharded(
+    file_path, workers, parser_kwargs, decompression_workers=None, decompressor=None, shard_size=64 * 1024 * 1024
+):
+    """Parse the changeset file with multiple worker processes that each write their own Parquet files.
+
+    The main process only decompresses and splits the stream into shards, the XML parsing and the
+    Parquet writing happens in the workers. Returns the total number of changesets and comments.
+    """
+    shard_queue = multiprocessing.Queue(maxsize=workers * 2)
+    result_queue = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=_parse_shards_worker, args=(worker_id, shard_queue, result_queue, parser_kwargs))
+        for worker_id in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    def check_workers():
+        if any(process.exitcode not in (None, 0) for process in processes):
+            raise RuntimeError("A changeset parser worker stopped unexpectedly")
+
+    def put_shard(shard):
+        while True:
+            try:
+                shard_queue.put(shard, timeout=1)
+                return
+            except queue.Full:
+                check_workers()
+
+    def get_result():
+        while True:
+            try:
+                return result_queue.get(timeout=1)
+            except queue.Empty:
+                check_workers()
+
+    try:
+        with open_input(file_path, decompression_workers, decompressor=decompressor) as file_handle:
+            for shard in iter_changeset_shards(file_handle, shard_size):
+                put_shard(shard)
+        for _ in processes:
+            put_shard(None)
+
+        changeset_count = 0
+        discussion_count = 0
+        for _ in processes:
+            worker_id, worker_changeset_count, worker_discussion_count, error = get_result()
+            if error is not None:
+                raise RuntimeError(f"Changeset parser worker {worker_id} failed: {error}")
+            changeset_count += worker_changeset_count
+            discussion_count += worker_discussion_count
+    except BaseException:
+        for process in processes:
+            process.terminate()
+        raise
+    for process in processes:
+        process.join()
+    return changeset_count, discussion_count
+
+
+def replication_diff_path(sequence):
+    """Path of a replication diff relative to the replication root, e.g. 5912345 -> 005/912/345.osm.gz"""
+    sequence_str = f"{sequence:09d}"
+    return f"{sequence_str[:3]}/{sequence_str[3:6]}/{sequence_str[6:]}.osm.gz"
+
+
+def _open_replication_file(replication_source, relative_path):
+    """Open a file of a replication source, which is either a URL or a local directory"""
+    if replication_source.startswith(("http://", "https://")):
+        return urllib.request.urlopen(f"{replication_source.rstrip('/')}/{relative_path}")
+    return open(Path(replication_source) / relative_path, "rb")
+
+
+def get_latest_replication_sequence(replication_source):
+    """Read the sequence number of the newest diff from the state.yaml of the replication source"""
+    with _open_replication_file(replication_source, "state.yaml") as file_handle:
+        for line in file_handle.read().decode().splitlines():
+            key, _, value = line.partition(":")
+            if key.strip() == "sequence":
+                return int(value)
+    raise ValueError(f"No sequence number found in the state.yaml of '{replication_source}'")
+
+
+def iter_replication_changesets(replication_source, first_sequence, last_sequence, xml_backend="etree"):
+    """Iterate over the changesets of the replication diffs in the given (inclusive) sequence range"""
+    for sequence in range(first_sequence, last_sequence + 1):
+        with _open_replication_file(replication_source, replication_diff_path(sequence)) as file_handle:
+            yield from iter_changesets(gzip.GzipFile(fileobj=file_handle), xml_backend)
+
+
+def collect_changeset_updates(changesets):
+    """Keep the newest version of every changeset, sorted by changeset id.
+
+    A changeset is contained in a diff every time it changes. Versions without comments keep the
+    comments of an older version, so a discussion is only replaced if the diff contained one.
+    """
+    updates = {}
+    for attribs, tags, comments in changesets:
+        changeset_id = int(attribs["id"])
+        if not comments and changeset_id in updates:
+            comments = updates[changeset_id][2]
+        updates[changeset_id] = (attribs, tags, comments)
+    return [updates[changeset_id] for changeset_id in sorted(updates)]
+
+
+def _replace_parquet_file(file_path, table):
+    """Write the table next to the file and move it into place, so readers never see a partial file"""
+    temp_path = file_path.with_name(f".{file_path.name}.tmp")
+    pq.write_table(table, temp_path)
+    temp_path.replace(file_path)
+
+
+def replace_changeset_partitions(changeset_table, changeset_output_path, file_name):
+    """Replace the changesets of the table in their year/month partitions, the other partitions are not touched.
+
+    Every affected partition is rewritten into a single file sorted by changeset id.
+    """
+    changeset_ids = changeset_table["changeset_id"]
+    year_months = changeset_table.select(["year", "month"]).group_by(["year", "month"]).aggregate([]).to_pylist()
+    for year_month in sorted(year_months, key=lambda row: (row["year"], row["month"])):
+        year, month = year_month["year"], year_month["month"]
+        partition_dir = Path(changeset_output_path) / f"year={year}" / f"month={month}"
+        partition_mask = pc.and_(pc.equal(changeset_table["year"], year), pc.equal(changeset_table["month"], month))
+        new_rows = changeset_table.filter(partition_mask).drop_columns(["year", "month"])
+
+        old_files = sorted(partition_dir.glob("*.parquet"))
+        tables = [
+            pq.read_table(file_path).select(new_rows.column_names).cast(new_rows.schema) for file_path in old_files
+        ]
+        tables = [table.filter(pc.invert(pc.is_in(table["changeset_id"], value_set=changeset_ids))) for table in tables]
+        partition_table = pa.concat_tables([*tables, new_rows]).sort_by("changeset_id")
+
+        partition_dir.mkdir(parents=True, exist_ok=True)
+        partition_file = partition_dir / file_name
+        _replace_parquet_file(partition_file, partition_table)
+        for file_path in old_files:
+            if file_path != partition_file:
+                file_path.unlink()
+
+
+def replace_discussions(discussion_table, changeset_ids, discussion_output_path, file_name):
+    """Replace the comments of the given changesets, only the files containing one of them are rewritten"""
+    discussion_dir = Path(discussion_output_path)
+    discussion_dir.mkdir(parents=True, exist_ok=True)
+    changeset_ids = pa.array(changeset_ids, pa.int64())
+    for file_path in sorted(discussion_dir.glob("*.parquet")):
+        ids_in_file = pq.read_table(file_path, columns=["changeset_id"])["changeset_id"]
+        if not pc.any(pc.is_in(ids_in_file, value_set=changeset_ids)).as_py():
+            continue
+        table = pq.read_table(file_path)
+        table = table.filter(pc.invert(pc.is_in(table["changeset_id"], value_set=changeset_ids)))
+        if table.num_rows > 0:
+            _replace_parquet_file(file_path, table)
+        else:
+            file_path.unlink()
+    if discussion_table.num_rows > 0:
+        _replace_parquet_file(discussion_dir / file_name, discussion_table)
+
+
+def apply_replication_diffs(
+    replication_source,
+    changeset_output_path,
+    discussion_output_path,
+    start_sequence=None,
+    sequences_per_update=10080,
+    ignore_current_month=False,
+    xml_backend="etree",
+):
+    """Apply the new changeset replication diffs to the existing changeset_data_raw and changeset_comments_data.
+
+    The last applied sequence number is stored in a state file in the changeset output directory. If it doesn't
+    exist yet, start_sequence is the first diff that is applied. The diffs are applied in groups of
+    sequences_per_update and the state is only saved after a group is written, so a failed run can just be
+    repeated. Returns the number of applied diffs.
+    """
+    state_path = Path(changeset_output_path) / REPLICATION_STATE_FILE
+    if state_path.exists():
+        last_applied_sequence = json.loads(state_path.read_text())["sequence"]
+    elif start_sequence is not None:
+        last_applied_sequence = start_sequence - 1
+    else:
+        raise FileNotFoundError(
+            f"Replication state file '{state_path}' doesn't exist. Use --start-sequence to set the first diff to apply."
+        )
+
+    latest_sequence = get_latest_replication_sequence(replication_source)
+    applied_count = 0
+    while last_applied_sequence < latest_sequence:
+        first_sequence = last_applied_sequence + 1
+        last_sequence = min(latest_sequence, last_applied_sequence + sequences_per_update)
+        changesets = collect_changeset_updates(
+            iter_replication_changesets(replication_source, first_sequence, last_sequence, xml_backend)
+        )
+
+        changeset_parser = ChangesetParser(
+            changeset_batch_size=sys.maxsize,
+            discussion_batch_size=sys.maxsize,
+            changeset_output_path=changeset_output_path,
+            discussion_output_path=discussion_output_path,
+            changeset_schema=CHANGESET_SCHEMA,
+            discussion_schema=DISCUSSION_SCHEMA,
+            ignore_current_month=ignore_current_month,
+            xml_backend=xml_backend,
+        )
+        for attribs, tags, comments in changesets:
+            changeset_parser._process_changeset(attribs, tags, comments)
+
+        file_prefix = f"part-r{last_sequence}"
+        replace_changeset_partitions(
+            changeset_parser._changeset_table(), changeset_output_path, f"{file_prefix}-0.parquet"
+        )
+        replace_discussions(
+            changeset_parser._discussion_table(),
+            [int(attribs["id"]) for attribs, tags, comments in changesets if comments],
+            discussion_output_path,
+            f"{file_prefix}.parquet",
+        )
+
+        state_path.parent.mkdir(parents=True, exist_ok=True)
+        state_path.write_text(json.dumps({"sequence": last_sequence}))
+        applied_count += last_sequence - last_applied_sequence
+        last_applied_sequence = last_sequence
+        print(
+            f"Applied replication diffs {first_sequence} to {last_sequence} with {len(changesets)} changed changesets"
+        )
+        sys.stdout.flush()
+    return applied_count
+
+
+def remove_discussions_since(discussion_output_path, min_changeset_id):
+    """Remove the comments of the changesets from min_changeset_id on, only files with such comments are rewritten"""
+    for file_path in sorted(Path(discussion_output_path).glob("*.parquet")):
+        max_changeset_id = pc.max(pq.read_table(file_path, columns=["changeset_id"])["changeset_id"]).as_py()
+        if max_changeset_id is None or max_changeset_id < min_changeset_id:
+            continue
+        table = pq.read_table(file_path)
+        table = table.filter(pc.less(table["changeset_id"], min_changeset_id))
+        if table.num_rows > 0:
+            _replace_parquet_file(file_path, table)
+        else:
+            file_path.unlink()
+
+
+def parse_file_since(
+    file_path,
+    block_index_path,
+    parser_kwargs,
+    min_changeset_id=None,
+    since=None,
+    decompression_workers=None,
+    metrics_path=None,
+):
+    """Parse the dump from a changeset id or (year, month) on and replace these changesets in the existing outputs.
+
+    The block index is used to start decompressing at the last bz2 block before the first wanted changeset.
+    The new rows are parsed into temporary directories next to the outputs and then replace the rows from
+    the first parsed changeset on, so only the affected partitions and comment files are rewritten.
+    The comments are in the dump with their changeset, so new comments on changesets before the first parsed
+    changeset are not added, only parsing the complete dump updates them.
+    """
+    block_index = pq.read_table(block_index_path)
+    position = find_start_position(block_index, min_changeset_id=min_changeset_id, since=since)
+    changeset_output_path = Path(parser_kwargs["changeset_output_path"])
+    discussion_output_path = Path(parser_kwargs["discussion_output_path"])
+    new_changeset_path = changeset_output_path.with_name(f"{changeset_output_path.name}.since")
+    new_discussion_path = discussion_output_path.with_name(f"{discussion_output_path.name}.since")
+    for path in [new_changeset_path, new_discussion_path]:
+        if path.exists():
+            shutil.rmtree(path)
+
+    changeset_parser = ChangesetParser(
+        **parser_kwargs
+        | {"changeset_output_path": str(new_changeset_path), "discussion_output_path": str(new_discussion_path)},
+        min_changeset_id=min_changeset_id or 0,
+        since=since,
+        metrics=IngestMetrics() if metrics_path else None,
+    )
+    print(f"Starting at decompressed offset {position['decompressed_offset'] if position else 0}")
+    # the parallel reader is needed to start at a bz2 block
+    changeset_parser.parse_file(file_path, decompression_workers or 1, start_position=position)
+    changeset_parser.finalize()
+    if metrics_path:
+        changeset_parser.write_metrics_report(metrics_path)
+    if changeset_parser.since is not None:
+        print("No changesets found in the given range")
+        return 0
+
+    first_changeset_id = changeset_parser.min_changeset_id
+    file_prefix = f"part-since{first_changeset_id}"
+    for partition_dir in sorted(new_changeset_path.glob("year=*/month=*")):
+        year = int(partition_dir.parent.name.removeprefix("year="))
+        month = int(partition_dir.name.removeprefix("month="))
+        partition_table = pq.read_table(partition_dir)
+        partition_table = partition_table.append_column(
+            "year", pa.array([year] * partition_table.num_rows, pa.int16())
+        ).append_column("month", pa.array([month] * partition_table.num_rows, pa.int8()))
+        replace_changeset_partitions(partition_table, changeset_output_path, f"{file_prefix}-0.parquet")
+
+    remove_discussions_since(discussion_output_path, first_changeset_id)
+    discussion_output_path.mkdir(parents=True, exist_ok=True)
+    for file_number, file_path in enumerate(sorted(new_discussion_path.glob("*.parquet"))):
+        file_path.replace(discussion_output_path / f"{file_prefix}-{file_number}.parquet")
+
+    shutil.rmtree(new_changeset_path, ignore_errors=True)
+    shutil.rmtree(new_discussion_path, ignore_errors=True)
+    print(
+        f"Warning: new comments on changesets before {first_changeset_id} are not added, "
+        "parse the complete dump to update all comments"
+    )
+    return changeset_parser.changeset_count
+
+
+def parse_year_month(value):
+    """Parse a YYYY-MM argument into a (year, month) tuple"""
+    try:
+        year_month = datetime.strptime(value, "%Y-%m")
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"'{value}' is not in the format YYYY-MM") from None
+    return year_month.year, year_month.month
 
 
 def main():
     parser = argparse.ArgumentParser(
         description="Process OSM changesets (with discussions) and convert to partitioned Parquet datasets"
     )
-    parser.add_argument("changeset_path", help="Path to the OSM changeset .bz2 file")
+    parser.add_argument(
+        "changeset_path",
+        help="Path to the OSM changeset file (bz2, gzip, zstd or uncompressed) or - to read it from stdin, "
+        "or the replication directory or URL with --incremental",
+    )
     parser.add_argument("changeset_output_path", help="Path to the output directory for changeset data")
     parser.add_argument("discussion_output_path", help="Path to the output directory for discussion data")
     parser.add_argument(
         "--changeset-batch-size",
         type=int,
-        default=1_000_000,
-        help="Number of changesets to process in each batch (default: 1_000_000)",
+        default=None,
+        help="Number of changesets to process in each batch (default: 1_000_000, no limit with --batch-memory-mb)",
     )
     parser.add_argument(
         "--discussion-batch-size",
         type=int,
-        default=1_000_000,
-        help="Number of discussion comments to process in each batch (default: 1_000_000)",
+        default=None,
+        help="Number of discussion comments to process in each batch "
+        "(default: 1_000_000, no limit with --batch-memory-mb)",
+    )
+    parser.add_argument(
+        "--batch-memory-mb",
+        type=float,
+        default=None,
+        help="Save a changeset or discussion batch once its buffered columns take this many MB "
+        "instead of after a fixed number of rows",
     )
     parser.add_argument("--overwrite", action="store_true", help="Delete output directories if they exist")
     parser.add_argument(
@@ -242,69 +948,226 @@ def main():
         action="store_true",
         help="Skip processing discussion comments created in the current month (useful for avoiding incomplete data)",
     )
+    parser.add_argument(
+        "--decompression-workers",
+        type=int,
+        default=None,
+        help="Decompress bz2 blocks in parallel with this many worker processes (default: single threaded bz2)",
+    )
+    parser.add_argument(
+        "--decompressor",
+        default=None,
+        help='External command that decompresses the input from stdin to stdout, e.g. "lbzip2 -dc"',
+    )
+    parser.add_argument(
+        "--xml-backend",
+        choices=XML_BACKENDS,
+        default="etree",
+        help="XML parser backend, expat fills the columns without building Elements (default: etree)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Parse the XML in this many worker processes that each write their own Parquet files (default: 1)",
+    )
+
+    parser.add_argument(
+        "--writer-queue-size",
+        type=int,
+        default=0,
+        help="Write the Parquet batches on a background thread with up to this many batches waiting, "
+        "0 writes them synchronously (default: 0)",
+    )
+    parser.add_argument(
+        "--one-file-per-month",
+        action="store_true",
+        help="Append the changeset batches to one open Parquet file per year/month partition "
+        "instead of writing new files for every batch",
+    )
+    parser.add_argument(
+        "--row-group-size",
+        type=int,
+        default=DEFAULT_ROW_GROUP_SIZE,
+        help=f"Rows per row group with --one-file-per-month (default: {DEFAULT_ROW_GROUP_SIZE})",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue an interrupted run after the checkpoint in the changeset output directory",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Apply the changeset replication diffs (e.g. https://planet.openstreetmap.org/replication/changesets) "
+        "to the existing output directories and only rewrite the affected year/month partitions",
+    )
+    parser.add_argument(
+        "--start-sequence",
+        type=int,
+        default=None,
+        help="First replication sequence to apply with --incremental if no replication state exists yet",
+    )
+    parser.add_argument(
+        "--sequences-per-update",
+        type=int,
+        default=10080,
+        help="Number of replication diffs applied per rewrite of the affected partitions (default: 10080)",
+    )
+
+    seek_group = parser.add_mutually_exclusive_group()
+    seek_group.add_argument(
+        "--since",
+        type=parse_year_month,
+        default=None,
+        help="Only parse the changesets created from this month (YYYY-MM) on and replace them in the existing outputs, "
+        "uses the block index to start decompressing close to them. New comments on older changesets are not "
+        "added, parse the complete dump to update them",
+    )
+    seek_group.add_argument(
+        "--min-changeset-id",
+        type=int,
+        default=None,
+        help="Like --since, but starting from this changeset id",
+    )
+    parser.add_argument(
+        "--block-index",
+        default=None,
+        help="Block index for --since and --min-changeset-id, see build_bz2_block_index.py "
+        "(default: <changeset_path>.index.parquet)",
+    )
+    parser.add_argument(
+        "--metrics-json",
+        default=None,
+        help="Write a JSON report with the throughput, the time split between the stages and the peak memory "
+        "to this path (not supported with --workers and --incremental)",
+    )
 
     args = parser.parse_args()
+    default_batch_size = 1_000_000 if args.batch_memory_mb is None else sys.maxsize
+    if args.changeset_batch_size is None:
+        args.changeset_batch_size = default_batch_size
+    if args.discussion_batch_size is None:
+        args.discussion_batch_size = default_batch_size
+    seek = args.since is not None or args.min_changeset_id is not None
+    if seek and (args.resume or args.incremental or (args.workers and args.workers > 1)):
+        parser.error("--since and --min-changeset-id can't be combined with --resume, --incremental or --workers")
+    if args.resume and (args.incremental or (args.workers and args.workers > 1)):
+        parser.error("--resume can't be combined with --incremental or --workers")
+    if args.resume and args.one_file_per_month:
+        parser.error("--resume can't be combined with --one-file-per-month")
+    if args.one_file_per_month and args.workers and args.workers > 1:
+        # every worker would write its own file of each month
+        parser.error("--one-file-per-month can't be combined with --workers")
+    if args.decompressor and args.decompression_workers:
+        parser.error("--decompressor can't be combined with --decompression-workers")
+    if args.changeset_path == STDIN_PATH and seek:
+        parser.error("--since and --min-changeset-id need a changeset file and not stdin")
+    if args.metrics_json and (args.incremental or (args.workers and args.workers > 1)):
+        parser.error("--metrics-json can't be combined with --incremental or --workers")
+
+    if args.incremental:
+        start_time = time.time()
+        applied_count = apply_replication_diffs(
+            args.changeset_path,
+            args.changeset_output_path,
+            args.discussion_output_path,
+            start_sequence=args.start_sequence,
+            sequences_per_update=args.sequences_per_update,
+            ignore_current_month=args.comments_ignore_current_month,
+            xml_backend=args.xml_backend,
+        )
+        elapsed_time = time.time() - start_time
+        print(
+            f"Applied {applied_count} replication diffs in {int(elapsed_time // 60)}:{int(elapsed_time % 60):02d} minutes"
+        )
+        return
 
     # Handle existing output directories
     changeset_output_path = Path(args.changeset_output_path)
     discussion_output_path = Path(args.discussion_output_path)
 
-    if changeset_output_path.exists():
+    if changeset_output_path.exists() and not (args.resume or seek):
         if args.overwrite:
             print(f"Removing existing changeset directory: {changeset_output_path}")
             shutil.rmtree(changeset_output_path)
         else:
             raise FileExistsError(
-                f"Changeset output directory '{changeset_output_path}' already exists. Use --overwrite to delete it or choose a different path."
+                f"Changeset output directory '{changeset_output_path}' already exists. Use --overwrite to delete it, --resume to continue an interrupted run or choose a different path."
             )
 
-    if discussion_output_path.exists():
+    if discussion_output_path.exists() and not (args.resume or seek):
         if args.overwrite:
             print(f"Removing existing discussion directory: {discussion_output_path}")
             shutil.rmtree(discussion_output_path)
         else:
             raise FileExistsError(
-                f"Discussion output directory '{discussion_output_path}' already exists. Use --overwrite to delete it or choose a different path."
+                f"Discussion output directory '{discussion_output_path}' already exists. Use --overwrite to delete it, --resume to continue an interrupted run or choose a different path."
             )
 
-    # Define schemas
-    changeset_schema_fields = [
-        pa.field("changeset_id", pa.int64()),
-        pa.field("year", pa.int16()),
-        pa.field("month", pa.int8()),
-        pa.field("edit_count", pa.int32()),
-        pa.field("user_name", pa.string()),
-        pa.field("bottom_left_lon", pa.float64()),
-        pa.field("bottom_left_lat", pa.float64()),
-        pa.field("top_right_lon", pa.float64()),
-        pa.field("top_right_lat", pa.float64()),
-        pa.field("tags", pa.map_(pa.string(), pa.string())),
-    ]
-
-    discussion_schema_fields = [
-        pa.field("changeset_id", pa.int64()),
-        pa.field("date", pa.timestamp("us", tz="UTC")),
-        pa.field("user_name", pa.string()),
-        pa.field("text", pa.string()),
-    ]
-
-    print(
-        f"Processing {args.changeset_path} with changeset batch size {args.changeset_batch_size} "
-        f"and discussion batch size {args.discussion_batch_size}..."
-    )
+    if args.batch_memory_mb is None:
+        print(
+            f"Processing {args.changeset_path} with changeset batch size {args.changeset_batch_size} "
+            f"and discussion batch size {args.discussion_batch_size}..."
+        )
+    else:
+        print(f"Processing {args.changeset_path} with batches of up to {args.batch_memory_mb} MB...")
     start_time = time.time()
 
-    changeset_parser = ChangesetParser(
-        changeset_batch_size=args.changeset_batch_size,
-        discussion_batch_size=args.discussion_batch_size,
-        changeset_output_path=args.changeset_output_path,
-        discussion_output_path=args.discussion_output_path,
-        changeset_schema=pa.schema(changeset_schema_fields),
-        discussion_schema=pa.schema(discussion_schema_fields),
-        ignore_current_month=args.comments_ignore_current_month,
-    )
-    changeset_parser.parse_file(args.changeset_path)
-    changeset_parser.finalize()
+    parser_kwargs = {
+        "changeset_batch_size": args.changeset_batch_size,
+        "discussion_batch_size": args.discussion_batch_size,
+        "changeset_output_path": args.changeset_output_path,
+        "discussion_output_path": args.discussion_output_path,
+        "changeset_schema": CHANGESET_SCHEMA,
+        "discussion_schema": DISCUSSION_SCHEMA,
+        "ignore_current_month": args.comments_ignore_current_month,
+        "xml_backend": args.xml_backend,
+        "writer_queue_size": args.writer_queue_size,
+        "one_file_per_month": args.one_file_per_month,
+        "row_group_size": args.row_group_size,
+        "batch_memory_mb": args.batch_memory_mb,
+    }
+    if args.workers and args.workers > 1:
+        changeset_count, discussion_count = parse_file_sharded(
+            args.changeset_path,
+            args.workers,
+            parser_kwargs,
+            decompression_workers=args.decompression_workers,
+            decompressor=args.decompressor,
+        )
+        print(
+            f"Finished processing with {args.workers} workers. Total: {changeset_count} changesets, {discussion_count} comments"
+        )
+    elif seek:
+        block_index_path = args.block_index or get_block_index_path(args.changeset_path)
+        if not Path(block_index_path).exists():
+            raise FileNotFoundError(
+                f"Block index '{block_index_path}' doesn't exist, create it with scripts/build_bz2_block_index.py"
+            )
+        parse_file_since(
+            args.changeset_path,
+            block_index_path,
+            parser_kwargs,
+            min_changeset_id=args.min_changeset_id,
+            since=args.since,
+            decompression_workers=args.decompression_workers,
+            metrics_path=args.metrics_json,
+        )
+    else:
+        # the files of --one-file-per-month stay open over many batches, so a checkpoint can't be resumed
+        checkpoint_path = None if args.one_file_per_month else changeset_output_path / CHECKPOINT_FILE
+        metrics = IngestMetrics() if args.metrics_json else None
+        changeset_parser = ChangesetParser(**parser_kwargs, checkpoint_path=checkpoint_path, metrics=metrics)
+        changeset_parser.parse_file(
+            args.changeset_path,
+            decompression_workers=args.decompression_workers,
+            resume=args.resume,
+            decompressor=args.decompressor,
+        )
+        changeset_parser.finalize()
+        if metrics is not None:
+            changeset_parser.write_metrics_report(args.metrics_json)
 
     elapsed_time = time.time() - start_time
     print(f"Processing completed in {int(elapsed_time // 60)}:{int(elapsed_time % 60):02d} minutes")
@@ -1,9 +1,55 @@
 import argparse
+import hashlib
 import json
+import multiprocessing
 import time
 from pathlib import Path
 
 import duckdb
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from build_user_dim import USER_DIM_FILE, get_user_dim_last_month
+from changeset_bridges import write_year_month_bridges
+from changeset_rollups import write_year_month_rollup
+from changeset_sketches import write_year_month_sketches
+from enrichment_manifest import (
+    MANIFEST_FILE,
+    get_input_checksums,
+    get_stale_columns,
+    partition_key,
+    read_manifest,
+    write_manifest,
+)
+from enum_codes import (
+    CODED_COLUMNS,
+    create_enum_types,
+    get_code_expression,
+    read_code_table,
+    update_code_table,
+    write_code_table,
+)
+from spatial_key import SPATIAL_KEY_ORDER_BY, get_spatial_key_sql
+
+ORGANISED_TEAMS_FILE = "config/organised_teams_contributors.json"
+CREATED_BY_RULES_FILE = "config/replace_rules_created_by.json"
+DEVICE_TYPES = ["desktop_editor", "mobile_editor", "tool"]
+IMAGERY_AND_SOURCE_RULES_FILE = "config/replace_rules_imagery_and_source.json"
+
+# the columns that are classified once per distinct created_by value instead of once per changeset
+CREATED_BY_LOOKUP_SCHEMA = pa.schema(
+    [
+        pa.field("raw_created_by", pa.string()),
+        pa.field("created_by", pa.string()),
+        pa.field("device_type", pa.string()),
+        pa.field("mobile_os", pa.string()),
+    ]
+)
+
+TOKEN_CACHE_SCHEMA = pa.schema([pa.field("raw_token", pa.string()), pa.field("token", pa.string())])
+RULES_HASH_METADATA_KEY = b"rules_sha256"
+# the columns of the LEFT JOINs without a match for every row, which change the order of the enriched rows
+JOIN_COLUMNS = ["organised_team", "for_profit", "user_id"]
 
 
 def sql_case_statement_from_rules(rules_file, column_name):
@@ -34,14 +80,14 @@ def sql_case_statement_from_rules(rules_file, column_name):
     return f"CASE\n{conditions_str}\nELSE {column_name}\nEND"
 
 
-def get_created_by_case_statement():
+def get_created_by_case_statement(column_name="main.tags['created_by']"):
     """Generate SQL CASE statement for created_by normalization."""
-    return sql_case_statement_from_rules("config/replace_rules_created_by.json", "main.tags['created_by']")
+    return sql_case_statement_from_rules(CREATED_BY_RULES_FILE, column_name)
 
 
 def get_device_type_case_statement():
     """Generate SQL CASE statement for device type classification."""
-    with Path("config/replace_rules_created_by.json").open(encoding="utf-8") as f:
+    with Path(CREATED_BY_RULES_FILE).open(encoding="utf-8") as f:
         rules = json.load(f)
 
     escape = lambda s: s.replace("'", "''")
@@ -50,29 +96,33 @@ def get_device_type_case_statement():
     for name, info in rules.items():
         if "type" in info:
             device_type = info["type"]
-            if device_type in ["desktop_editor", "mobile_editor", "tool"]:
+            if device_type in DEVICE_TYPES:
                 conditions.append(f"WHEN created_by = '{escape(name)}' THEN '{device_type}'")
 
     conditions_str = "\n".join(conditions)
     return f"CASE\n{conditions_str}\nELSE 'other'\nEND"
 
 
+def get_imagery_used_tokens_sql(column_name="main.tags['imagery_used']"):
+    # split on semicolon and clean URL encoding
+    return f"""
+    list_filter(
+        list_transform(
+            string_split(replace(replace({column_name}, '%20%', ' '), '%2c%', ','), ';'),
+            x -> trim(x)
+        ),
+        x -> x != ''
+    )
+    """
+
+
 def get_imagery_used_case_statement():
-    # split on semicolon, clean URL encoding and apply rules to each element
-    imagery_case_statement = sql_case_statement_from_rules("config/replace_rules_imagery_and_source.json", "x")
+    # apply rules to each element
+    imagery_case_statement = sql_case_statement_from_rules(IMAGERY_AND_SOURCE_RULES_FILE, "x")
     return f"""
     CASE 
         WHEN main.tags['imagery_used'] IS NOT NULL AND main.tags['imagery_used'] != '' 
-        THEN list_transform(
-            list_filter(
-                list_transform(
-                    string_split(replace(replace(main.tags['imagery_used'], '%20%', ' '), '%2c%', ','), ';'),
-                    x -> trim(x)
-                ),
-                x -> x != ''
-            ),
-            x -> {imagery_case_statement}
-        )
+        THEN list_transform({get_imagery_used_tokens_sql()}, x -> {imagery_case_statement})
         ELSE NULL
     END
     """
@@ -88,32 +138,40 @@ def get_hashtags_case_statement():
     """
 
 
+def get_source_tokens_sql(column_name="main.tags['source']"):
+    # split on multiple separators
+    return f"""
+    list_filter(
+        list_transform(
+            regexp_split_to_array({column_name}, ';| / | & |, |\\||\\+'),
+            x -> trim(x)
+        ),
+        x -> x != ''
+    )
+    """
+
+
 def get_source_case_statement():
-    # split on multiple separators and apply rules to each element
-    source_case_statement = sql_case_statement_from_rules("config/replace_rules_imagery_and_source.json", "x")
+    # apply rules to each element
+    source_case_statement = sql_case_statement_from_rules(IMAGERY_AND_SOURCE_RULES_FILE, "x")
     return f"""
     CASE 
         WHEN main.tags['source'] IS NOT NULL AND main.tags['source'] != '' 
-        THEN list_transform(
-            list_filter(
-                list_transform(
-                    regexp_split_to_array(main.tags['source'], ';| / | & |, |\\||\\+'),
-                    x -> trim(x)
-                ),
-                x -> x != ''
-            ),
-            x -> {source_case_statement}
-        )
+        THEN list_transform({get_source_tokens_sql()}, x -> {source_case_statement})
         ELSE NULL
     END
     """
 
 
-def get_mobile_os_case_statement():
-    return """
+# the tags that are split into tokens, which are normalized with the imagery and source rules
+TOKEN_COLUMNS = {"imagery_used": get_imagery_used_tokens_sql, "source": get_source_tokens_sql}
+
+
+def get_mobile_os_case_statement(column_name="main.tags['created_by']"):
+    return f"""
     CASE 
-        WHEN lower(main.tags['created_by']) LIKE '%android%' THEN 'Android'
-        WHEN lower(main.tags['created_by']) LIKE '%ios%' THEN 'iOS'
+        WHEN lower({column_name}) LIKE '%android%' THEN 'Android'
+        WHEN lower({column_name}) LIKE '%ios%' THEN 'iOS'
         ELSE NULL
     END
     """
@@ -134,7 +192,7 @@ def get_streetcomplete_quest_case_statement():
 
 def create_organised_team_lookup_table():
     """Create a temporary table for efficient organised team user mapping."""
-    with Path("config/organised_teams_contributors.json").open(encoding="utf-8") as f:
+    with Path(ORGANISED_TEAMS_FILE).open(encoding="utf-8") as f:
         team_data = json.load(f)
 
     # Build list of (user_name, team, for_profit) tuples
@@ -161,26 +219,304 @@ def create_organised_team_lookup_table():
     duckdb.sql(create_table_sql)
 
 
-def get_column_expressions():
-    """Get SQL expressions for all enrichment columns."""
+def create_user_lookup_table(user_dim_path):
+    """Create a temporary table with the user_id of every user name in the user dimension of build_user_dim.py."""
+    # with a NULL row every changeset has a match, see get_enriched_changesets_sql
+    duckdb.sql(f"""
+    CREATE OR REPLACE TEMPORARY TABLE user_lookup AS
+    SELECT user_name, user_id FROM read_parquet('{Path(user_dim_path) / USER_DIM_FILE}')
+    UNION ALL SELECT NULL, NULL;
+    """)
+
+
+def get_created_by_lookup_sql(values_sql):
+    """Generate SQL that classifies created_by values with the CASE statements of the rules.
+
+    values_sql is a query with the distinct raw values in a raw_created_by column. device_type refers
+    to the created_by column of the same SELECT, like it does in the enrichment of every changeset.
+    """
+    return f"""
+    SELECT
+        raw_created_by,
+        {get_created_by_case_statement("raw_created_by")} as created_by,
+        {get_device_type_case_statement()} as device_type,
+        {get_mobile_os_case_statement("raw_created_by")} as mobile_os
+    FROM ({values_sql})
+    """
+
+
+class TokenCache:
+    """Normalized names of the imagery_used and source tokens, so every token is classified with the rules once.
+
+    With a path the cache is read from and saved to a Parquet file together with the hash of the rules file,
+    so later runs only classify the tokens they haven't seen before. After a change of the rules the cache is rebuilt.
+    """
+
+    def __init__(self, path=None):
+        self.path = Path(path) if path is not None else None
+        self.rules_hash = hashlib.sha256(Path(IMAGERY_AND_SOURCE_RULES_FILE).read_bytes()).hexdigest()
+        # tokens are classified in a separate connection, so it can be used while DuckDB scans a stream of batches
+        self.connection = duckdb.connect()
+        self.tokens = TOKEN_CACHE_SCHEMA.empty_table()
+        self.new_tokens = []
+        self.new_token_count = 0
+        if self.path is not None and self.path.exists():
+            cached_tokens = pq.read_table(self.path)
+            if (cached_tokens.schema.metadata or {}).get(RULES_HASH_METADATA_KEY) == self.rules_hash.encode():
+                self.tokens = cached_tokens.cast(TOKEN_CACHE_SCHEMA)
+            else:
+                print(f"The rules changed since {self.path} was saved, rebuilding the token cache")
+
+    def add(self, tokens):
+        """Add classified tokens, e.g. of the cache of a worker process, that aren't in the cache yet"""
+        tokens = tokens.filter(
+            pc.invert(pc.is_in(tokens["raw_token"], value_set=self.tokens["raw_token"].combine_chunks()))
+        )
+        if tokens.num_rows > 0:
+            self.tokens = pa.concat_tables([self.tokens, tokens.cast(TOKEN_CACHE_SCHEMA)]).combine_chunks()
+            self.new_tokens.append(tokens)
+            self.new_token_count += tokens.num_rows
+
+    def pop_new_tokens(self):
+        """Return the tokens added since the last call"""
+        tokens = pa.concat_tables([TOKEN_CACHE_SCHEMA.empty_table(), *self.new_tokens])
+        self.new_tokens = []
+        return tokens
+
+    def classify(self, raw_tokens):
+        """Classify the raw tokens that aren't in the cache yet with the rules"""
+        raw_tokens = pc.unique(raw_tokens)
+        raw_tokens = raw_tokens.filter(
+            pc.invert(pc.is_in(raw_tokens, value_set=self.tokens["raw_token"].combine_chunks()))
+        )
+        if len(raw_tokens) == 0:
+            return
+        case_statement = sql_case_statement_from_rules(IMAGERY_AND_SOURCE_RULES_FILE, "raw_token")
+        self.connection.register("new_tokens", pa.table({"raw_token": raw_tokens}))
+        # arrow() returns a table in older DuckDB versions and a RecordBatchReader in newer ones
+        self.add(pa.table(self.connection.sql(f"SELECT raw_token, {case_statement} as token FROM new_tokens").arrow()))
+        self.connection.unregister("new_tokens")
+
+    def normalize(self, token_lists):
+        """Replace the raw tokens of a list array by their normalized names"""
+        raw_tokens = token_lists.flatten()
+        self.classify(raw_tokens)
+        indices = pc.index_in(raw_tokens, value_set=self.tokens["raw_token"].combine_chunks())
+        tokens = self.tokens["token"].take(indices).combine_chunks()
+        offsets = pc.subtract(token_lists.offsets, token_lists.offsets[0])
+        return type(token_lists).from_arrays(offsets, tokens, mask=token_lists.is_null())
+
+    def value_lookup(self, connection, values_sql, column):
+        """Map the distinct values of a tag to their normalized token lists.
+
+        values_sql is a query of the connection with the distinct values in a raw_value column,
+        NULL and empty values are mapped to NULL like in the enrichment.
+        """
+        tokens_sql = TOKEN_COLUMNS[column]("raw_value")
+        values_sql = (
+            f"SELECT raw_value, CASE WHEN raw_value != '' THEN {tokens_sql} END as raw_tokens FROM ({values_sql})"
+        )
+        values = pa.table(connection.sql(values_sql).arrow())
+        token_lists = self.normalize(values["raw_tokens"].combine_chunks())
+        return pa.table({"raw_value": values["raw_value"].cast(pa.string()), column: token_lists})
+
+    def save(self):
+        if self.path is None or self.new_token_count == 0:
+            return
+        temp_path = self.path.with_name(f"{self.path.name}.tmp")
+        pq.write_table(self.tokens.replace_schema_metadata({RULES_HASH_METADATA_KEY: self.rules_hash}), temp_path)
+        temp_path.replace(self.path)
+        print(f"Saved {self.new_token_count} new tokens to {self.path}")
+
+
+def create_lookup_tables(source_sql, where_sql="true", token_cache=None):
+    """Create the lookup tables that map the distinct created_by, imagery_used and source values of a source.
+
+    There are much fewer distinct values than changesets, so the long CASE statements of the rules are evaluated
+    once per value (or once per token with the token cache) and the enrichment only has to join the lookup tables.
+    """
+    if token_cache is None:
+        token_cache = TokenCache()
+    # scan the tags of the source once
+    duckdb.sql(f"""
+    CREATE OR REPLACE TEMPORARY TABLE lookup_tag_values AS
+    SELECT DISTINCT
+        main.tags['created_by'] as created_by, main.tags['imagery_used'] as imagery_used, main.tags['source'] as source
+    FROM {source_sql} main
+    WHERE {where_sql}
+    """)
+    created_by_values_sql = "SELECT DISTINCT created_by as raw_created_by FROM lookup_tag_values"
+    duckdb.sql(
+        f"CREATE OR REPLACE TEMPORARY TABLE created_by_lookup AS {get_created_by_lookup_sql(created_by_values_sql)}"
+    )
+    for column in TOKEN_COLUMNS:
+        values_sql = f"SELECT DISTINCT {column} as raw_value FROM lookup_tag_values"
+        duckdb.register(f"{column}_lookup", token_cache.value_lookup(duckdb, values_sql, column))
+    duckdb.sql("DROP TABLE lookup_tag_values")
+
+
+class RecordBatchNormalizer:
+    """Add the columns of the lookup tables to record batches, classifying every new value once.
+
+    A stream of batches can only be scanned once, so the lookups can't be created from its distinct values up front.
+    Instead the new created_by values of every batch are classified in a separate DuckDB connection and the lookup
+    grows, the imagery_used and source values are normalized with the token cache.
+    """
+
+    def __init__(self, token_cache=None):
+        self.token_cache = token_cache if token_cache is not None else TokenCache()
+        self.connection = duckdb.connect()
+        self.created_by_lookup = CREATED_BY_LOOKUP_SCHEMA.empty_table()
+
+    def get_schema(self, schema):
+        """Schema of the batches with the added columns"""
+        for name in CREATED_BY_LOOKUP_SCHEMA.names[1:]:
+            schema = schema.append(CREATED_BY_LOOKUP_SCHEMA.field(name))
+        for column in TOKEN_COLUMNS:
+            schema = schema.append(pa.field(column, pa.list_(pa.string())))
+        return schema
+
+    def _add_created_by_columns(self, batch):
+        raw_created_by = pc.map_lookup(batch.column("tags"), pa.scalar("created_by"), "first")
+        raw_values = self.created_by_lookup.column("raw_created_by").combine_chunks()
+        values = pc.unique(raw_created_by)
+        new_values = values.filter(pc.invert(pc.is_in(values, value_set=raw_values)))
+        if len(new_values) > 0:
+            self.connection.register("created_by_values", pa.table({"raw_created_by": new_values}))
+            lookup_sql = get_created_by_lookup_sql("SELECT raw_created_by FROM created_by_values")
+            # arrow() returns a table in older DuckDB versions and a RecordBatchReader in newer ones
+            new_lookup = pa.table(self.connection.sql(lookup_sql).arrow()).cast(CREATED_BY_LOOKUP_SCHEMA)
+            self.created_by_lookup = pa.concat_tables([self.created_by_lookup, new_lookup]).combine_chunks()
+            self.connection.unregister("created_by_values")
+            raw_values = self.created_by_lookup.column("raw_created_by").combine_chunks()
+
+        indices = pc.index_in(raw_created_by, value_set=raw_values, skip_nulls=False)
+        for name in CREATED_BY_LOOKUP_SCHEMA.names[1:]:
+            batch = batch.append_column(name, self.created_by_lookup.column(name).take(indices).combine_chunks())
+        return batch
+
+    def add_columns(self, batch):
+        batch = self._add_created_by_columns(batch)
+        for column in TOKEN_COLUMNS:
+            raw_values = pc.map_lookup(batch.column("tags"), pa.scalar(column), "first")
+            self.connection.register("tag_values", pa.table({"raw_value": pc.unique(raw_values)}))
+            lookup = self.token_cache.value_lookup(self.connection, "SELECT raw_value FROM tag_values", column)
+            self.connection.unregister("tag_values")
+            indices = pc.index_in(raw_values, value_set=lookup["raw_value"].combine_chunks(), skip_nulls=False)
+            batch = batch.append_column(column, lookup[column].take(indices).combine_chunks())
+        return batch
+
+
+def get_lookup_expressions(relation=None):
+    """Get the SQL expressions of the columns that are taken from the lookup tables.
+
+    With relation, the columns are taken from that relation instead, e.g. the batches of a RecordBatchNormalizer.
+    """
+    created_by_relation = relation or "created_by_lookup"
+    return {
+        "created_by": f"{created_by_relation}.created_by",
+        "device_type": f"{created_by_relation}.device_type",
+        "imagery_used": f"{relation or 'imagery_used_lookup'}.imagery_used",
+        "source": f"{relation or 'source_lookup'}.source",
+        "mobile_os": f"{created_by_relation}.mobile_os",
+    }
+
+
+def get_column_expressions(user_id=False, enum_codes=False, spatial_key=False):
+    """Get SQL expressions for all enrichment columns.
+
+    With user_id, the user_id column is taken from the table of create_user_lookup_table.
+    With enum_codes, the CODED_COLUMNS are integer codes of the ENUM types of create_code_types.
+    With spatial_key, the Morton key of the bbox centre of get_spatial_key_sql is added after mid_pos_y.
+    """
     expressions = {}
     expressions["mid_pos_x"] = "CAST(ROUND(((main.bottom_left_lon + main.top_right_lon) / 2 + 180) % 360) AS INTEGER)"
     expressions["mid_pos_y"] = "CAST(ROUND(((main.bottom_left_lat + main.top_right_lat) / 2 + 90) % 180) AS INTEGER)"
+    if spatial_key:
+        expressions["spatial_key"] = get_spatial_key_sql(
+            "(main.bottom_left_lon + main.top_right_lon) / 2", "(main.bottom_left_lat + main.top_right_lat) / 2"
+        )
     expressions["bot"] = "COALESCE(main.tags['bot'] = 'yes', false)"
-    expressions["created_by"] = get_created_by_case_statement()
-    expressions["device_type"] = get_device_type_case_statement()
-    expressions["imagery_used"] = get_imagery_used_case_statement()
+    lookup_expressions = get_lookup_expressions()
+    expressions["created_by"] = lookup_expressions["created_by"]
+    expressions["device_type"] = lookup_expressions["device_type"]
+    expressions["imagery_used"] = lookup_expressions["imagery_used"]
     expressions["hashtags"] = get_hashtags_case_statement()
-    expressions["source"] = get_source_case_statement()
-    expressions["mobile_os"] = get_mobile_os_case_statement()
+    expressions["source"] = lookup_expressions["source"]
+    expressions["mobile_os"] = lookup_expressions["mobile_os"]
     expressions["streetcomplete_quest"] = get_streetcomplete_quest_case_statement()
     # split each tag name on ':' and take the first part
     expressions["all_tags"] = "array_distinct(list_transform(map_keys(main.tags), x -> split_part(x, ':', 1)))"
     expressions["organised_team"] = "team_lookup.team"
     expressions["for_profit"] = "team_lookup.for_profit"
+    if user_id:
+        expressions["user_id"] = "user_lookup.user_id"
+    if enum_codes:
+        for column in CODED_COLUMNS:
+            expressions[column] = get_code_expression(column, expressions[column])
     return expressions
 
 
+def get_code_values(source_sql, where_sql="true"):
+    """Get the values of the coded columns, first the ones of the rules files and then the ones of the source.
+
+    Only created_by (of the editors without a rule) and streetcomplete_quest have values that aren't in the rules.
+    """
+    created_by_rules = json.loads(Path(CREATED_BY_RULES_FILE).read_text(encoding="utf-8"))
+    organised_teams = json.loads(Path(ORGANISED_TEAMS_FILE).read_text(encoding="utf-8"))
+    created_by_values = duckdb.sql(f"""
+        SELECT DISTINCT {get_created_by_case_statement("raw_created_by")} as created_by
+        FROM (SELECT DISTINCT main.tags['created_by'] as raw_created_by FROM {source_sql} main WHERE {where_sql})
+        ORDER BY created_by
+    """).fetchall()
+    streetcomplete_quest_values = duckdb.sql(f"""
+        SELECT DISTINCT {get_streetcomplete_quest_case_statement()} as streetcomplete_quest
+        FROM {source_sql} main
+        WHERE {where_sql}
+        ORDER BY streetcomplete_quest
+    """).fetchall()
+    return {
+        "created_by": list(created_by_rules) + [value for (value,) in created_by_values],
+        "device_type": [*DEVICE_TYPES, "other"],
+        "mobile_os": ["Android", "iOS"],
+        "streetcomplete_quest": [value for (value,) in streetcomplete_quest_values],
+        "organised_team": list(organised_teams),
+    }
+
+
+def create_code_types(input_path, year_months, code_table_path):
+    """Give every value of the coded columns of the year-months a code and create their ENUM types.
+
+    The code table in code_table_path is only appended to, so the codes of existing values never change.
+    """
+    source_sql = f"'{input_path}/year=*/month=*/*.parquet'"
+    where_sql = " OR ".join(f"(main.year = {year} AND main.month = {month})" for year, month in year_months)
+    code_table = update_code_table(read_code_table(code_table_path), get_code_values(source_sql, where_sql or "false"))
+    write_code_table(code_table_path, code_table)
+    create_enum_types(code_table)
+
+
+def get_column_hashes(expressions):
+    """Hash the SQL and the rules that every enrichment column is computed with, to find the stale columns."""
+    created_by_statement = get_created_by_case_statement("raw_created_by")
+    token_statement = sql_case_statement_from_rules(IMAGERY_AND_SOURCE_RULES_FILE, "raw_token")
+    organised_teams = Path(ORGANISED_TEAMS_FILE).read_text(encoding="utf-8")
+    # the columns of the lookup tables and the team lookup don't contain the rules in their expression
+    dependencies = {
+        "created_by": [created_by_statement],
+        "device_type": [created_by_statement, get_device_type_case_statement()],
+        "mobile_os": [get_mobile_os_case_statement("raw_created_by")],
+        "organised_team": [organised_teams],
+        "for_profit": [organised_teams],
+    }
+    for column, get_tokens_sql in TOKEN_COLUMNS.items():
+        dependencies[column] = [get_tokens_sql("raw_value"), token_statement]
+    return {
+        name: hashlib.sha256("\n".join([expression, *dependencies.get(name, [])]).encode()).hexdigest()
+        for name, expression in expressions.items()
+    }
+
+
 def get_column_sql(expressions):
     base_columns = ["main.changeset_id", "main.edit_count", "main.user_name", "main.month", "main.year"]
     enriched_columns = [f"{expr} as {name}" for name, expr in expressions.items()]
@@ -228,19 +564,36 @@ def get_last_year_month(input_path, offset=0):
     return (result[0], result[1]) if result else None
 
 
-def enrich_table_year_month(input_path, output_path, year, month, expressions):
-    """Enrich parquet table with additional columns for a specific year-month."""
-    print(f"Processing year-month: {year}-{month:02d}")
-    sql_query = f"""
-    COPY (
+def get_enriched_changesets_sql(source_sql, expressions, where_sql="true", join_lookup_tables=True, order_by=None):
+    """Generate the SQL query of the enriched changesets of a DuckDB source.
+
+    With join_lookup_tables the tables of create_lookup_tables have to exist for the source.
+    The table of create_user_lookup_table is joined if the user_id column is computed.
+    With order_by, the enriched changesets are sorted by it.
+    """
+    lookup_joins = ""
+    if join_lookup_tables:
+        # the lookups also contain NULL, a LEFT JOIN returns the rows without a match after the matched rows
+        # of a chunk, so with a match for every row the joins keep the insertion order
+        lookup_joins = """
+        LEFT JOIN created_by_lookup ON main.tags['created_by'] IS NOT DISTINCT FROM created_by_lookup.raw_created_by
+        LEFT JOIN imagery_used_lookup ON main.tags['imagery_used'] IS NOT DISTINCT FROM imagery_used_lookup.raw_value
+        LEFT JOIN source_lookup ON main.tags['source'] IS NOT DISTINCT FROM source_lookup.raw_value
+        """
+    if "user_id" in expressions:
+        lookup_joins += "LEFT JOIN user_lookup ON main.user_name IS NOT DISTINCT FROM user_lookup.user_name"
+    return f"""
         SELECT
             {get_column_sql(expressions)}
-        FROM '{input_path}/year=*/month=*/*.parquet' main
+        FROM {source_sql} main
         LEFT JOIN organised_team_lookup team_lookup ON main.user_name = team_lookup.user_name
-        WHERE main.year = {year} AND main.month = {month}
-    ) TO '{output_path}'
-    (FORMAT PARQUET, PARTITION_BY (year, month), OVERWRITE_OR_IGNORE true);
+        {lookup_joins}
+        WHERE {where_sql}
+        {f"ORDER BY {order_by}" if order_by else ""}
     """
+
+
+def run_single_threaded(sql_query):
     # Use single thread to create exactly 1 file per partition and preserve insertion order to create the row order for different runs
     duckdb.sql("SET preserve_insertion_order = true")
     duckdb.sql("SET threads = 1")
@@ -249,6 +602,255 @@ def enrich_table_year_month(input_path, output_path, year, month, expressions):
     duckdb.sql("SET threads TO DEFAULT")
 
 
+def copy_enriched_changesets(
+    source_sql, output_path, expressions, where_sql="true", join_lookup_tables=True, order_by=None
+):
+    """Enrich the raw changesets of a DuckDB source (a Parquet glob or a registered Arrow table) and write them."""
+    enriched_sql = get_enriched_changesets_sql(source_sql, expressions, where_sql, join_lookup_tables, order_by)
+    run_single_threaded(f"""
+    COPY ({enriched_sql}) TO '{output_path}'
+    (FORMAT PARQUET, PARTITION_BY (year, month), OVERWRITE_OR_IGNORE true);
+    """)
+
+
+def enrich_table_year_month(input_path, output_path, year, month, expressions, token_cache=None, order_by=None):
+    """Enrich parquet table with additional columns for a specific year-month.
+
+    With order_by, e.g. SPATIAL_KEY_ORDER_BY, the enriched changesets of the year-month are sorted by it.
+    """
+    print(f"Processing year-month: {year}-{month:02d}")
+    source_sql = f"'{input_path}/year=*/month=*/*.parquet'"
+    where_sql = f"main.year = {year} AND main.month = {month}"
+    create_lookup_tables(source_sql, where_sql, token_cache)
+    copy_enriched_changesets(source_sql, output_path, expressions, where_sql, order_by=order_by)
+
+
+def rewrite_columns_year_month(input_path, output_path, year, month, expressions, columns, token_cache=None):
+    """Compute only some columns of an enriched year-month again and keep its other columns.
+
+    The input of the year-month must not have changed since it was enriched. The computed columns are joined by
+    changeset_id, as the LEFT JOINs of JOIN_COLUMNS don't keep the order of the raw rows, and the rows stay in the
+    order of the enriched file.
+    """
+    print(f"Rewriting the columns {', '.join(columns)} of year-month: {year}-{month:02d}")
+    (output_file,) = (Path(output_path) / partition_key(year, month)).glob("*.parquet")
+    source_sql = f"'{input_path}/year=*/month=*/*.parquet'"
+    where_sql = f"main.year = {year} AND main.month = {month}"
+    if set(columns) & set(get_lookup_expressions()):
+        create_lookup_tables(source_sql, where_sql, token_cache)
+    computed_sql = get_enriched_changesets_sql(source_sql, {name: expressions[name] for name in columns}, where_sql)
+    column_sql = ["enriched.changeset_id", "enriched.edit_count", "enriched.user_name"]
+    column_sql += [f"{'computed' if name in columns else 'enriched'}.{name} as {name}" for name in expressions]
+    temp_file = output_file.with_name(f"{output_file.name}.tmp")
+    run_single_threaded(f"""
+    COPY (
+        SELECT {", ".join(column_sql)}
+        FROM read_parquet('{output_file}', hive_partitioning = false, file_row_number = true) enriched
+        LEFT JOIN ({computed_sql}) computed ON enriched.changeset_id = computed.changeset_id
+        ORDER BY enriched.file_row_number
+    ) TO '{temp_file}' (FORMAT PARQUET);
+    """)
+    temp_file.replace(output_file)
+
+
+def enrich_record_batches(record_batch_reader, output_path, expressions, token_cache=None):
+    """Enrich raw changesets from a pyarrow RecordBatchReader, e.g. straight from the parser, and write them.
+
+    DuckDB scans the batches while they are produced, so the raw changesets are never written to disk.
+    The columns of the lookup tables are added to the batches by a RecordBatchNormalizer instead of joining them.
+    """
+    normalizer = RecordBatchNormalizer(token_cache)
+    schema = normalizer.get_schema(record_batch_reader.schema)
+    batches = (normalizer.add_columns(batch) for batch in record_batch_reader)
+    expressions = {**expressions, **get_lookup_expressions("main")}
+    duckdb.register("raw_changeset_batches", pa.RecordBatchReader.from_batches(schema, batches))
+    try:
+        copy_enriched_changesets("raw_changeset_batches", output_path, expressions, join_lookup_tables=False)
+    finally:
+        duckdb.unregister("raw_changeset_batches")
+
+
+def get_year_month_input_sizes(input_path, year_months):
+    """Size of the raw Parquet files of every year-month, to estimate how long their enrichment takes."""
+    sizes = {}
+    for year, month in year_months:
+        partition_dir = Path(input_path) / f"year={year}" / f"month={month}"
+        sizes[(year, month)] = sum(file_path.stat().st_size for file_path in partition_dir.glob("*.parquet"))
+    return sizes
+
+
+_worker_expressions = None
+_worker_token_cache = None
+
+
+def _init_enrich_worker(expressions, tokens, user_dim_path, code_table_path):
+    global _worker_expressions, _worker_token_cache
+    create_organised_team_lookup_table()
+    if "user_id" in expressions:
+        create_user_lookup_table(user_dim_path)
+    if code_table_path is not None:
+        create_enum_types(read_code_table(code_table_path))
+    _worker_expressions = expressions
+    _worker_token_cache = TokenCache()
+    _worker_token_cache.add(tokens)
+    _worker_token_cache.pop_new_tokens()
+
+
+def _enrich_year_month_worker(task):
+    input_path, output_path, year, month, order_by = task
+    enrich_table_year_month(input_path, output_path, year, month, _worker_expressions, _worker_token_cache, order_by)
+    # the tokens classified by this worker are added to the cache of the main process
+    return year, month, _worker_token_cache.pop_new_tokens()
+
+
+def enrich_year_months_parallel(
+    input_path,
+    output_path,
+    year_months,
+    expressions,
+    jobs,
+    token_cache=None,
+    enriched_callback=None,
+    user_dim_path=None,
+    code_table_path=None,
+    order_by=None,
+):
+    """Enrich the year-months with the expressions in parallel worker processes, starting with the largest ones.
+
+    The expressions are sent to the workers, which only create the lookup tables they join. Every year-month
+    is still enriched by a single threaded DuckDB query into its own partition, so the output files are
+    byte-identical to enriching them one after another.
+    The workers start with the tokens of token_cache and the tokens they classify are added to it.
+    enriched_callback(year, month) is called once a year-month is done. The workers create the user lookup of
+    user_dim_path if the expressions have the user_id column, and the ENUM types of the code table of
+    code_table_path, which has to contain the values of the year-months already.
+    """
+    if token_cache is None:
+        token_cache = TokenCache()
+    sizes = get_year_month_input_sizes(input_path, year_months)
+    year_months = sorted(year_months, key=lambda year_month: sizes[year_month], reverse=True)
+    # create the partition directories up front, so the workers don't race creating the same year directory
+    for year, month in year_months:
+        (Path(output_path) / f"year={year}" / f"month={month}").mkdir(parents=True, exist_ok=True)
+
+    tasks = [(input_path, output_path, year, month, order_by) for year, month in year_months]
+    # spawn instead of fork, the DuckDB connection of this process must not be shared with the workers
+    with multiprocessing.get_context("spawn").Pool(
+        jobs,
+        initializer=_init_enrich_worker,
+        initargs=(expressions, token_cache.tokens, user_dim_path, code_table_path),
+    ) as pool:
+        for year, month, new_tokens in pool.imap_unordered(_enrich_year_month_worker, tasks):
+            token_cache.add(new_tokens)
+            if enriched_callback is not None:
+                enriched_callback(year, month)
+
+
+def enrich_year_months(
+    input_path,
+    output_path,
+    year_months,
+    expressions,
+    token_cache=None,
+    jobs=1,
+    only_stale=False,
+    user_dim_path=None,
+    rollup_path=None,
+    sketch_path=None,
+    bridge_path=None,
+    code_table_path=None,
+    sort_by_spatial_key=False,
+):
+    """Enrich the year-months and record their input checksums and column hashes in the manifest.
+
+    With only_stale, the year-months whose input and columns are unchanged since the manifest was written are
+    skipped, and of the year-months with unchanged input only the stale columns are computed again. If one of the
+    JOIN_COLUMNS is stale, the order of the rows changes as well and the year-month is enriched again.
+    With rollup_path, sketch_path and bridge_path, the rollup, the sketches and the bridge tables of every enriched
+    or rewritten year-month are written there as well, the bridge tables need the user_id column.
+    With code_table_path, the values of the coded columns of the year-months get their codes before the
+    enrichment, expressions has to be created with enum_codes then.
+    user_dim_path is only used by the parallel workers, which create their own lookup tables.
+    With sort_by_spatial_key, expressions has to be created with spatial_key, and the changesets of every
+    year-month are sorted by SPATIAL_KEY_ORDER_BY, so the row group statistics let bounding box filters skip row
+    groups. A change of the layout or a stale spatial_key column changes the order, so the year-month is enriched
+    again, the other stale columns are rewritten in the sorted order.
+    Returns the enriched year-months and a dict of the year-months with rewritten columns to these columns.
+    """
+    if sort_by_spatial_key and "spatial_key" not in expressions:
+        raise ValueError("Sorting by spatial_key needs the spatial_key column, see get_column_expressions")
+    manifest_path = Path(output_path) / MANIFEST_FILE
+    manifest = read_manifest(manifest_path)
+    column_hashes = get_column_hashes(expressions)
+    order_by = SPATIAL_KEY_ORDER_BY if sort_by_spatial_key else None
+
+    def record_year_month(year, month):
+        key = partition_key(year, month)
+        previous_checksums = manifest["partitions"].get(key, {}).get("input_files")
+        manifest["partitions"][key] = {
+            "input_files": get_input_checksums(Path(input_path) / key, previous_checksums),
+            "columns": column_hashes,
+        }
+        if order_by is not None:
+            manifest["partitions"][key]["order_by"] = order_by
+        write_manifest(manifest_path, manifest)
+        if rollup_path is not None:
+            write_year_month_rollup(output_path, rollup_path, year, month, code_table_path)
+        if sketch_path is not None:
+            write_year_month_sketches(output_path, sketch_path, year, month, code_table_path)
+        if bridge_path is not None:
+            write_year_month_bridges(output_path, bridge_path, year, month)
+
+    enrich_year_month_list = list(year_months)
+    rewrite_columns = {}
+    if only_stale:
+        enrich_year_month_list = []
+        for year, month in year_months:
+            key = partition_key(year, month)
+            partition = manifest["partitions"].get(key)
+            input_checksums = get_input_checksums(Path(input_path) / key, partition and partition["input_files"])
+            stale_columns = get_stale_columns(partition, input_checksums, column_hashes)
+            if (
+                stale_columns is None
+                or set(stale_columns) & set(JOIN_COLUMNS)
+                or partition.get("order_by") != order_by
+                or (order_by is not None and "spatial_key" in stale_columns)
+                or len(list((Path(output_path) / key).glob("*.parquet"))) != 1
+            ):
+                enrich_year_month_list.append((year, month))
+            elif stale_columns:
+                rewrite_columns[(year, month)] = stale_columns
+        up_to_date_count = len(year_months) - len(enrich_year_month_list) - len(rewrite_columns)
+        print(
+            f"{len(enrich_year_month_list)} year-months are enriched again, {len(rewrite_columns)} have stale columns "
+            f"and {up_to_date_count} are up to date"
+        )
+
+    if code_table_path is not None:
+        create_code_types(input_path, enrich_year_month_list + list(rewrite_columns), code_table_path)
+    if jobs > 1 and len(enrich_year_month_list) > 1:
+        enrich_year_months_parallel(
+            input_path,
+            output_path,
+            enrich_year_month_list,
+            expressions,
+            jobs,
+            token_cache,
+            enriched_callback=record_year_month,
+            user_dim_path=user_dim_path,
+            code_table_path=code_table_path,
+            order_by=order_by,
+        )
+    else:
+        for year, month in enrich_year_month_list:
+            enrich_table_year_month(input_path, output_path, year, month, expressions, token_cache, order_by)
+            record_year_month(year, month)
+    for (year, month), columns in rewrite_columns.items():
+        rewrite_columns_year_month(input_path, output_path, year, month, expressions, columns, token_cache)
+        record_year_month(year, month)
+    return enrich_year_month_list, rewrite_columns
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Enrich OSM changeset parquet tables. Can process specific year-month, all months in a year, or all available data."
@@ -266,12 +868,89 @@ def main():
         action="store_true",
         help="Process only the last complete month (skips the most recent potentially incomplete month)",
     )
+    parser.add_argument(
+        "--complete-months",
+        action="store_true",
+        help="Process all available months except the most recent potentially incomplete month",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Enrich this many year-months in parallel worker processes, the largest first (default: 1)",
+    )
+    parser.add_argument(
+        "--token-cache",
+        default=None,
+        help="Parquet file that caches the normalized imagery_used and source tokens between runs, "
+        "so only new tokens are classified with the rules (default: no cache)",
+    )
+    parser.add_argument(
+        "--only-stale",
+        action="store_true",
+        help=f"Skip the year-months that didn't change since they were recorded in {MANIFEST_FILE} of the output, "
+        "and only compute the columns whose SQL or rules changed if the input of a year-month is unchanged",
+    )
+    parser.add_argument(
+        "--user-dim",
+        default=None,
+        help="Add the user_id column from this user dimension directory of build_user_dim.py, which has to "
+        "contain the activity of the enriched year-months (default: no user_id column)",
+    )
+    parser.add_argument(
+        "--rollup-path",
+        default=None,
+        help="Also write the monthly rollup at (year, month, dimension, value) grain of every enriched year-month "
+        "to this directory (default: no rollups)",
+    )
+    parser.add_argument(
+        "--sketch-path",
+        default=None,
+        help="Also write the HyperLogLog contributor sketches and the top-K created_by and hashtags sketches "
+        "of every enriched year-month to this directory (default: no sketches)",
+    )
+    parser.add_argument(
+        "--bridge-path",
+        default=None,
+        help="Also write the bridge tables of all_tags, hashtags, imagery_used and source with one row per "
+        "changeset and value, sorted by value, to this directory, needs --user-dim (default: no bridge tables)",
+    )
+    parser.add_argument(
+        "--code-table",
+        default=None,
+        help="Write created_by, device_type, mobile_os, streetcomplete_quest and organised_team as integer codes "
+        "of the code table in this directory, which only gets codes for new values appended, the rollups and "
+        "sketches keep the values (default: strings)",
+    )
+    parser.add_argument(
+        "--spatial-key",
+        action="store_true",
+        help="Add the spatial_key column, the Morton key of the bbox centre, enrich all months with it so that "
+        "every month has the column (default: no spatial_key)",
+    )
+    parser.add_argument(
+        "--sort-by-spatial-key",
+        action="store_true",
+        help="Sort the changesets of every year-month by the Morton key of their bbox centre instead of keeping "
+        "the input order, so bounding box filters on spatial_key skip most row groups (default: input order)",
+    )
     args = parser.parse_args()
+    if args.last_complete_month and args.complete_months:
+        parser.error("--last-complete-month can't be combined with --complete-months")
+    if args.bridge_path and not args.user_dim:
+        parser.error("--bridge-path needs --user-dim")
+    if args.sort_by_spatial_key and not args.spatial_key:
+        parser.error("--sort-by-spatial-key needs --spatial-key")
 
     start_time = time.time()
     print("Creating organised team lookup table for efficient organised team mapping")
     create_organised_team_lookup_table()
-    expressions = get_column_expressions()
+    if args.user_dim:
+        create_user_lookup_table(args.user_dim)
+    expressions = get_column_expressions(
+        user_id=args.user_dim is not None, enum_codes=args.code_table is not None, spatial_key=args.spatial_key
+    )
+    token_cache = TokenCache(args.token_cache)
     print(f"Adding columns: {', '.join(expressions.keys())}")
 
     # Determine which year-month combinations to process
@@ -279,6 +958,9 @@ def main():
         # Process the second-to-last month (skip the most recent incomplete month)
         last_ym = get_last_year_month(args.input_path, offset=1)
         year_months = [last_ym]
+    elif args.complete_months:
+        year_months = get_all_available_year_months(args.input_path)[:-1]
+        print(f"Processing all complete months: {len(year_months)} year-month combinations")
     elif args.year is None:
         year_months = get_all_available_year_months(args.input_path)
         print(f"Processing all available data: {len(year_months)} year-month combinations")
@@ -289,8 +971,31 @@ def main():
     else:
         year_months = [(args.year, args.month)]
 
-    for year, month in year_months:
-        enrich_table_year_month(args.input_path, args.output_path, year, month, expressions)
+    if args.user_dim:
+        # a user without a user_id would change the order of the enriched rows, see create_user_lookup_table
+        user_dim_last_month = get_user_dim_last_month(args.user_dim)
+        if year_months and (user_dim_last_month is None or max(year_months) > user_dim_last_month):
+            parser.error(
+                f"The user dimension {args.user_dim} doesn't contain the activity of all enriched year-months, "
+                "update it with build_user_dim.py first"
+            )
+
+    enrich_year_months(
+        args.input_path,
+        args.output_path,
+        year_months,
+        expressions,
+        token_cache,
+        jobs=args.jobs,
+        only_stale=args.only_stale,
+        user_dim_path=args.user_dim,
+        rollup_path=args.rollup_path,
+        sketch_path=args.sketch_path,
+        bridge_path=args.bridge_path,
+        code_table_path=args.code_table,
+        sort_by_spatial_key=args.sort_by_spatial_key,
+    )
+    token_cache.save()
 
     elapsed_time = time.time() - start_time
     print(f"Enrichment completed successfully in {int(elapsed_time // 60)}:{int(elapsed_time % 60):02d} minutes")
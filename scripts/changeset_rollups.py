@@ -0,0 +1,75 @@
+from pathlib import Path
+
+import duckdb
+from enrichment_manifest import partition_key
+from enum_codes import get_decoded_changesets_sql
+
+ROLLUP_FILE = "rollup.parquet"
+# enriched columns with one value per changeset
+ROLLUP_DIMENSIONS = [
+    "created_by",
+    "device_type",
+    "mobile_os",
+    "organised_team",
+    "for_profit",
+    "bot",
+    "streetcomplete_quest",
+]
+# enriched list columns, a changeset is counted once for every distinct value of its list
+ROLLUP_LIST_DIMENSIONS = ["imagery_used", "hashtags", "source", "all_tags"]
+
+
+def get_rollup_sql(changesets_sql):
+    """Generate the SQL query of the rollup of one enriched year-month at (dimension, value) grain.
+
+    Every row has the changesets, edits and distinct contributors of a value of a dimension, the row of the
+    dimension "total" has the totals of the month. The contributors of different months or values can't be summed.
+    """
+    aggregates_sql = (
+        "count(*)::BIGINT as changesets, sum(edit_count)::BIGINT as edits, "
+        "count(DISTINCT user_name)::BIGINT as contributors"
+    )
+    selects = [f"SELECT 'total' as dimension, NULL::VARCHAR as value, {aggregates_sql} FROM changesets"]
+    selects += [
+        f"SELECT '{dimension}', {dimension}::VARCHAR, {aggregates_sql} FROM changesets GROUP BY {dimension}"
+        for dimension in ROLLUP_DIMENSIONS
+    ]
+    selects += [
+        f"SELECT '{dimension}', value, {aggregates_sql} "
+        f"FROM (SELECT unnest(list_distinct({dimension})) as value, edit_count, user_name FROM changesets) "
+        "GROUP BY value"
+        for dimension in ROLLUP_LIST_DIMENSIONS
+    ]
+    return f"""
+        WITH changesets AS (SELECT * FROM {changesets_sql})
+        SELECT * FROM ({" UNION ALL ".join(selects)})
+        ORDER BY dimension, value NULLS FIRST
+    """
+
+
+def write_year_month_rollup(enriched_path, rollup_path, year, month, code_table_path=None):
+    """Write the rollup of an enriched year-month to rollup_path, replacing the previous rollup of the year-month.
+
+    The rollups are partitioned like the enriched changesets, so year and month are the hive partition columns.
+    With code_table_path, the coded columns are decoded, so the rollup has the same values as without codes.
+    """
+    partition_dir = Path(enriched_path) / partition_key(year, month)
+    changesets_sql = get_decoded_changesets_sql(
+        f"read_parquet('{partition_dir}/*.parquet', hive_partitioning = false)", code_table_path
+    )
+    rollup_file = Path(rollup_path) / partition_key(year, month) / ROLLUP_FILE
+    rollup_file.parent.mkdir(parents=True, exist_ok=True)
+    temp_file = rollup_file.with_name(f"{rollup_file.name}.tmp")
+    duckdb.sql(f"COPY ({get_rollup_sql(changesets_sql)}) TO '{temp_file}' (FORMAT PARQUET)")
+    temp_file.replace(rollup_file)
+
+
+def write_rollups(enriched_path, rollup_path, year_months=None, code_table_path=None):
+    """Write the rollups of the given year-months, of all enriched year-months if year_months is None"""
+    if year_months is None:
+        year_months = sorted(
+            (int(month_dir.parent.name.split("=")[1]), int(month_dir.name.split("=")[1]))
+            for month_dir in Path(enriched_path).glob("year=*/month=*")
+        )
+    for year, month in year_months:
+        write_year_month_rollup(enriched_path, rollup_path, year, month, code_table_path)
@@ -0,0 +1,199 @@
+from pathlib import Path
+
+import duckdb
+import numpy as np
+from changeset_rollups import ROLLUP_DIMENSIONS, ROLLUP_LIST_DIMENSIONS
+from enrichment_manifest import partition_key
+from enum_codes import get_decoded_changesets_sql
+
+SKETCH_FILE = "sketch.parquet"
+CONTRIBUTORS_HLL_DIR = "contributors_hll"
+TOP_K_DIR = "top_k"
+
+# 2^12 registers, the estimate has a relative standard error of 1.04 / sqrt(4096), so about 1.6 %
+HLL_PRECISION = 12
+HLL_REGISTER_COUNT = 1 << HLL_PRECISION
+HLL_RELATIVE_ERROR = 1.04 / HLL_REGISTER_COUNT**0.5
+HLL_ALPHA = 0.7213 / (1 + 1.079 / HLL_REGISTER_COUNT)
+TOP_K_DIMENSIONS = ["created_by", "hashtags"]
+TOP_K = 100
+
+
+def get_user_hash_sql(column_name="user_name"):
+    # the first 64 bits of the md5, unlike hash() it doesn't change between DuckDB versions
+    return f"('0x' || md5({column_name})[1:16])::UBIGINT"
+
+
+def get_hll_sql(changesets_sql):
+    """Generate the SQL query of the sparse HyperLogLog sketches of the contributors of one enriched year-month.
+
+    There is a sketch for every value of the rollup dimensions (and the dimension "total"), it only contains the
+    registers that aren't 0: the first HLL_PRECISION bits of the hash select the register in register_index,
+    register_rank is the position of the first 1 bit in the lower 32 bits of the hash.
+    """
+    user_values = ["SELECT 'total' as dimension, NULL::VARCHAR as value, user_name FROM changesets"]
+    user_values += [
+        f"SELECT '{dimension}', {dimension}::VARCHAR, user_name FROM changesets" for dimension in ROLLUP_DIMENSIONS
+    ]
+    user_values += [
+        f"SELECT '{dimension}', unnest(list_distinct({dimension})), user_name FROM changesets"
+        for dimension in ROLLUP_LIST_DIMENSIONS
+    ]
+    return f"""
+        WITH changesets AS (SELECT * FROM {changesets_sql}),
+        user_hashes AS (
+            SELECT DISTINCT dimension, value, {get_user_hash_sql()} as user_hash
+            FROM ({" UNION ALL ".join(user_values)})
+            WHERE user_name IS NOT NULL
+        ),
+        registers AS (
+            SELECT dimension, value, (user_hash >> {64 - HLL_PRECISION})::USMALLINT as register_index,
+                max(CASE WHEN user_hash & 4294967295 = 0 THEN 33
+                    ELSE 32 - floor(log2((user_hash & 4294967295)::DOUBLE))::INTEGER END)::UTINYINT as register_rank
+            FROM user_hashes
+            GROUP BY ALL
+        )
+        SELECT dimension, value, list(register_index ORDER BY register_index) as register_index,
+            list(register_rank ORDER BY register_index) as register_rank
+        FROM registers
+        GROUP BY ALL
+        ORDER BY dimension, value NULLS FIRST
+    """
+
+
+def get_top_k_sql(changesets_sql, k=TOP_K):
+    """Generate the SQL query of the k values with the most changesets of the top-K dimensions of a year-month.
+
+    other_max_changesets is the number of changesets of the next value after the top k, no value that is
+    missing from the sketch has more changesets in the year-month.
+    """
+    value_counts = [
+        f"SELECT '{dimension}' as dimension, {dimension} as value, count(*) as changesets FROM changesets "
+        f"WHERE {dimension} IS NOT NULL GROUP BY ALL"
+        if dimension in ROLLUP_DIMENSIONS
+        else f"SELECT '{dimension}', value, count(*) FROM (SELECT unnest(list_distinct({dimension})) as value "
+        "FROM changesets) GROUP BY ALL"
+        for dimension in TOP_K_DIMENSIONS
+    ]
+    return f"""
+        WITH changesets AS (SELECT * FROM {changesets_sql}),
+        ranked AS (
+            SELECT *, row_number() OVER (PARTITION BY dimension ORDER BY changesets DESC, value) as rank
+            FROM ({" UNION ALL ".join(value_counts)})
+        )
+        SELECT dimension, value, changesets::BIGINT as changesets,
+            coalesce((SELECT max(changesets) FROM ranked other
+                WHERE other.dimension = ranked.dimension AND other.rank = {k + 1}), 0)::BIGINT as other_max_changesets
+        FROM ranked
+        WHERE rank <= {k}
+        ORDER BY dimension, rank
+    """
+
+
+def write_year_month_sketches(enriched_path, sketch_path, year, month, code_table_path=None):
+    """Write the contributor HLL and top-K sketches of an enriched year-month to sketch_path, replacing old ones.
+
+    With code_table_path, the coded columns are decoded, so the sketches have the same values as without codes.
+    """
+    partition_dir = Path(enriched_path) / partition_key(year, month)
+    changesets_sql = get_decoded_changesets_sql(
+        f"read_parquet('{partition_dir}/*.parquet', hive_partitioning = false)", code_table_path
+    )
+    for sketch_dir, sketch_sql in [
+        (CONTRIBUTORS_HLL_DIR, get_hll_sql(changesets_sql)),
+        (TOP_K_DIR, get_top_k_sql(changesets_sql)),
+    ]:
+        sketch_file = Path(sketch_path) / sketch_dir / partition_key(year, month) / SKETCH_FILE
+        sketch_file.parent.mkdir(parents=True, exist_ok=True)
+        temp_file = sketch_file.with_name(f"{sketch_file.name}.tmp")
+        duckdb.sql(f"COPY ({sketch_sql}) TO '{temp_file}' (FORMAT PARQUET)")
+        temp_file.replace(sketch_file)
+
+
+def write_sketches(enriched_path, sketch_path, year_months=None, code_table_path=None):
+    """Write the sketches of the given year-months, of all enriched year-months if year_months is None"""
+    if year_months is None:
+        year_months = sorted(
+            (int(month_dir.parent.name.split("=")[1]), int(month_dir.name.split("=")[1]))
+            for month_dir in Path(enriched_path).glob("year=*/month=*")
+        )
+    for year, month in year_months:
+        write_year_month_sketches(enriched_path, sketch_path, year, month, code_table_path)
+
+
+def get_merged_contributors_sql(sketch_path, where_sql="true", group_by=("dimension", "value")):
+    """Generate the SQL query of the estimated distinct contributors of the HLL sketches merged over where_sql.
+
+    The sketches of the selected year-months are merged per group_by (any columns of the sketch table including
+    year, e.g. ("year", "dimension", "value") for yearly contributors) by taking the maximum of every register.
+    The estimate has a relative standard error of HLL_RELATIVE_ERROR.
+    """
+    group_sql = ", ".join(group_by)
+    m = HLL_REGISTER_COUNT
+    raw_estimate_sql = f"{HLL_ALPHA * m * m}::DOUBLE / inverse_sum"
+    return f"""
+        WITH registers AS (
+            SELECT {group_sql}, register_index, max(register_rank) as register_rank
+            FROM (
+                SELECT * EXCLUDE (register_index, register_rank),
+                    unnest(register_index) as register_index, unnest(register_rank) as register_rank
+                FROM read_parquet('{sketch_path}/{CONTRIBUTORS_HLL_DIR}/year=*/month=*/*.parquet')
+                WHERE {where_sql}
+            )
+            GROUP BY ALL
+        ),
+        sums AS (
+            SELECT {group_sql}, {m} - count(*) as zero_registers,
+                sum(pow(2, -register_rank::INTEGER)) + {m} - count(*) as inverse_sum
+            FROM registers
+            GROUP BY ALL
+        )
+        SELECT {group_sql},
+            CASE WHEN {raw_estimate_sql} <= {2.5 * m} AND zero_registers > 0
+                THEN {m} * ln({m} / zero_registers)
+                ELSE {raw_estimate_sql}
+            END as contributors
+        FROM sums
+    """
+
+
+def get_merged_top_k_sql(sketch_path, dimension, where_sql="true", k=TOP_K):
+    """Generate the SQL query of the k values of a top-K dimension with the most changesets over where_sql.
+
+    changesets is the sum over the year-months in which the value is in the sketch, so it is a lower bound.
+    The value can have at most other_max_changesets of every year-month it is missing in, which gives the
+    upper bound max_changesets.
+    """
+    sketches_sql = f"""
+        SELECT * FROM read_parquet('{sketch_path}/{TOP_K_DIR}/year=*/month=*/*.parquet')
+        WHERE dimension = '{dimension}' AND {where_sql}
+    """
+    return f"""
+        WITH sketches AS ({sketches_sql}),
+        months AS (SELECT DISTINCT year, month, other_max_changesets FROM sketches)
+        SELECT value, sum(changesets)::BIGINT as changesets,
+            (sum(changesets) + (SELECT sum(other_max_changesets) FROM months)
+                - sum(other_max_changesets))::BIGINT as max_changesets
+        FROM sketches
+        GROUP BY value
+        ORDER BY changesets DESC, value
+        LIMIT {k}
+    """
+
+
+def merge_hll(sketches):
+    """Merge sparse HLL sketches, given as (register_index, register_rank) lists, into a dense register array"""
+    registers = np.zeros(HLL_REGISTER_COUNT, dtype=np.uint8)
+    for register_index, register_rank in sketches:
+        np.maximum.at(registers, np.asarray(register_index, dtype=np.int64), np.asarray(register_rank, np.uint8))
+    return registers
+
+
+def estimate_hll(registers):
+    """Estimate the distinct count of a dense register array, with a relative standard error of HLL_RELATIVE_ERROR"""
+    m = HLL_REGISTER_COUNT
+    estimate = HLL_ALPHA * m * m / np.sum(np.power(2.0, -registers.astype(np.float64)))
+    zero_registers = np.count_nonzero(registers == 0)
+    if estimate <= 2.5 * m and zero_registers > 0:
+        return m * np.log(m / zero_registers)
+    return estimate
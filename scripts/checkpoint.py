@@ -0,0 +1,52 @@
+import json
+import re
+from pathlib import Path
+
+from osm_input import input_position
+
+# The checkpoint is stored in the output directory of the main dataset. Files starting with an underscore
+# are ignored by the Parquet dataset readers and the *.parquet globs don't match it.
+CHECKPOINT_FILE = "_checkpoint.json"
+
+
+def stream_checkpoint(file_handle, **values):
+    """Create the checkpoint of one output stream with the resume position of the input file handle"""
+    position = input_position(file_handle) if file_handle is not None else None
+    return {**values, "position": position}
+
+
+def resume_position(checkpoint):
+    """Return the earliest resume position of all output streams, None means from the start of the input"""
+    positions = [stream["position"] for stream in checkpoint.values()]
+    if any(position is None for position in positions):
+        return None
+    position = min(positions, key=lambda position: position["decompressed_offset"])
+    return position if position["decompressed_offset"] > 0 else None
+
+
+def read_checkpoint(checkpoint_path):
+    checkpoint_path = Path(checkpoint_path)
+    if not checkpoint_path.exists():
+        raise FileNotFoundError(f"Checkpoint '{checkpoint_path}' doesn't exist, there is nothing to resume.")
+    return json.loads(checkpoint_path.read_text())
+
+
+def write_checkpoint(checkpoint_path, checkpoint):
+    """Write the checkpoint to a temporary file first, so a crash never leaves a partial checkpoint"""
+    checkpoint_path = Path(checkpoint_path)
+    checkpoint_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = checkpoint_path.with_name(f"{checkpoint_path.name}.tmp")
+    temp_path.write_text(json.dumps(checkpoint, indent=2))
+    temp_path.replace(checkpoint_path)
+
+
+def remove_unsaved_batches(directory, file_name_pattern, batch_count):
+    """Remove the batch files written after the checkpoint, the first group of the pattern is the batch number"""
+    removed_count = 0
+    for file_path in Path(directory).glob("**/*.parquet"):
+        match = re.fullmatch(file_name_pattern, file_path.name)
+        if match and int(match.group(1)) >= batch_count:
+            file_path.unlink()
+            removed_count += 1
+    if removed_count:
+        print(f"Removed {removed_count} files in {directory} that were written after the checkpoint")
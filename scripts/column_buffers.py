@@ -0,0 +1,212 @@
+import math
+from array import array
+from datetime import UTC, datetime, timedelta
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+EPOCH = datetime(1970, 1, 1, tzinfo=UTC)
+ONE_MICROSECOND = timedelta(microseconds=1)
+
+# Typed append-only column buffers. They store values in compact C arrays or Arrow arrays instead of
+# Python objects, so a batch takes less memory and converts to an Arrow table without a Python loop.
+COMPACT_INTERVAL = 65536
+# with a memory budget per batch the strings are compacted more often, so the size of a batch is known more exactly
+MEMORY_CHECK_INTERVAL = 4096
+# the int32 offsets of an Arrow string array limit its string data to 2 GiB, larger columns are split into chunks
+MAX_STRING_ARRAY_NBYTES = 2**31 - 1
+# microseconds that a None timestamp is stored as, it is converted to null
+NULL_TIMESTAMP = -(2**63)
+
+
+def buffers_nbytes(*buffers):
+    """Estimated memory of column buffers, exact for compacted strings"""
+    return sum(buffer.nbytes() for buffer in buffers)
+
+
+def _concat_strings(chunks):
+    """Concatenate string chunks into a large_string array, which has no 2 GiB limit"""
+    return pa.concat_arrays([chunk.cast(pa.large_string()) for chunk in chunks])
+
+
+def _split_rows(row_string_offsets, max_nbytes):
+    """Split rows into (first row, end row) slices with at most max_nbytes of string data each.
+
+    row_string_offsets are the offsets of the rows in the string data of every string array of the column,
+    a single row with more string data gets its own slice.
+    """
+    row_count = len(row_string_offsets[0]) - 1
+    slices = []
+    start = 0
+    while start < row_count:
+        end = min(
+            int(np.searchsorted(offsets, offsets[start] + max_nbytes, side="right")) - 1
+            for offsets in row_string_offsets
+        )
+        end = min(max(end, start + 1), row_count)
+        slices.append((start, end))
+        start = end
+    return slices
+
+
+def _string_offsets(large_strings):
+    return np.frombuffer(
+        large_strings.buffers()[1], dtype=np.int64, count=len(large_strings) + 1, offset=large_strings.offset * 8
+    )
+
+
+class NumberBuffer:
+    """Column of fixed width numbers stored in an array.array"""
+
+    def __init__(self, typecode, arrow_type):
+        self.values = array(typecode)
+        self.arrow_type = arrow_type
+        # avoid a Python level method call per value, subclasses that convert values define their own append
+        if "append" not in type(self).__dict__:
+            self.append = self.values.append
+
+    def __len__(self):
+        return len(self.values)
+
+    def compact(self):
+        pass
+
+    def nbytes(self):
+        return len(self.values) * self.values.itemsize
+
+    def to_arrow(self):
+        return pa.Array.from_buffers(self.arrow_type, len(self.values), [None, pa.py_buffer(self.values)])
+
+
+class FloatBuffer(NumberBuffer):
+    """Column of float64 values where None is stored as NaN and converted to null"""
+
+    def __init__(self):
+        super().__init__("d", pa.float64())
+        self.has_nulls = False
+
+    def append(self, value):
+        if value is None:
+            self.has_nulls = True
+            value = math.nan
+        self.values.append(value)
+
+    def to_arrow(self):
+        values = super().to_arrow()
+        if not self.has_nulls:
+            return values
+        return pc.if_else(pc.is_nan(values), pa.scalar(None, pa.float64()), values)
+
+
+class TimestampBuffer(NumberBuffer):
+    """Column of UTC datetimes stored as int64 microseconds since the epoch, None is converted to null"""
+
+    def __init__(self):
+        super().__init__("q", pa.timestamp("us", tz="UTC"))
+        self.has_nulls = False
+
+    def append(self, value):
+        if value is None:
+            self.has_nulls = True
+            self.values.append(NULL_TIMESTAMP)
+        else:
+            self.values.append((value - EPOCH) // ONE_MICROSECOND)
+
+    def to_arrow(self):
+        values = super().to_arrow()
+        if not self.has_nulls:
+            return values
+        return pc.if_else(pc.equal(values.cast(pa.int64()), NULL_TIMESTAMP), pa.scalar(None, self.arrow_type), values)
+
+
+class StringBuffer:
+    """Column of strings that are collected in a list and regularly compacted into Arrow string arrays
+
+    Encoding every string in Python is slower than letting Arrow convert a list of strings, so only
+    up to COMPACT_INTERVAL rows are kept as Python objects before they are moved into an Arrow chunk.
+    """
+
+    def __init__(self):
+        self.pending = []
+        self.chunks = []
+        self.chunks_length = 0
+        self.chunks_nbytes = 0
+        self.append = self.pending.append
+        self.extend = self.pending.extend
+
+    def __len__(self):
+        return self.chunks_length + len(self.pending)
+
+    def compact(self):
+        """Move the pending strings into an Arrow chunk"""
+        if not self.pending:
+            return
+        chunk = pa.array(self.pending, pa.string())
+        self.chunks.append(chunk)
+        self.chunks_length += len(chunk)
+        self.chunks_nbytes += chunk.nbytes
+        self.pending.clear()
+
+    def nbytes(self):
+        # pending strings are estimated with the size of a short Python string and its list pointer
+        return self.chunks_nbytes + len(self.pending) * 64
+
+    def to_arrow(self):
+        """Return a string array, or a chunked array if the strings don't fit into one array"""
+        self.compact()
+        if not self.chunks:
+            return pa.array([], pa.string())
+        if self.chunks_nbytes <= MAX_STRING_ARRAY_NBYTES:
+            return pa.concat_arrays(self.chunks)
+        strings = _concat_strings(self.chunks)
+        slices = _split_rows([_string_offsets(strings)], MAX_STRING_ARRAY_NBYTES)
+        return pa.chunked_array([strings[start:end].cast(pa.string()) for start, end in slices], pa.string())
+
+
+class MapBuffer:
+    """Column of str -> str dicts stored as flat key and value string buffers with int32 row offsets"""
+
+    def __init__(self):
+        self.keys = StringBuffer()
+        self.values = StringBuffer()
+        self.offsets = array("i", [0])
+        self.length = 0
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def append(self, value):
+        self.keys.extend(value)
+        self.values.extend(value.values())
+        self.length += len(value)
+        self.offsets.append(self.length)
+
+    def compact(self):
+        self.keys.compact()
+        self.values.compact()
+
+    def nbytes(self):
+        return self.keys.nbytes() + self.values.nbytes() + len(self.offsets) * self.offsets.itemsize
+
+    def to_arrow(self):
+        """Return a map array, or a chunked array if the keys or values don't fit into one string array"""
+        offsets = pa.Array.from_buffers(pa.int32(), len(self.offsets), [None, pa.py_buffer(self.offsets)])
+        self.compact()
+        if max(self.keys.chunks_nbytes, self.values.chunks_nbytes) <= MAX_STRING_ARRAY_NBYTES:
+            return pa.MapArray.from_arrays(offsets, self.keys.to_arrow(), self.values.to_arrow())
+        keys = _concat_strings(self.keys.chunks)
+        values = _concat_strings(self.values.chunks)
+        entry_offsets = np.frombuffer(self.offsets, dtype=np.int32)
+        row_string_offsets = [_string_offsets(keys)[entry_offsets], _string_offsets(values)[entry_offsets]]
+        chunks = []
+        for start, end in _split_rows(row_string_offsets, MAX_STRING_ARRAY_NBYTES):
+            first_entry, end_entry = entry_offsets[start], entry_offsets[end]
+            chunks.append(
+                pa.MapArray.from_arrays(
+                    pa.array(entry_offsets[start : end + 1] - first_entry, pa.int32()),
+                    keys[first_entry:end_entry].cast(pa.string()),
+                    values[first_entry:end_entry].cast(pa.string()),
+                )
+            )
+        return pa.chunked_array(chunks, pa.map_(pa.string(), pa.string()))
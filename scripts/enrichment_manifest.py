@@ -0,0 +1,72 @@
+import hashlib
+import json
+from pathlib import Path
+
+# Stored in the output directory of the enriched dataset, like the checkpoint the *.parquet globs don't match it
+MANIFEST_FILE = "_manifest.json"
+
+
+def partition_key(year, month):
+    return f"year={year}/month={month}"
+
+
+def file_sha256(file_path):
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as file_handle:
+        while chunk := file_handle.read(1024 * 1024):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def get_input_checksums(partition_dir, previous_checksums=None):
+    """Checksums of the Parquet files of a partition.
+
+    The checksum of a file is only computed again if its size or modification time differs from previous_checksums.
+    """
+    previous_checksums = previous_checksums or {}
+    checksums = {}
+    for file_path in sorted(Path(partition_dir).glob("*.parquet")):
+        stat = file_path.stat()
+        checksum = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        previous = previous_checksums.get(file_path.name, {})
+        if previous.get("size") == stat.st_size and previous.get("mtime_ns") == stat.st_mtime_ns:
+            checksum["sha256"] = previous["sha256"]
+        else:
+            checksum["sha256"] = file_sha256(file_path)
+        checksums[file_path.name] = checksum
+    return checksums
+
+
+def get_stale_columns(partition, input_checksums, column_hashes):
+    """Return the columns of a partition that have to be computed again, None if the whole partition has to.
+
+    partition is the entry of the manifest, the whole partition has to be enriched again if there is none yet,
+    if its input files changed or if a column was removed. Otherwise the new columns and the columns
+    whose hash changed are stale.
+    """
+    if partition is None or _file_sha256s(partition["input_files"]) != _file_sha256s(input_checksums):
+        return None
+    if any(name not in column_hashes for name in partition["columns"]):
+        return None
+    return [name for name, column_hash in column_hashes.items() if partition["columns"].get(name) != column_hash]
+
+
+def _file_sha256s(checksums):
+    # a file that was only touched didn't change
+    return {file_name: checksum["sha256"] for file_name, checksum in checksums.items()}
+
+
+def read_manifest(manifest_path):
+    manifest_path = Path(manifest_path)
+    if not manifest_path.exists():
+        return {"partitions": {}}
+    return json.loads(manifest_path.read_text())
+
+
+def write_manifest(manifest_path, manifest):
+    """Write the manifest to a temporary file first, so a crash never leaves a partial manifest"""
+    manifest_path = Path(manifest_path)
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = manifest_path.with_name(f"{manifest_path.name}.tmp")
+    temp_path.write_text(json.dumps(manifest, indent=2))
+    temp_path.replace(manifest_path)
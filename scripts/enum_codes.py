@@ -0,0 +1,91 @@
+from pathlib import Path
+
+import duckdb
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+CODE_TABLE_FILE = "codes.parquet"
+CODE_TABLE_SCHEMA = pa.schema(
+    [pa.field("column", pa.string()), pa.field("code", pa.int32()), pa.field("value", pa.string())]
+)
+# enriched string columns with few distinct values that are written as integer codes with --code-table
+CODED_COLUMNS = ["created_by", "device_type", "mobile_os", "streetcomplete_quest", "organised_team"]
+
+
+def read_code_table(code_table_path):
+    code_table_file = Path(code_table_path) / CODE_TABLE_FILE
+    if not code_table_file.exists():
+        return CODE_TABLE_SCHEMA.empty_table()
+    return pq.read_table(code_table_file, schema=CODE_TABLE_SCHEMA)
+
+
+def update_code_table(code_table, values_by_column):
+    """Append the values that don't have a code yet, the codes of a column are numbered from 0 in this order.
+
+    values_by_column maps a coded column to a list of its values, the existing codes never change.
+    """
+    rows = code_table.to_pylist()
+    for column, values in values_by_column.items():
+        known_values = {row["value"] for row in rows if row["column"] == column}
+        next_code = len(known_values)
+        for value in values:
+            if value is not None and value not in known_values:
+                rows.append({"column": column, "code": next_code, "value": value})
+                known_values.add(value)
+                next_code += 1
+    return pa.Table.from_pylist(rows, schema=CODE_TABLE_SCHEMA)
+
+
+def write_code_table(code_table_path, code_table):
+    code_table_file = Path(code_table_path) / CODE_TABLE_FILE
+    code_table_file.parent.mkdir(parents=True, exist_ok=True)
+    temp_file = code_table_file.with_name(f"{code_table_file.name}.tmp")
+    pq.write_table(code_table, temp_file)
+    temp_file.replace(code_table_file)
+
+
+def create_enum_types(code_table):
+    """Create a DuckDB ENUM type for every coded column with the values in the order of their codes"""
+    duckdb.register("code_table", code_table)
+    try:
+        for column in CODED_COLUMNS:
+            duckdb.sql(f"DROP TYPE IF EXISTS {column}_code")
+            duckdb.sql(f"""
+            CREATE TYPE {column}_code AS ENUM (
+                SELECT value FROM code_table WHERE "column" = '{column}' ORDER BY code
+            )
+            """)
+    finally:
+        duckdb.unregister("code_table")
+
+
+def get_code_expression(column, expression):
+    """Generate SQL of the code of a coded column, the position of its value in the ENUM type of create_enum_types.
+
+    A value without a code fails the query with an error that names it, instead of a cast error without context.
+    """
+    code_sql = f"TRY_CAST({expression} AS {column}_code)"
+    return f"""
+        CASE
+            WHEN ({expression}) IS NOT NULL AND {code_sql} IS NULL
+            THEN error('{column} value without a code, update the code table first: ' || ({expression}))
+            ELSE enum_code({code_sql})::INTEGER
+        END
+    """
+
+
+def get_decoded_changesets_sql(changesets_sql, code_table_path=None):
+    """Generate SQL of the changesets of a DuckDB source with the values of the coded columns instead of their codes.
+
+    The codes of a column are numbered from 0 without gaps, so the code is an index into the list of its values.
+    Without code_table_path the columns aren't coded and the source is returned unchanged.
+    """
+    if code_table_path is None:
+        return changesets_sql
+    code_table_sql = f"read_parquet('{Path(code_table_path) / CODE_TABLE_FILE}')"
+    decode_sql = ", ".join(
+        f"""(SELECT list(value ORDER BY code) FROM {code_table_sql} WHERE "column" = '{column}')[{column} + 1]"""
+        f" as {column}"
+        for column in CODED_COLUMNS
+    )
+    return f"(SELECT * REPLACE ({decode_sql}) FROM {changesets_sql})"
@@ -0,0 +1,159 @@
+import io
+import json
+import resource
+import threading
+import time
+from pathlib import Path
+
+RSS_SAMPLE_INTERVAL = 0.5
+
+
+def get_rss_mb():
+    """Current resident set size of this process in MB"""
+    try:
+        with open("/proc/self/status") as status_file:
+            for line in status_file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # without /proc only the peak is available (in KB on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class RSSSampler:
+    """Sample the RSS of this process on a background thread and keep the peak"""
+
+    def __init__(self, interval=RSS_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.peak_rss_mb = get_rss_mb()
+        self.sample_count = 1
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak_rss_mb = max(self.peak_rss_mb, get_rss_mb())
+            self.sample_count += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.peak_rss_mb = max(self.peak_rss_mb, get_rss_mb())
+
+
+class TimedReader(io.RawIOBase):
+    """Read-only stream that measures the time spent waiting for the decompressed data and counts its bytes"""
+
+    def __init__(self, file_handle):
+        super().__init__()
+        self.file_handle = file_handle
+        self.read_time = 0.0
+        self.read_bytes = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        start_time = time.perf_counter()
+        data = self.file_handle.read(len(buffer))
+        self.read_time += time.perf_counter() - start_time
+        buffer[: len(data)] = data
+        self.read_bytes += len(data)
+        return len(data)
+
+
+class IngestMetrics:
+    """Collect throughput and the time split of a parser run for a JSON report.
+
+    The parse loop is timed per element, so XML parsing (iterating the records minus the time waiting for the
+    decompressed data) and the Python conversion (processing the records minus saving the batches) can be told apart.
+    """
+
+    def __init__(self, rss_sample_interval=RSS_SAMPLE_INTERVAL):
+        self.start_time = time.perf_counter()
+        self.rss_sampler = RSSSampler(rss_sample_interval)
+        self.readers = []
+        self.compressed_bytes = 0
+        self.iteration_time = 0.0
+        self.process_time = 0.0
+        self.batch_save_time = 0.0
+
+    def wrap_input(self, file_handle, compressed_bytes):
+        """Wrap the decompressed input stream to measure it.
+
+        compressed_bytes is the size of the read input, None if it is unknown like for stdin.
+        """
+        if compressed_bytes is None or self.compressed_bytes is None:
+            self.compressed_bytes = None
+        else:
+            self.compressed_bytes += compressed_bytes
+        reader = TimedReader(file_handle)
+        self.readers.append(reader)
+        return io.BufferedReader(reader)
+
+    def process_records(self, records, process_record, get_batch_save_time):
+        """Process every record with process_record(*record) and time the iteration and the processing.
+
+        get_batch_save_time returns the time spent saving batches so far, which happens while processing.
+        """
+        perf_counter = time.perf_counter
+        records = iter(records)
+        batch_save_time_before = get_batch_save_time()
+        iteration_time = 0.0
+        process_time = 0.0
+        while True:
+            start_time = perf_counter()
+            record = next(records, None)
+            iterated_time = perf_counter()
+            if record is None:
+                iteration_time += iterated_time - start_time
+                break
+            process_record(*record)
+            iteration_time += iterated_time - start_time
+            process_time += perf_counter() - iterated_time
+        self.iteration_time += iteration_time
+        self.process_time += process_time
+        self.batch_save_time += get_batch_save_time() - batch_save_time_before
+
+    def report(self, elements, arrow_build_time, parquet_write_time, writer_wait_time=0.0, background_write=False):
+        """Create the report, elements maps the element type to its count"""
+        self.rss_sampler.stop()
+        total_time = time.perf_counter() - self.start_time
+        decompression_time = sum(reader.read_time for reader in self.readers)
+        decompressed_bytes = sum(reader.read_bytes for reader in self.readers)
+        element_count = sum(elements.values())
+        compressed_bytes_per_s = None
+        if self.compressed_bytes is not None:
+            compressed_bytes_per_s = round(self.compressed_bytes / total_time)
+        return {
+            "total_time_s": round(total_time, 3),
+            "elements": elements,
+            "elements_per_s": round(element_count / total_time, 1),
+            "compressed_bytes": self.compressed_bytes,
+            "compressed_bytes_per_s": compressed_bytes_per_s,
+            "decompressed_bytes": decompressed_bytes,
+            "decompressed_bytes_per_s": round(decompressed_bytes / total_time),
+            "time_s": {
+                # with parallel decompression this is the time the parser waited for the next decompressed block
+                "decompression": round(decompression_time, 3),
+                "xml_parsing": round(self.iteration_time - decompression_time, 3),
+                "python_conversion": round(self.process_time - self.batch_save_time, 3),
+                "arrow_build": round(arrow_build_time, 3),
+                # the writing overlaps with the parsing if it runs on the background writer
+                "parquet_write": round(parquet_write_time, 3),
+                "parquet_write_in_background": background_write,
+                "waiting_for_writer": round(writer_wait_time, 3),
+            },
+            "peak_rss_mb": round(self.rss_sampler.peak_rss_mb, 1),
+            "rss_sample_interval_s": self.rss_sampler.interval,
+            "rss_sample_count": self.rss_sampler.sample_count,
+            # the largest RSS of a terminated child process, e.g. of the bz2 decompression workers
+            "children_peak_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+        }
+
+
+def write_metrics_report(metrics_path, report):
+    Path(metrics_path).write_text(json.dumps(report, indent=2) + "\n")
+    print(f"Saved metrics report to {metrics_path}")
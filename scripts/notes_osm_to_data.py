@@ -1,14 +1,53 @@
 import argparse
-import bz2
 import shutil
 import sys
 import time
-import xml.etree.ElementTree as ET
 from datetime import datetime
 from pathlib import Path
 
 import pyarrow as pa
 import pyarrow.parquet as pq
+from checkpoint import (
+    CHECKPOINT_FILE,
+    read_checkpoint,
+    remove_unsaved_batches,
+    resume_position,
+    stream_checkpoint,
+    write_checkpoint,
+)
+from column_buffers import (
+    COMPACT_INTERVAL,
+    MEMORY_CHECK_INTERVAL,
+    NumberBuffer,
+    StringBuffer,
+    TimestampBuffer,
+    buffers_nbytes,
+)
+from ingest_metrics import IngestMetrics, write_metrics_report
+from osm_input import input_compressed_size, open_input, resync_stream
+from osm_xml import XML_BACKENDS, iter_notes
+
+NOTES_SCHEMA = pa.schema(
+    [
+        pa.field("note_id", pa.int64()),
+        pa.field("lat", pa.float64()),
+        pa.field("lon", pa.float64()),
+        pa.field("created_at", pa.timestamp("us", tz="UTC")),
+        pa.field("closed_at", pa.timestamp("us", tz="UTC")),
+        pa.field("mid_pos_x", pa.int32()),
+        pa.field("mid_pos_y", pa.int32()),
+    ]
+)
+
+COMMENTS_SCHEMA = pa.schema(
+    [
+        pa.field("note_id", pa.int64()),
+        pa.field("action", pa.string()),
+        pa.field("timestamp", pa.timestamp("us", tz="UTC")),
+        pa.field("user_name", pa.string()),
+        pa.field("text", pa.string()),
+    ]
+)
 
 
 class NotesParser:
@@ -21,19 +60,46 @@ class NotesParser:
         notes_schema,
         comments_schema,
         ignore_current_month=False,
+        xml_backend="etree",
+        checkpoint_path=None,
+        metrics=None,
+        batch_memory_mb=None,
     ):
         self.notes_batch_size = notes_batch_size
         self.comments_batch_size = comments_batch_size
+        # with a memory budget a batch is also saved once its buffered columns reach it, this is checked
+        # (after compacting the strings into Arrow arrays) every MEMORY_CHECK_INTERVAL rows
+        self.batch_memory_bytes = None if batch_memory_mb is None else int(batch_memory_mb * 1024 * 1024)
+        self.compact_interval = COMPACT_INTERVAL if batch_memory_mb is None else MEMORY_CHECK_INTERVAL
         self.notes_output_path = notes_output_path
         self.comments_output_path = comments_output_path
         self.notes_schema = notes_schema
         self.comments_schema = comments_schema
         self.ignore_current_month = ignore_current_month
+        self.xml_backend = xml_backend
         self.notes_count = 0
         self.notes_batch_count = 0
         self.comments_count = 0
         self.comments_batch_count = 0
 
+        # a checkpoint is written after every saved batch, the file handle of the input is needed for its position
+        self.checkpoint_path = checkpoint_path
+        self.input_handle = None
+        self.last_note_id = 0
+        self.last_comment = (0, -1)
+        # notes and comments up to these ones were already saved before resuming
+        self.saved_note_id = 0
+        self.saved_comment = (0, -1)
+        self.checkpoint = {
+            "notes": stream_checkpoint(None, last_note_id=0, batch_count=0, count=0),
+            "comments": stream_checkpoint(None, last_comment=(0, -1), batch_count=0, count=0),
+        }
+
+        # an IngestMetrics instance that times the parse loop for the metrics report
+        self.metrics = metrics
+        self.conversion_time = 0.0
+        self.write_time = 0.0
+
         # Get current year and month if we need to filter
         if self.ignore_current_month:
             now = datetime.now()
@@ -44,45 +110,71 @@ class NotesParser:
         self._init_comments_data()
 
     def _init_notes_data(self):
-        self.note_id = []
-        self.lat = []
-        self.lon = []
-        self.created_at = []
-        self.closed_at = []
-        self.mid_pos_x = []
-        self.mid_pos_y = []
+        self.note_id = NumberBuffer("q", pa.int64())
+        self.lat = NumberBuffer("d", pa.float64())
+        self.lon = NumberBuffer("d", pa.float64())
+        self.created_at = TimestampBuffer()
+        self.closed_at = TimestampBuffer()
+        self.mid_pos_x = NumberBuffer("i", pa.int32())
+        self.mid_pos_y = NumberBuffer("i", pa.int32())
 
     def _init_comments_data(self):
-        self.comment_note_id = []
-        self.comment_action = []
-        self.comment_timestamp = []
-        self.comment_user_name = []
-        self.comment_text = []
+        self.comment_note_id = NumberBuffer("q", pa.int64())
+        self.comment_action = StringBuffer()
+        self.comment_timestamp = TimestampBuffer()
+        self.comment_user_name = StringBuffer()
+        self.comment_text = StringBuffer()
+
+    def _notes_nbytes(self):
+        """Memory of the buffered notes columns"""
+        return buffers_nbytes(
+            self.note_id, self.lat, self.lon, self.created_at, self.closed_at, self.mid_pos_x, self.mid_pos_y
+        )
+
+    def _comments_nbytes(self):
+        """Estimated memory of the buffered comments columns"""
+        return buffers_nbytes(
+            self.comment_note_id,
+            self.comment_action,
+            self.comment_timestamp,
+            self.comment_user_name,
+            self.comment_text,
+        )
 
     def _save_notes_batch(self):
         """Save current notes batch to disk and clear notes data"""
         if not self.note_id:
             return
 
+        start_time = time.perf_counter()
         notes_data_dict = {
-            "note_id": self.note_id,
-            "lat": self.lat,
-            "lon": self.lon,
-            "created_at": self.created_at,
-            "closed_at": self.closed_at,
-            "mid_pos_x": self.mid_pos_x,
-            "mid_pos_y": self.mid_pos_y,
+            "note_id": self.note_id.to_arrow(),
+            "lat": self.lat.to_arrow(),
+            "lon": self.lon.to_arrow(),
+            "created_at": self.created_at.to_arrow(),
+            "closed_at": self.closed_at.to_arrow(),
+            "mid_pos_x": self.mid_pos_x.to_arrow(),
+            "mid_pos_y": self.mid_pos_y.to_arrow(),
         }
         notes_table = pa.table(notes_data_dict, schema=self.notes_schema)
+        self.conversion_time += time.perf_counter() - start_time
 
         notes_dir = Path(self.notes_output_path)
         notes_dir.mkdir(parents=True, exist_ok=True)
         notes_file = notes_dir / f"part-{self.notes_batch_count}.parquet"
+        start_time = time.perf_counter()
         pq.write_table(notes_table, notes_file)
+        self.write_time += time.perf_counter() - start_time
 
         self._init_notes_data()
         self.notes_batch_count += 1
-        print(f"Saved notes batch {self.notes_batch_count}, processed {self.notes_count} notes total")
+        self._save_checkpoint(
+            "notes", last_note_id=self.last_note_id, batch_count=self.notes_batch_count, count=self.notes_count
+        )
+        print(
+            f"Saved notes batch {self.notes_batch_count} with {notes_table.num_rows} notes "
+            f"({notes_table.nbytes / 1024 / 1024:.1f} MB), processed {self.notes_count} notes total"
+        )
         sys.stdout.flush()
 
     def _save_comments_batch(self):
@@ -90,36 +182,78 @@ class NotesParser:
         if not self.comment_note_id:
             return
 
+        start_time = time.perf_counter()
         comments_data_dict = {
-            "note_id": self.comment_note_id,
-            "action": self.comment_action,
-            "timestamp": self.comment_timestamp,
-            "user_name": self.comment_user_name,
-            "text": self.comment_text,
+            "note_id": self.comment_note_id.to_arrow(),
+            "action": self.comment_action.to_arrow(),
+            "timestamp": self.comment_timestamp.to_arrow(),
+            "user_name": self.comment_user_name.to_arrow(),
+            "text": self.comment_text.to_arrow(),
         }
         comments_table = pa.table(comments_data_dict, schema=self.comments_schema)
+        self.conversion_time += time.perf_counter() - start_time
 
         comments_dir = Path(self.comments_output_path)
         comments_dir.mkdir(parents=True, exist_ok=True)
         comments_file = comments_dir / f"part-{self.comments_batch_count}.parquet"
+        start_time = time.perf_counter()
         pq.write_table(comments_table, comments_file)
+        self.write_time += time.perf_counter() - start_time
 
         self._init_comments_data()
         self.comments_batch_count += 1
-        print(f"Saved comments batch {self.comments_batch_count}, processed {self.comments_count} comments total")
+        self._save_checkpoint(
+            "comments", last_comment=self.last_comment, batch_count=self.comments_batch_count, count=self.comments_count
+        )
+        print(
+            f"Saved comments batch {self.comments_batch_count} with {comments_table.num_rows} comments "
+            f"({comments_table.nbytes / 1024 / 1024:.1f} MB), processed {self.comments_count} comments total"
+        )
         sys.stdout.flush()
 
+    def _save_checkpoint(self, stream, **values):
+        """Update the checkpoint of one output stream after its batch was saved"""
+        if self.checkpoint_path is None:
+            return
+        self.checkpoint[stream] = stream_checkpoint(self.input_handle, **values)
+        write_checkpoint(self.checkpoint_path, self.checkpoint)
+
+    def _resume_from_checkpoint(self):
+        """Restore the state of the checkpoint and remove batch files that were written after it.
+
+        Returns the input position to continue from. The notes in the dump are ordered by id, so
+        the notes and comments up to the last saved ones are skipped after resuming.
+        """
+        self.checkpoint = read_checkpoint(self.checkpoint_path)
+        notes_checkpoint = self.checkpoint["notes"]
+        comments_checkpoint = self.checkpoint["comments"]
+        self.saved_note_id = self.last_note_id = notes_checkpoint["last_note_id"]
+        self.saved_comment = self.last_comment = tuple(comments_checkpoint["last_comment"])
+        self.notes_batch_count = notes_checkpoint["batch_count"]
+        self.notes_count = notes_checkpoint["count"]
+        self.comments_batch_count = comments_checkpoint["batch_count"]
+        self.comments_count = comments_checkpoint["count"]
+        remove_unsaved_batches(self.notes_output_path, r"part-(\d+)\.parquet", self.notes_batch_count)
+        remove_unsaved_batches(self.comments_output_path, r"part-(\d+)\.parquet", self.comments_batch_count)
+        print(f"Resuming after note {self.saved_note_id} and the comments of note {self.saved_comment[0]}")
+        return resume_position(self.checkpoint)
+
     def _parse_timestamp(self, timestamp_str):
         """Parse ISO 8601 timestamp string to datetime object"""
         if timestamp_str:
             return datetime.fromisoformat(timestamp_str[:-1] + "+00:00")
         return None
 
-    def _process_note(self, elem):
-        """Process a single note element"""
+    def _process_note(self, attribs, comments):
+        """Process a single note with its comments"""
         # Get note attributes
-        attribs = elem.attrib
         note_id = int(attribs.get("id"))
+        self.last_note_id = note_id
+        if note_id <= self.saved_note_id:
+            # the note was already saved before resuming, only some of its comments may be missing
+            self._process_comments(note_id, comments)
+            return
+
         lat = float(attribs.get("lat"))
         lon = float(attribs.get("lon"))
         created_at = self._parse_timestamp(attribs.get("created_at"))
@@ -128,7 +262,6 @@ class NotesParser:
         # Check if we should skip this note
         if self.ignore_current_month:
             if created_at.year == self.current_year and created_at.month == self.current_month:
-                elem.clear()
                 return
 
             # If note was closed in current month, treat it as still open
@@ -145,71 +278,123 @@ class NotesParser:
         self.mid_pos_x.append(round((lon + 180) % 360))
         self.mid_pos_y.append(round((lat + 90) % 180))
 
-        # Extract comments
-        for child in elem:
-            if child.tag == "comment":
-                comment_attribs = child.attrib
-                comment_timestamp = self._parse_timestamp(comment_attribs.get("timestamp"))
-
-                # Skip comments from current month if flag is set
-                if self.ignore_current_month:
-                    if comment_timestamp.year == self.current_year and comment_timestamp.month == self.current_month:
-                        continue
-
-                self.comments_count += 1
-
-                self.comment_note_id.append(note_id)
-                self.comment_action.append(comment_attribs.get("action", ""))
-                self.comment_timestamp.append(comment_timestamp)
-                self.comment_user_name.append(comment_attribs.get("user", ""))
-
-                comment_text = child.text or ""
-                self.comment_text.append(comment_text)
-
-                # Check if we need to save comments batch
-                if len(self.comment_note_id) >= self.comments_batch_size:
-                    self._save_comments_batch()
+        self._process_comments(note_id, comments)
 
         # Check if we need to save notes batch
         if len(self.note_id) >= self.notes_batch_size:
             self._save_notes_batch()
+        elif len(self.note_id) % self.compact_interval == 0:
+            if self.batch_memory_bytes is not None and self._notes_nbytes() >= self.batch_memory_bytes:
+                self._save_notes_batch()
+
+    def _process_comments(self, note_id, comments):
+        """Store the comments of a note"""
+        for comment_index, (comment_attribs, comment_text) in enumerate(comments):
+            # Skip comments that were already saved before resuming
+            if note_id <= self.saved_comment[0] and (note_id, comment_index) <= self.saved_comment:
+                continue
+            self.last_comment = (note_id, comment_index)
+            comment_timestamp = self._parse_timestamp(comment_attribs.get("timestamp"))
+
+            # Skip comments from current month if flag is set
+            if self.ignore_current_month:
+                if comment_timestamp.year == self.current_year and comment_timestamp.month == self.current_month:
+                    continue
+
+            self.comments_count += 1
+
+            self.comment_note_id.append(note_id)
+            self.comment_action.append(comment_attribs.get("action", ""))
+            self.comment_timestamp.append(comment_timestamp)
+            self.comment_user_name.append(comment_attribs.get("user", ""))
+            self.comment_text.append(comment_text)
+
+            # Check if we need to save comments batch
+            if len(self.comment_note_id) >= self.comments_batch_size:
+                self._save_comments_batch()
+            elif len(self.comment_note_id) % self.compact_interval == 0:
+                self.comment_action.compact()
+                self.comment_user_name.compact()
+                self.comment_text.compact()
+                if self.batch_memory_bytes is not None and self._comments_nbytes() >= self.batch_memory_bytes:
+                    self._save_comments_batch()
 
-        elem.clear()
+    def _batch_save_time(self):
+        """Time the parse loop spent saving batches instead of parsing"""
+        return self.conversion_time + self.write_time
 
-    def parse_file(self, file_path):
-        """Parse OSM notes bz2 XML file using iterparse for memory efficiency"""
-        with bz2.open(file_path, "rb") as file_handle:
-            context = ET.iterparse(file_handle, events=("end",))
-            for event, elem in context:
-                if elem.tag == "note":
-                    self._process_note(elem)
+    def parse_stream(self, file_handle):
+        """Parse a decompressed OSM notes XML stream with the selected XML backend"""
+        notes = iter_notes(file_handle, self.xml_backend)
+        if self.metrics is not None:
+            self.metrics.process_records(notes, self._process_note, self._batch_save_time)
+            return
+        for attribs, comments in notes:
+            self._process_note(attribs, comments)
+
+    def parse_file(self, file_path, decompression_workers=None, resume=False, decompressor=None):
+        """Parse OSM notes bz2 XML file, with resume=True it continues after the saved checkpoint
+
+        The file path can also be "-" for stdin or a binary file object, see open_input.
+        """
+        position = self._resume_from_checkpoint() if resume else None
+        with open_input(file_path, decompression_workers, position, decompressor) as file_handle:
+            self.input_handle = file_handle
+            if self.metrics is not None:
+                compressed_size = input_compressed_size(file_path, decompression_workers, position)
+                file_handle = self.metrics.wrap_input(file_handle, compressed_size)
+            if position is None:
+                self.parse_stream(file_handle)
+            else:
+                self.parse_stream(resync_stream(file_handle, b"<note ", root=b"osm-notes"))
+        self.input_handle = None
 
     def finalize(self):
         """Save any remaining data in the final batches"""
         self._save_notes_batch()
         self._save_comments_batch()
+        if self.checkpoint_path is not None:
+            Path(self.checkpoint_path).unlink(missing_ok=True)
         print(
             f"Finished processing. Total: {self.notes_count} notes in {self.notes_batch_count} batches, "
             f"{self.comments_count} comments in {self.comments_batch_count} batches"
         )
 
+    def write_metrics_report(self, metrics_path):
+        """Write the metrics report of this run after finalize"""
+        report = self.metrics.report(
+            {"notes": self.notes_count, "comments": self.comments_count},
+            arrow_build_time=self.conversion_time,
+            parquet_write_time=self.write_time,
+        )
+        write_metrics_report(metrics_path, report)
+
 
 def main():
     parser = argparse.ArgumentParser(description="Process OSM notes (with comments) and convert to Parquet datasets")
-    parser.add_argument("notes_path", help="Path to the OSM notes .bz2 file")
+    parser.add_argument(
+        "notes_path", help="Path to the OSM notes file (bz2, gzip, zstd or uncompressed) or - to read it from stdin"
+    )
     parser.add_argument("notes_output_path", help="Path to the output directory for notes data")
     parser.add_argument("comments_output_path", help="Path to the output directory for comments data")
     parser.add_argument(
         "--notes-batch-size",
         type=int,
-        default=1_000_000,
-        help="Number of notes to process in each batch (default: 1_000_000)",
+        default=None,
+        help="Number of notes to process in each batch (default: 1_000_000, no limit with --batch-memory-mb)",
     )
     parser.add_argument(
         "--comments-batch-size",
         type=int,
-        default=1_000_000,
-        help="Number of comments to process in each batch (default: 1_000_000)",
+        default=None,
+        help="Number of comments to process in each batch (default: 1_000_000, no limit with --batch-memory-mb)",
+    )
+    parser.add_argument(
+        "--batch-memory-mb",
+        type=float,
+        default=None,
+        help="Save a notes or comments batch once its buffered columns take this many MB "
+        "instead of after a fixed number of rows",
     )
     parser.add_argument("--overwrite", action="store_true", help="Delete output directories if they exist")
     parser.add_argument(
@@ -217,70 +402,101 @@ def main():
         action="store_true",
         help="Skip processing notes created in the current month (useful for avoiding incomplete data)",
     )
+    parser.add_argument(
+        "--decompression-workers",
+        type=int,
+        default=None,
+        help="Decompress bz2 blocks in parallel with this many worker processes (default: single threaded bz2)",
+    )
+    parser.add_argument(
+        "--decompressor",
+        default=None,
+        help='External command that decompresses the input from stdin to stdout, e.g. "lbzip2 -dc"',
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue an interrupted run after the checkpoint in the notes output directory",
+    )
+    parser.add_argument(
+        "--xml-backend",
+        choices=XML_BACKENDS,
+        default="etree",
+        help="XML parser backend, expat fills the columns without building Elements (default: etree)",
+    )
+    parser.add_argument(
+        "--metrics-json",
+        default=None,
+        help="Write a JSON report with the throughput, the time split between the stages and the peak memory "
+        "to this path",
+    )
 
     args = parser.parse_args()
+    if args.decompressor and args.decompression_workers:
+        parser.error("--decompressor can't be combined with --decompression-workers")
+    default_batch_size = 1_000_000 if args.batch_memory_mb is None else sys.maxsize
+    if args.notes_batch_size is None:
+        args.notes_batch_size = default_batch_size
+    if args.comments_batch_size is None:
+        args.comments_batch_size = default_batch_size
 
     # Handle existing output directories
     notes_output_path = Path(args.notes_output_path)
     comments_output_path = Path(args.comments_output_path)
 
-    if notes_output_path.exists():
+    if notes_output_path.exists() and not args.resume:
         if args.overwrite:
             print(f"Removing existing notes directory: {notes_output_path}")
             shutil.rmtree(notes_output_path)
         else:
             raise FileExistsError(
-                f"Notes output directory '{notes_output_path}' already exists. Use --overwrite to delete it or choose a different path."
+                f"Notes output directory '{notes_output_path}' already exists. Use --overwrite to delete it, --resume to continue an interrupted run or choose a different path."
             )
 
-    if comments_output_path.exists():
+    if comments_output_path.exists() and not args.resume:
         if args.overwrite:
             print(f"Removing existing comments directory: {comments_output_path}")
             shutil.rmtree(comments_output_path)
         else:
             raise FileExistsError(
-                f"Comments output directory '{comments_output_path}' already exists. Use --overwrite to delete it or choose a different path."
+                f"Comments output directory '{comments_output_path}' already exists. Use --overwrite to delete it, --resume to continue an interrupted run or choose a different path."
             )
 
-    # Define schemas
-    notes_schema_fields = [
-        pa.field("note_id", pa.int64()),
-        pa.field("lat", pa.float64()),
-        pa.field("lon", pa.float64()),
-        pa.field("created_at", pa.timestamp("us", tz="UTC")),
-        pa.field("closed_at", pa.timestamp("us", tz="UTC")),
-        pa.field("mid_pos_x", pa.int32()),
-        pa.field("mid_pos_y", pa.int32()),
-    ]
-
-    comments_schema_fields = [
-        pa.field("note_id", pa.int64()),
-        pa.field("action", pa.string()),
-        pa.field("timestamp", pa.timestamp("us", tz="UTC")),
-        pa.field("user_name", pa.string()),
-        pa.field("text", pa.string()),
-    ]
-
     if args.ignore_current_month:
         print("Ignoring notes from the current month")
 
-    print(
-        f"Processing {args.notes_path} with notes batch size {args.notes_batch_size} "
-        f"and comments batch size {args.comments_batch_size}..."
-    )
+    if args.batch_memory_mb is None:
+        print(
+            f"Processing {args.notes_path} with notes batch size {args.notes_batch_size} "
+            f"and comments batch size {args.comments_batch_size}..."
+        )
+    else:
+        print(f"Processing {args.notes_path} with batches of up to {args.batch_memory_mb} MB...")
     start_time = time.time()
 
+    metrics = IngestMetrics() if args.metrics_json else None
     notes_parser = NotesParser(
         notes_batch_size=args.notes_batch_size,
         comments_batch_size=args.comments_batch_size,
         notes_output_path=args.notes_output_path,
         comments_output_path=args.comments_output_path,
-        notes_schema=pa.schema(notes_schema_fields),
-        comments_schema=pa.schema(comments_schema_fields),
+        notes_schema=NOTES_SCHEMA,
+        comments_schema=COMMENTS_SCHEMA,
         ignore_current_month=args.ignore_current_month,
+        xml_backend=args.xml_backend,
+        checkpoint_path=notes_output_path / CHECKPOINT_FILE,
+        metrics=metrics,
+        batch_memory_mb=args.batch_memory_mb,
+    )
+    notes_parser.parse_file(
+        args.notes_path,
+        decompression_workers=args.decompression_workers,
+        resume=args.resume,
+        decompressor=args.decompressor,
     )
-    notes_parser.parse_file(args.notes_path)
     notes_parser.finalize()
+    if metrics is not None:
+        notes_parser.write_metrics_report(args.metrics_json)
 
     elapsed_time = time.time() - start_time
     print(f"Processing completed in {int(elapsed_time // 60)}:{int(elapsed_time % 60):02d} minutes")
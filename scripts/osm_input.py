@@ -0,0 +1,554 @@
+import bisect
+import bz2
+import gzip
+import io
+import os
+import shlex
+import struct
+import subprocess
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import pyarrow as pa
+
+BZ2_BLOCK_MAGIC = 0x314159265359
+BZ2_EOS_MAGIC = 0x177245385090
+BZ2_MAGIC_BITS = 48
+
+# a resume position is taken this far before the current read position, so it lies before the start of
+# every element that the XML parser already completed, even with the read ahead of the parser
+RESUME_MARGIN = 16 * 1024 * 1024
+
+# input path that reads the compressed dump from stdin, e.g. while it is still downloading
+STDIN_PATH = "-"
+
+# the compression of an input is detected by the signature at its start
+BZ2_SIGNATURE = b"BZh"
+GZIP_SIGNATURE = b"\x1f\x8b"
+ZSTD_FRAME_MAGIC = 0xFD2FB528
+# zstd skippable frames have the magic numbers 0x184D2A50 to 0x184D2A5F, the seekable format stores its
+# seek table in one at the end of the file, see https://github.com/facebook/zstd/tree/dev/contrib/seekable_format
+ZSTD_SKIPPABLE_MAGIC = 0x184D2A50
+ZSTD_SEEK_TABLE_MAGIC = 0x184D2A5E
+ZSTD_SEEKABLE_MAGIC = 0x8F92EAB1
+ZSTD_SEEK_TABLE_FOOTER = struct.Struct("<IBI")
+
+
+def _magic_search_patterns(magic):
+    """Precompute (shift, needle, first_mask, first_byte, last_mask, last_byte) for each bit shift of a 48 bit magic."""
+    patterns = []
+    for shift in range(8):
+        pattern = (magic << (16 - shift)).to_bytes(8, "big")
+        mask = (((1 << BZ2_MAGIC_BITS) - 1) << (16 - shift)).to_bytes(8, "big")
+        if shift == 0:
+            patterns.append((shift, pattern[0:6], 0, 0, 0, 0))
+        else:
+            patterns.append((shift, pattern[1:6], mask[0], pattern[0], mask[6], pattern[6]))
+    return patterns
+
+
+BZ2_BLOCK_PATTERNS = _magic_search_patterns(BZ2_BLOCK_MAGIC)
+BZ2_EOS_PATTERNS = _magic_search_patterns(BZ2_EOS_MAGIC)
+
+
+def find_bz2_magic_bits(data, patterns):
+    """Return the sorted bit offsets of a bz2 magic in data, the magic can start at any bit of a byte."""
+    positions = []
+    for shift, needle, first_mask, first_byte, last_mask, last_byte in patterns:
+        # for shifts > 0 the needle starts one byte after the first (partially used) byte of the magic
+        needle_offset = 0 if shift == 0 else 1
+        index = data.find(needle)
+        while index != -1:
+            start = index - needle_offset
+            if shift == 0:
+                positions.append(start * 8)
+            elif (
+                start >= 0
+                and start + 6 < len(data)
+                and data[start] & first_mask == first_byte & first_mask
+                and data[start + 6] & last_mask == last_byte & last_mask
+            ):
+                positions.append(start * 8 + shift)
+            index = data.find(needle, index + 1)
+    positions.sort()
+    return positions
+
+
+def _extract_bits(data, start_bit, end_bit):
+    """Return the bits [start_bit, end_bit) of data as an integer."""
+    first_byte = start_bit // 8
+    last_byte = (end_bit + 7) // 8
+    value = int.from_bytes(data[first_byte:last_byte], "big")
+    value >>= last_byte * 8 - end_bit
+    return value & ((1 << (end_bit - start_bit)) - 1)
+
+
+def bz2_block_to_stream(data, start_bit, end_bit):
+    """Wrap the bz2 block at bits [start_bit, end_bit) of data into a standalone single block bz2 stream.
+
+    A block starts with its magic followed by the 32 bit block CRC. The combined CRC of a stream with
+    only one block equals the block CRC, so it can be copied into the end of stream footer.
+    """
+    block_bits = end_bit - start_bit
+    block = _extract_bits(data, start_bit, end_bit)
+    block_crc = (block >> (block_bits - BZ2_MAGIC_BITS - 32)) & 0xFFFFFFFF
+    stream = (((block << BZ2_MAGIC_BITS) | BZ2_EOS_MAGIC) << 32) | block_crc
+    stream_bits = block_bits + BZ2_MAGIC_BITS + 32
+    padding = -stream_bits % 8
+    return b"BZh9" + (stream << padding).to_bytes((stream_bits + padding) // 8, "big")
+
+
+def _decompress_bz2_block(data, start_bit, end_bits):
+    """Decompress the block starting at start_bit, trying each candidate end boundary in order.
+
+    A candidate end can be a false positive (the magic occurring by chance inside compressed data),
+    in which case the block is truncated and fails the CRC check, so the next candidate is tried.
+    """
+    for end_bit in end_bits:
+        try:
+            return bz2.decompress(bz2_block_to_stream(data, start_bit, end_bit)), end_bit
+        except (OSError, ValueError):
+            continue
+    return None, None
+
+
+class ParallelBZ2Reader(io.RawIOBase):
+    """Read-only file object that decompresses a bz2 file block by block on a process pool.
+
+    The compressed input is split at bz2 block boundaries (which are bit aligned), every block is
+    decompressed as an independent stream by a worker and the decompressed blocks are returned in order.
+    Works for single stream files (bzip2, lbzip2) and multi stream files (pbzip2).
+
+    Reading can start at the block at start_bit, start_position is then the decompressed offset of that block.
+    The start bits of the recently returned blocks are kept, so a position can be mapped back to a block.
+    """
+
+    def __init__(
+        self, file_obj, workers, chunk_size=16 * 1024 * 1024, max_pending_blocks=None, start_bit=0, start_position=0
+    ):
+        super().__init__()
+        self.file_obj = file_obj
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.max_pending_blocks = max_pending_blocks or workers * 4
+        self.start_bit = start_bit
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.blocks = self._iter_decompressed_blocks()
+        self.current_block = b""
+        self.current_block_pos = 0
+        self.position = start_position
+        # (decompressed offset, start bit) of the recently returned blocks
+        self.block_starts = deque(maxlen=1024)
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def readinto(self, buffer):
+        while self.current_block_pos >= len(self.current_block):
+            block = next(self.blocks, None)
+            if block is None:
+                return 0
+            start_bit, self.current_block = block
+            self.current_block_pos = 0
+            self.block_starts.append((self.position, start_bit))
+        size = min(len(buffer), len(self.current_block) - self.current_block_pos)
+        buffer[:size] = self.current_block[self.current_block_pos : self.current_block_pos + size]
+        self.current_block_pos += size
+        self.position += size
+        return size
+
+    def block_start(self, position):
+        """Return (decompressed offset, start bit) of the last returned block starting at or before position"""
+        for block_position, start_bit in reversed(self.block_starts):
+            if block_position <= position:
+                return block_position, start_bit
+        return None
+
+    def close(self):
+        if not self.closed:
+            self.blocks.close()
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.file_obj.close()
+        super().close()
+
+    def _iter_block_segments(self):
+        """Yield (data, start_bit, end_bits, absolute_start_bit) for every block of the compressed file."""
+        start_byte = self.start_bit // 8
+        if start_byte:
+            self.file_obj.seek(start_byte)
+        buffer = b""
+        buffer_start_bit = start_byte * 8
+        last_dispatched_bit = self.start_bit - 1
+        while True:
+            chunk = self.file_obj.read(self.chunk_size)
+            at_eof = not chunk
+            buffer += chunk
+
+            block_starts = find_bz2_magic_bits(buffer, BZ2_BLOCK_PATTERNS)
+            boundaries = sorted(block_starts + find_bz2_magic_bits(buffer, BZ2_EOS_PATTERNS))
+            keep_from_bit = boundaries[-1] if boundaries else 0
+            for start_bit in block_starts:
+                if buffer_start_bit + start_bit <= last_dispatched_bit:
+                    continue
+                # pass two candidate ends in case the first one is a false positive
+                end_bits = [bit for bit in boundaries if bit > start_bit][:2]
+                if len(end_bits) < 2 and not (at_eof and end_bits):
+                    keep_from_bit = start_bit
+                    break
+                segment_start_byte = start_bit // 8
+                segment = buffer[segment_start_byte : (end_bits[-1] + 7) // 8]
+                offset_bits = segment_start_byte * 8
+                yield (
+                    segment,
+                    start_bit - offset_bits,
+                    [bit - offset_bits for bit in end_bits],
+                    buffer_start_bit + start_bit,
+                )
+                last_dispatched_bit = buffer_start_bit + start_bit
+
+            if at_eof:
+                return
+            keep_from_byte = keep_from_bit // 8
+            buffer = buffer[keep_from_byte:]
+            buffer_start_bit += keep_from_byte * 8
+
+    def _iter_decompressed_blocks(self):
+        """Yield (start_bit, data) of the decompressed blocks in file order with a bounded number of blocks in flight."""
+        pending = deque()
+        decompressed_until_bit = -1
+        segments = self._iter_block_segments()
+        while True:
+            for segment, start_bit, end_bits, absolute_start_bit in segments:
+                future = self.executor.submit(_decompress_bz2_block, segment, start_bit, end_bits)
+                pending.append((future, absolute_start_bit - start_bit, absolute_start_bit))
+                if len(pending) >= self.max_pending_blocks:
+                    break
+            if not pending:
+                return
+
+            future, segment_offset_bit, absolute_start_bit = pending.popleft()
+            data, end_bit = future.result()
+            # a block starting inside an already decompressed block was a false positive magic
+            if absolute_start_bit < decompressed_until_bit:
+                continue
+            if data is None:
+                raise OSError(f"Invalid bz2 block at bit offset {absolute_start_bit}")
+            decompressed_until_bit = segment_offset_bit + end_bit
+            yield absolute_start_bit, data
+
+
+def input_position(file_handle):
+    """Return a position to resume reading from, which lies before every element that was already parsed.
+
+    The position has the decompressed offset and, if the parallel reader is used, the start bit of the bz2
+    block at that offset, so resuming can start at that block instead of decompressing everything before it.
+    """
+    position = max(0, file_handle.tell() - RESUME_MARGIN)
+    if isinstance(file_handle, ParallelBZ2Reader):
+        block_start = file_handle.block_start(position)
+        if block_start is not None:
+            return {"decompressed_offset": block_start[0], "block_bit_offset": block_start[1]}
+    return {"decompressed_offset": position, "block_bit_offset": None}
+
+
+class _PrefixedStream(io.RawIOBase):
+    """Read-only stream that returns the prefix bytes followed by the rest of the file handle"""
+
+    def __init__(self, prefix, file_handle):
+        super().__init__()
+        self.prefix = prefix
+        self.file_handle = file_handle
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.prefix:
+            size = min(len(buffer), len(self.prefix))
+            buffer[:size] = self.prefix[:size]
+            self.prefix = self.prefix[size:]
+            return size
+        data = self.file_handle.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+
+def resync_stream(file_handle, element_start, root=b"osm", read_size=1024 * 1024):
+    """Skip to the first element_start (e.g. b"<changeset ") and prepend the start tag of the root element.
+
+    This makes a stream that was opened in the middle of a document parseable again.
+    """
+    buffer = b""
+    while True:
+        chunk = file_handle.read(read_size)
+        buffer += chunk
+        index = buffer.find(element_start)
+        if index != -1:
+            return io.BufferedReader(_PrefixedStream(b"<" + root + b">" + buffer[index:], file_handle))
+        if not chunk:
+            return io.BytesIO(b"<" + root + b"></" + root + b">")
+        buffer = buffer[-len(element_start) :]
+
+
+def _skip(file_handle, size, read_size=1024 * 1024):
+    """Read and discard the next size bytes of a stream"""
+    while size > 0:
+        chunk = file_handle.read(min(size, read_size))
+        if not chunk:
+            return
+        size -= len(chunk)
+
+
+class DecompressorStream(io.RawIOBase):
+    """Read-only stream of the output of an external decompressor command like "lbzip2 -dc".
+
+    The compressed input is passed to the stdin of the command, directly if it has a file descriptor and
+    otherwise by a thread that copies it. A failing command raises CalledProcessError once its output is read.
+    """
+
+    def __init__(self, command, compressed_input, close_input=False, copy_size=1024 * 1024):
+        super().__init__()
+        self.command = command
+        self.compressed_input = compressed_input
+        self.close_input = close_input
+        self.position = 0
+        self.at_eof = False
+        self.copy_thread = None
+        try:
+            stdin = compressed_input.fileno()
+        except (AttributeError, OSError):
+            stdin = subprocess.PIPE
+        self.process = subprocess.Popen(shlex.split(command), stdin=stdin, stdout=subprocess.PIPE)
+        if stdin == subprocess.PIPE:
+            self.copy_thread = threading.Thread(
+                target=self._copy_input, args=(compressed_input, copy_size), name="decompressor-input", daemon=True
+            )
+            self.copy_thread.start()
+
+    def _copy_input(self, compressed_input, copy_size):
+        try:
+            while chunk := compressed_input.read(copy_size):
+                self.process.stdin.write(chunk)
+            self.process.stdin.close()
+        except (BrokenPipeError, ValueError):
+            # the command stopped reading, its exit code is checked by the reader
+            pass
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def readinto(self, buffer):
+        size = self.process.stdout.readinto(buffer)
+        if size == 0 and len(buffer) > 0:
+            self.at_eof = True
+            return_code = self.process.wait()
+            if return_code != 0:
+                raise subprocess.CalledProcessError(return_code, self.command)
+        self.position += size
+        return size
+
+    def close(self):
+        if not self.closed:
+            # the process is stopped if reading ended early, e.g. because of an error in the parser
+            if not self.at_eof:
+                self.process.kill()
+            self.process.stdout.close()
+            self.process.wait()
+            if self.copy_thread is not None:
+                self.copy_thread.join()
+            if self.close_input:
+                self.compressed_input.close()
+        super().close()
+
+
+def detect_compression(header):
+    """Return "bz2", "gzip", "zstd" or None (uncompressed) for the first 4 bytes of an input"""
+    if header.startswith(BZ2_SIGNATURE):
+        return "bz2"
+    if header.startswith(GZIP_SIGNATURE):
+        return "gzip"
+    if len(header) >= 4:
+        magic = int.from_bytes(header[:4], "little")
+        if magic == ZSTD_FRAME_MAGIC or magic & 0xFFFFFFF0 == ZSTD_SKIPPABLE_MAGIC:
+            return "zstd"
+    return None
+
+
+def read_zstd_seek_table(file_obj):
+    """Return the (compressed offset, decompressed offset) of every frame of a seekable zstd file.
+
+    Returns None if the file has no seek table. The file position is reset to the start.
+    """
+    file_size = file_obj.seek(0, os.SEEK_END)
+    frames = None
+    if file_size >= ZSTD_SEEK_TABLE_FOOTER.size:
+        file_obj.seek(file_size - ZSTD_SEEK_TABLE_FOOTER.size)
+        frame_count, descriptor, magic = ZSTD_SEEK_TABLE_FOOTER.unpack(file_obj.read(ZSTD_SEEK_TABLE_FOOTER.size))
+        # entries have an optional checksum
+        entry_size = 12 if descriptor & 0x80 else 8
+        table_size = frame_count * entry_size
+        if magic == ZSTD_SEEKABLE_MAGIC and table_size + ZSTD_SEEK_TABLE_FOOTER.size <= file_size:
+            file_obj.seek(file_size - ZSTD_SEEK_TABLE_FOOTER.size - table_size)
+            entries = file_obj.read(table_size)
+            frames = []
+            compressed_offset = decompressed_offset = 0
+            for index in range(frame_count):
+                compressed_size, decompressed_size = struct.unpack_from("<II", entries, index * entry_size)
+                frames.append((compressed_offset, decompressed_offset))
+                compressed_offset += compressed_size
+                decompressed_offset += decompressed_size
+    file_obj.seek(0)
+    return frames
+
+
+def find_zstd_frame(frames, decompressed_offset):
+    """Return (compressed offset, decompressed offset) of the frame that contains the decompressed offset"""
+    index = bisect.bisect_right(frames, decompressed_offset, key=lambda frame: frame[1]) - 1
+    return frames[max(index, 0)]
+
+
+class DecompressedStream(io.RawIOBase):
+    """Read-only stream of a bz2, gzip, zstd or uncompressed input that keeps track of its decompressed position.
+
+    start_position is the decompressed offset of the start of the compressed input, e.g. of a zstd frame.
+    """
+
+    def __init__(self, compressed_input, compression, start_position=0):
+        super().__init__()
+        self.compressed_input = compressed_input
+        if compression == "bz2":
+            self.stream = bz2.BZ2File(compressed_input)
+        elif compression == "gzip":
+            self.stream = gzip.GzipFile(fileobj=compressed_input)
+        elif compression == "zstd":
+            # concatenated frames and skippable frames like the seek table are handled by the zstd stream
+            self.stream = pa.CompressedInputStream(pa.PythonFile(compressed_input, mode="r"), "zstd")
+        else:
+            self.stream = compressed_input
+        self.position = start_position
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def readinto(self, buffer):
+        size = self.stream.readinto(buffer)
+        self.position += size
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.stream.close()
+            self.compressed_input.close()
+        super().close()
+
+
+def is_file_path(file_input):
+    """Check if the input of open_input is a file path, and not stdin or a file object"""
+    return isinstance(file_input, (str, os.PathLike)) and file_input != STDIN_PATH
+
+
+def _open_compressed(file_input):
+    if file_input == STDIN_PATH:
+        return sys.stdin.buffer
+    if is_file_path(file_input):
+        return open(file_input, "rb")
+    # the signature is read with peek, so it stays in the stream
+    if not hasattr(file_input, "peek"):
+        return io.BufferedReader(file_input)
+    return file_input
+
+
+def _read_signature(compressed_input):
+    """Return the first 4 bytes of the input and the input to read from, which still starts with them.
+
+    peek returns only what one read of a pipe gave, which can be less than 4 bytes. Then the signature is read
+    until there are 4 bytes or the input ends, and put in front of the rest of the input again.
+    """
+    header = compressed_input.peek(4)[:4]
+    if len(header) == 4:
+        return header, compressed_input
+    header = compressed_input.read(4)
+    return header, io.BufferedReader(_PrefixedStream(header, compressed_input))
+
+
+def _zstd_start_frame(compressed_input, file_input, position):
+    """Return the (compressed offset, decompressed offset) of the zstd frame to start reading a position from"""
+    if position is None or not is_file_path(file_input):
+        return None
+    frames = read_zstd_seek_table(compressed_input)
+    if not frames:
+        return None
+    return find_zstd_frame(frames, position["decompressed_offset"])
+
+
+def open_input(file_input, decompression_workers=None, position=None, decompressor=None):
+    """Open a compressed OSM dump for reading.
+
+    The input is a file path, "-" for stdin or a binary file object, so a dump can be parsed while it is
+    still downloading. The compression (bz2, gzip, zstd or none) is detected by the signature of the input.
+    With a decompressor command (e.g. "lbzip2 -dc") that command decompresses the input. bz2 inputs are
+    decompressed in parallel worker processes if decompression_workers is set.
+
+    With a position from input_position, reading starts at that position, directly at the recorded bz2 block
+    or at the frame of a seekable zstd file (see transcode_to_zstd.py), otherwise by skipping the data before it.
+    """
+    compressed_input = _open_compressed(file_input)
+    if decompressor:
+        file_handle = DecompressorStream(decompressor, compressed_input, close_input=is_file_path(file_input))
+        if position is not None:
+            _skip(file_handle, position["decompressed_offset"])
+        return file_handle
+
+    header, compressed_input = _read_signature(compressed_input)
+    compression = detect_compression(header)
+    skip_size = 0 if position is None else position["decompressed_offset"]
+    if compression == "bz2" and decompression_workers:
+        if position is not None and position["block_bit_offset"] is not None and is_file_path(file_input):
+            return ParallelBZ2Reader(
+                compressed_input,
+                decompression_workers,
+                start_bit=position["block_bit_offset"],
+                start_position=position["decompressed_offset"],
+            )
+        file_handle = ParallelBZ2Reader(compressed_input, decompression_workers)
+    elif compression == "zstd" and (start_frame := _zstd_start_frame(compressed_input, file_input, position)):
+        compressed_input.seek(start_frame[0])
+        file_handle = DecompressedStream(compressed_input, compression, start_position=start_frame[1])
+        skip_size -= start_frame[1]
+    elif compression is None and position is not None and is_file_path(file_input):
+        compressed_input.seek(skip_size)
+        file_handle = DecompressedStream(compressed_input, compression, start_position=skip_size)
+        skip_size = 0
+    else:
+        file_handle = DecompressedStream(compressed_input, compression)
+    _skip(file_handle, skip_size)
+    return file_handle
+
+
+def input_compressed_size(file_input, decompression_workers=None, position=None):
+    """Number of compressed bytes that open_input reads from the file, None if the input is not a file"""
+    if not is_file_path(file_input):
+        return None
+    file_size = os.path.getsize(file_input)
+    if position is None:
+        return file_size
+    with open(file_input, "rb") as compressed_input:
+        compression = detect_compression(compressed_input.read(4))
+        if compression == "bz2" and decompression_workers and position["block_bit_offset"] is not None:
+            return file_size - position["block_bit_offset"] // 8
+        if compression == "zstd" and (start_frame := _zstd_start_frame(compressed_input, file_input, position)):
+            return file_size - start_frame[0]
+        if compression is None:
+            return file_size - position["decompressed_offset"]
+    return file_size
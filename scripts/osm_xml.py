@@ -0,0 +1,164 @@
+import xml.etree.ElementTree as ET
+from xml.parsers import expat
+
+XML_BACKENDS = ("etree", "expat")
+EXPAT_READ_SIZE = 1024 * 1024
+
+# Both backends yield the same plain Python records:
+#   changesets: (attribs, tags, comments) with comments as a list of (comment_attribs, text)
+#   notes: (attribs, comments) with comments as a list of (comment_attribs, text)
+
+
+def _iter_etree_changesets(file_handle):
+    """Reference implementation using ElementTree.iterparse"""
+    for event, elem in ET.iterparse(file_handle, events=("end",)):
+        if elem.tag != "changeset":
+            continue
+        tags = {}
+        comments = []
+        for child in elem:
+            if child.tag == "tag":
+                tags[child.attrib.get("k", "")] = child.attrib.get("v", "")
+            elif child.tag == "discussion":
+                for comment_elem in child:
+                    if comment_elem.tag == "comment":
+                        comment_text = ""
+                        for text_elem in comment_elem:
+                            if text_elem.tag == "text":
+                                comment_text = text_elem.text or ""
+                                break
+                        comments.append((comment_elem.attrib, comment_text))
+        yield elem.attrib, tags, comments
+        # Clear the element to free memory
+        elem.clear()
+
+
+def _iter_etree_notes(file_handle):
+    """Reference implementation using ElementTree.iterparse"""
+    for event, elem in ET.iterparse(file_handle, events=("end",)):
+        if elem.tag != "note":
+            continue
+        comments = [(child.attrib, child.text or "") for child in elem if child.tag == "comment"]
+        yield elem.attrib, comments
+        elem.clear()
+
+
+def _iter_expat_records(file_handle, parser, records):
+    """Feed the stream to the expat parser and yield the records the callbacks completed after each read."""
+    while chunk := file_handle.read(EXPAT_READ_SIZE):
+        parser.Parse(chunk, False)
+        yield from records
+        records.clear()
+    parser.Parse(b"", True)
+    yield from records
+
+
+def _create_expat_parser():
+    parser = expat.ParserCreate()
+    parser.buffer_text = True
+    return parser
+
+
+# Every Python callback costs about as much as building the Element in C, so the expat backends only
+# register the end element and character data handlers while they are inside a discussion or comment.
+# A record is completed when the next one starts or the document ends.
+
+
+def _iter_expat_changesets(file_handle):
+    """Callback based implementation that collects the values without building Elements"""
+    parser = _create_expat_parser()
+    records = []
+    changeset = None
+    comment_attribs = None
+    comment_text = None
+    text_parts = None
+
+    def start_element(name, attribs):
+        nonlocal changeset, comment_attribs, comment_text, text_parts
+        if name == "tag":
+            if changeset is not None:
+                changeset[1][attribs.get("k", "")] = attribs.get("v", "")
+        elif name == "changeset":
+            if changeset is not None:
+                records.append(changeset)
+            changeset = (attribs, {}, [])
+        elif changeset is None:
+            return
+        elif name == "discussion":
+            parser.EndElementHandler = end_discussion_element
+        elif name == "comment":
+            comment_attribs = attribs
+            comment_text = None
+        elif name == "text" and comment_attribs is not None and comment_text is None:
+            text_parts = []
+            parser.CharacterDataHandler = text_parts.append
+
+    def end_discussion_element(name):
+        nonlocal comment_attribs, comment_text, text_parts
+        if name == "text" and text_parts is not None:
+            comment_text = "".join(text_parts)
+            text_parts = None
+            parser.CharacterDataHandler = None
+        elif name == "comment" and comment_attribs is not None:
+            changeset[2].append((comment_attribs, comment_text or ""))
+            comment_attribs = None
+        elif name == "discussion":
+            parser.EndElementHandler = None
+
+    parser.StartElementHandler = start_element
+    yield from _iter_expat_records(file_handle, parser, records)
+    if changeset is not None:
+        yield changeset
+
+
+def _iter_expat_notes(file_handle):
+    """Callback based implementation that collects the values without building Elements"""
+    parser = _create_expat_parser()
+    records = []
+    note = None
+    comment_attribs = None
+    text_parts = None
+
+    def start_element(name, attribs):
+        nonlocal note, comment_attribs, text_parts
+        if name == "note":
+            if note is not None:
+                records.append(note)
+            note = (attribs, [])
+        elif name == "comment" and note is not None:
+            comment_attribs = attribs
+            text_parts = []
+            parser.CharacterDataHandler = text_parts.append
+            parser.EndElementHandler = end_comment_element
+
+    def end_comment_element(name):
+        nonlocal comment_attribs, text_parts
+        if name == "comment":
+            note[1].append((comment_attribs, "".join(text_parts)))
+            comment_attribs = None
+            text_parts = None
+            parser.CharacterDataHandler = None
+            parser.EndElementHandler = None
+
+    parser.StartElementHandler = start_element
+    yield from _iter_expat_records(file_handle, parser, records)
+    if note is not None:
+        yield note
+
+
+def iter_changesets(file_handle, backend="etree"):
+    """Iterate over the changesets of a decompressed OSM changeset XML stream."""
+    if backend == "etree":
+        return _iter_etree_changesets(file_handle)
+    if backend == "expat":
+        return _iter_expat_changesets(file_handle)
+    raise ValueError(f"Unknown XML backend '{backend}', choose one of {', '.join(XML_BACKENDS)}")
+
+
+def iter_notes(file_handle, backend="etree"):
+    """Iterate over the notes of a decompressed OSM notes XML stream."""
+    if backend == "etree":
+        return _iter_etree_notes(file_handle)
+    if backend == "expat":
+        return _iter_expat_notes(file_handle)
+    raise ValueError(f"Unknown XML backend '{backend}', choose one of {', '.join(XML_BACKENDS)}")
@@ -0,0 +1,84 @@
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+# DuckDB parallelizes the scan of a Parquet file over its row groups, this is also its own default size
+DEFAULT_ROW_GROUP_SIZE = 122_880
+
+
+class PartitionedParquetWriter:
+    """Append batches to one open Parquet file per year/month partition instead of new files for every batch.
+
+    The input is expected to be ordered by time (like the changesets in the dump, which are ordered by id),
+    so a partition is closed once a batch only contains later months. Rows are collected per partition until
+    a full row group of row_group_size rows can be written. If rows of an already closed partition arrive,
+    they are written into an additional file of that partition.
+    """
+
+    def __init__(self, root_path, schema, row_group_size=DEFAULT_ROW_GROUP_SIZE, file_prefix="part-"):
+        self.root_path = Path(root_path)
+        self.schema = pa.schema([field for field in schema if field.name not in ("year", "month")])
+        self.row_group_size = row_group_size
+        self.file_prefix = file_prefix
+        # (year, month) -> [ParquetWriter, list of pending tables, number of pending rows]
+        self.open_partitions = {}
+        self.file_counts = {}
+
+    def _open_partition(self, partition):
+        year, month = partition
+        file_number = self.file_counts.get(partition, 0)
+        if file_number > 0:
+            print(f"Partition year={year}/month={month} was already closed, writing its new rows to another file")
+        self.file_counts[partition] = file_number + 1
+        partition_dir = self.root_path / f"year={year}" / f"month={month}"
+        partition_dir.mkdir(parents=True, exist_ok=True)
+        parquet_writer = pq.ParquetWriter(partition_dir / f"{self.file_prefix}{file_number}.parquet", self.schema)
+        self.open_partitions[partition] = [parquet_writer, [], 0]
+
+    def _write_row_groups(self, partition, flush=False):
+        """Write the pending rows of a partition in full row groups, with flush=True also the remaining rows"""
+        parquet_writer, pending_tables, pending_rows = self.open_partitions[partition]
+        if pending_rows < self.row_group_size and not (flush and pending_rows > 0):
+            return
+        pending = pa.concat_tables(pending_tables)
+        full_rows = pending_rows if flush else pending_rows - pending_rows % self.row_group_size
+        parquet_writer.write_table(pending.slice(0, full_rows), row_group_size=self.row_group_size)
+        remaining = pending.slice(full_rows)
+        self.open_partitions[partition] = [
+            parquet_writer,
+            [remaining] if remaining.num_rows else [],
+            remaining.num_rows,
+        ]
+
+    def _close_partition(self, partition):
+        self._write_row_groups(partition, flush=True)
+        self.open_partitions.pop(partition)[0].close()
+
+    def write_table(self, table):
+        """Append the rows of a table with year and month columns to their partitions"""
+        if table.num_rows == 0:
+            return
+        partition_keys = pc.add(
+            pc.multiply(pc.cast(table["year"], pa.int32()), 100), pc.cast(table["month"], pa.int32())
+        )
+        sorted_keys = sorted(pc.unique(partition_keys).to_pylist())
+        for partition_key in sorted_keys:
+            partition = divmod(partition_key, 100)
+            rows = table.filter(pc.equal(partition_keys, partition_key)).drop_columns(["year", "month"])
+            if partition not in self.open_partitions:
+                self._open_partition(partition)
+            self.open_partitions[partition][1].append(rows.cast(self.schema))
+            self.open_partitions[partition][2] += rows.num_rows
+            self._write_row_groups(partition)
+
+        # the input moved past the partitions before the earliest month of this batch
+        first_partition = divmod(sorted_keys[0], 100)
+        for partition in sorted(self.open_partitions):
+            if partition < first_partition:
+                self._close_partition(partition)
+
+    def close(self):
+        for partition in sorted(self.open_partitions):
+            self._close_partition(partition)
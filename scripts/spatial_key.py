@@ -0,0 +1,107 @@
+# the longitude and the latitude are both quantized to 2^16 cells, about 0.0055 x 0.0027 degrees
+SPATIAL_KEY_BITS = 16
+SPATIAL_KEY_CELLS = 1 << SPATIAL_KEY_BITS
+# order of the enriched changesets of a year-month with --sort-by-spatial-key, changesets without bbox are last
+SPATIAL_KEY_ORDER_BY = "spatial_key, changeset_id"
+# the number of key ranges of get_bbox_filter_sql, more ranges skip more row groups but make the filter longer
+MAX_KEY_RANGES = 32
+# the bits of the longitude and of the latitude cell in the key
+X_BITS = 0x55555555
+Y_BITS = 0xAAAAAAAA
+
+
+def _spread_bits_sql(value_sql):
+    # move the 16 bits of the value to the even bits of a 32 bit integer
+    for shift, mask in [(8, 0x00FF00FF), (4, 0x0F0F0F0F), (2, 0x33333333), (1, 0x55555555)]:
+        value_sql = f"(({value_sql} | ({value_sql} << {shift})) & {mask})"
+    return value_sql
+
+
+def _cell_sql(coordinate_sql, min_value, max_value):
+    cell_sql = f"floor(({coordinate_sql} - {min_value}) / {max_value - min_value} * {SPATIAL_KEY_CELLS})"
+    # least() would ignore NULL, so the maximum coordinate is moved into the last cell with a CASE
+    return f"(CASE WHEN {cell_sql} >= {SPATIAL_KEY_CELLS} THEN {SPATIAL_KEY_CELLS - 1} ELSE {cell_sql} END)::BIGINT"
+
+
+def get_spatial_key_sql(lon_sql, lat_sql):
+    """Generate SQL for the Morton (Z-order) key of a position, NULL if the position is NULL.
+
+    The bits of the longitude cell are the even bits of the key and the bits of the latitude cell the odd bits,
+    so positions that are close to each other mostly have close keys and sorting by the key keeps regions together.
+    """
+    return (
+        f"({_spread_bits_sql(_cell_sql(lon_sql, -180, 180))} | ({_spread_bits_sql(_cell_sql(lat_sql, -90, 90))} << 1))"
+    )
+
+
+def _cell(coordinate, min_value, max_value):
+    cell = int((coordinate - min_value) / (max_value - min_value) * SPATIAL_KEY_CELLS)
+    return max(min(cell, SPATIAL_KEY_CELLS - 1), 0)
+
+
+def _interleave(x, y):
+    return sum(((x >> bit) & 1) << (2 * bit) | ((y >> bit) & 1) << (2 * bit + 1) for bit in range(SPATIAL_KEY_BITS))
+
+
+def get_spatial_key(lon, lat):
+    """Morton key of a position, like get_spatial_key_sql"""
+    return _interleave(_cell(lon, -180, 180), _cell(lat, -90, 90))
+
+
+def get_spatial_key_ranges(min_lon, min_lat, max_lon, max_lat, max_ranges=MAX_KEY_RANGES):
+    """Return sorted (first key, last key) ranges that contain all keys of a bounding box.
+
+    The quadtree cells of the key that overlap the bounding box are split as long as there are at most max_ranges
+    cells, the cells that are only partly inside add keys outside of the bounding box to the ranges.
+    """
+    min_x, max_x = _cell(min_lon, -180, 180), _cell(max_lon, -180, 180)
+    min_y, max_y = _cell(min_lat, -90, 90), _cell(max_lat, -90, 90)
+    # a quadtree cell is (x, y, level) with 2^level x 2^level key cells starting at x, y, its keys are consecutive
+    ranges = []
+    partial_cells = [(0, 0, SPATIAL_KEY_BITS)]
+    while partial_cells and partial_cells[0][2] > 0 and len(ranges) + 4 * len(partial_cells) <= max_ranges:
+        children = []
+        for x, y, level in partial_cells:
+            size = 1 << (level - 1)
+            for child_x, child_y in [(x, y), (x + size, y), (x, y + size), (x + size, y + size)]:
+                if child_x > max_x or child_x + size <= min_x or child_y > max_y or child_y + size <= min_y:
+                    continue
+                if (
+                    min_x <= child_x
+                    and child_x + size <= max_x + 1
+                    and min_y <= child_y
+                    and child_y + size <= max_y + 1
+                ):
+                    ranges.append((_interleave(child_x, child_y), _interleave(child_x, child_y) + size * size - 1))
+                else:
+                    children.append((child_x, child_y, level - 1))
+        partial_cells = children
+    ranges += [(_interleave(x, y), _interleave(x, y) + (1 << (2 * level)) - 1) for x, y, level in partial_cells]
+    merged_ranges = []
+    for first_key, last_key in sorted(ranges):
+        if merged_ranges and merged_ranges[-1][1] + 1 == first_key:
+            merged_ranges[-1] = (merged_ranges[-1][0], last_key)
+        else:
+            merged_ranges.append((first_key, last_key))
+    return merged_ranges
+
+
+def get_bbox_filter_sql(min_lon, min_lat, max_lon, max_lat, column_name="spatial_key", max_ranges=MAX_KEY_RANGES):
+    """Generate a filter for the rows whose key cell is in a bounding box.
+
+    The key ranges of get_spatial_key_ranges are pushed down into the Parquet scan, so DuckDB skips the row groups
+    of files sorted by the key with their min/max statistics. Then the cells of the key are compared with the
+    bounding box, so the filter is exact up to a cell.
+    """
+    ranges = get_spatial_key_ranges(min_lon, min_lat, max_lon, max_lat, max_ranges)
+    if not ranges:
+        return "false"
+    range_sql = " OR ".join(f"{column_name} BETWEEN {first_key} AND {last_key}" for first_key, last_key in ranges)
+    # the spread bits of a cell keep its order, so the cells are compared without decoding them from the key
+    min_x, max_x = _interleave(_cell(min_lon, -180, 180), 0), _interleave(_cell(max_lon, -180, 180), 0)
+    min_y, max_y = _interleave(0, _cell(min_lat, -90, 90)), _interleave(0, _cell(max_lat, -90, 90))
+    return (
+        f"{column_name} BETWEEN {ranges[0][0]} AND {ranges[-1][1]} AND ({range_sql}) "
+        f"AND {column_name} & {X_BITS} BETWEEN {min_x} AND {max_x} "
+        f"AND {column_name} & {Y_BITS} BETWEEN {min_y} AND {max_y}"
+    )
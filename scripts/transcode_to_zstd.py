@@ -0,0 +1,124 @@
+import argparse
+import struct
+import time
+from pathlib import Path
+
+import pyarrow as pa
+from osm_input import (
+    STDIN_PATH,
+    ZSTD_SEEK_TABLE_FOOTER,
+    ZSTD_SEEK_TABLE_MAGIC,
+    ZSTD_SEEKABLE_MAGIC,
+    open_input,
+)
+
+# smaller frames allow seeking closer to a position, larger frames compress slightly better
+DEFAULT_FRAME_SIZE = 4 * 1024 * 1024
+
+
+def zstd_seek_table(frame_sizes):
+    """Create the skippable frame with the seek table of the zstd seekable format.
+
+    frame_sizes is a list of (compressed size, decompressed size) of every frame, checksums are not stored.
+    """
+    entries = b"".join(struct.pack("<II", compressed_size, size) for compressed_size, size in frame_sizes)
+    footer = ZSTD_SEEK_TABLE_FOOTER.pack(len(frame_sizes), 0, ZSTD_SEEKABLE_MAGIC)
+    return struct.pack("<II", ZSTD_SEEK_TABLE_MAGIC, len(entries) + len(footer)) + entries + footer
+
+
+def _read_frame(file_handle, frame_size):
+    """Read frame_size bytes of the decompressed input, less only at its end"""
+    chunks = []
+    remaining = frame_size
+    while remaining > 0:
+        chunk = file_handle.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+
+def transcode_to_zstd(
+    input_path, output_path, frame_size=DEFAULT_FRAME_SIZE, level=3, decompression_workers=None, decompressor=None
+):
+    """Decompress an OSM dump once and write it as seekable zstd file with independent frames.
+
+    Every frame holds frame_size bytes of the decompressed dump, the seek table at the end of the file maps
+    the frames to their compressed and decompressed offsets, so open_input can start at the frame of a position.
+    The file can also be read by every zstd decoder. Returns the number of frames.
+    """
+    codec = pa.Codec("zstd", compression_level=level)
+    frame_sizes = []
+    output_path = Path(output_path)
+    temp_path = output_path.with_name(f"{output_path.name}.tmp")
+    with open_input(input_path, decompression_workers, decompressor=decompressor) as input_handle:
+        with open(temp_path, "wb") as output_file:
+            while data := _read_frame(input_handle, frame_size):
+                frame = codec.compress(data, asbytes=True)
+                output_file.write(frame)
+                frame_sizes.append((len(frame), len(data)))
+            output_file.write(zstd_seek_table(frame_sizes))
+    temp_path.replace(output_path)
+    return len(frame_sizes)
+
+
+def get_default_output_path(input_path):
+    path = Path(input_path)
+    if path.suffix in (".bz2", ".gz"):
+        path = path.with_suffix("")
+    return path.with_name(f"{path.name}.zst")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Transcode an OSM changeset or notes dump into a seekable zstd file, which is much faster to "
+        "decompress than bz2 on repeated runs of the ingest scripts"
+    )
+    parser.add_argument("input_path", help="Path to the dump (bz2, gzip, zstd or uncompressed) or - to read stdin")
+    parser.add_argument(
+        "--output", help="Path of the zstd file (default: the input path with .zst instead of .bz2 or .gz)"
+    )
+    parser.add_argument(
+        "--frame-size-mb",
+        type=float,
+        default=DEFAULT_FRAME_SIZE / 1024 / 1024,
+        help=f"Decompressed size of every zstd frame (default: {DEFAULT_FRAME_SIZE // 1024 // 1024})",
+    )
+    parser.add_argument("--level", type=int, default=3, help="zstd compression level (default: 3)")
+    parser.add_argument(
+        "--decompression-workers",
+        type=int,
+        default=None,
+        help="Decompress bz2 blocks in parallel with this many worker processes (default: single threaded bz2)",
+    )
+    parser.add_argument(
+        "--decompressor",
+        default=None,
+        help='External command that decompresses the input from stdin to stdout, e.g. "lbzip2 -dc"',
+    )
+    args = parser.parse_args()
+    if args.decompressor and args.decompression_workers:
+        parser.error("--decompressor can't be combined with --decompression-workers")
+    if args.input_path == STDIN_PATH and args.output is None:
+        parser.error("--output is needed when reading from stdin")
+
+    start_time = time.time()
+    output_path = args.output or get_default_output_path(args.input_path)
+    frame_count = transcode_to_zstd(
+        args.input_path,
+        output_path,
+        frame_size=int(args.frame_size_mb * 1024 * 1024),
+        level=args.level,
+        decompression_workers=args.decompression_workers,
+        decompressor=args.decompressor,
+    )
+    elapsed_time = time.time() - start_time
+    print(
+        f"Saved {frame_count} zstd frames to {output_path} "
+        f"in {int(elapsed_time // 60)}:{int(elapsed_time % 60):02d} minutes"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -19,6 +19,58 @@ for year_folder in $CHANGESET_DATA_DIR/year=*; do
     fi
 done
 
+# Upload changeset rollups (partitioned like the changeset data, only the enriched months exist locally)
+CHANGESET_ROLLUPS_DIR="./changeset_rollups"
+if [ -d "$CHANGESET_ROLLUPS_DIR" ]; then
+    echo "Uploading changeset rollups..."
+
+    uv run hf upload "$REPO_ID" "$CHANGESET_ROLLUPS_DIR" "changeset_rollups" \
+        --repo-type=dataset \
+        --commit-message="Add changeset rollups"
+
+    echo "Finished changeset rollups"
+    echo "---"
+fi
+
+# Upload changeset sketches
+CHANGESET_SKETCHES_DIR="./changeset_sketches"
+if [ -d "$CHANGESET_SKETCHES_DIR" ]; then
+    echo "Uploading changeset sketches..."
+
+    uv run hf upload "$REPO_ID" "$CHANGESET_SKETCHES_DIR" "changeset_sketches" \
+        --repo-type=dataset \
+        --commit-message="Add changeset sketches"
+
+    echo "Finished changeset sketches"
+    echo "---"
+fi
+
+# Upload changeset bridge tables
+CHANGESET_BRIDGES_DIR="./changeset_bridges"
+if [ -d "$CHANGESET_BRIDGES_DIR" ]; then
+    echo "Uploading changeset bridge tables..."
+
+    uv run hf upload "$REPO_ID" "$CHANGESET_BRIDGES_DIR" "changeset_bridges" \
+        --repo-type=dataset \
+        --commit-message="Add changeset bridge tables"
+
+    echo "Finished changeset bridge tables"
+    echo "---"
+fi
+
+# Upload the code table of the coded changeset columns (only written with --code-table)
+CHANGESET_CODES_DIR="./changeset_codes"
+if [ -d "$CHANGESET_CODES_DIR" ]; then
+    echo "Uploading changeset code table..."
+
+    uv run hf upload "$REPO_ID" "$CHANGESET_CODES_DIR" "changeset_codes" \
+        --repo-type=dataset \
+        --commit-message="Add changeset code table"
+
+    echo "Finished changeset code table"
+    echo "---"
+fi
+
 # Upload changeset comments data
 CHANGESET_COMMENTS_DATA_DIR="./changeset_comments_data"
 if [ -d "$CHANGESET_COMMENTS_DATA_DIR" ]; then
@@ -58,4 +110,17 @@ if [ -d "$NOTES_COMMENTS_DATA_DIR" ]; then
     echo "---"
 fi
 
+# Upload user dimension
+USER_DIM_DIR="./user_dim"
+if [ -d "$USER_DIM_DIR" ]; then
+    echo "Uploading user dimension..."
+
+    uv run hf upload "$REPO_ID" "$USER_DIM_DIR" "user_dim" \
+        --repo-type=dataset \
+        --commit-message="Add user dimension"
+
+    echo "Finished user dimension"
+    echo "---"
+fi
+
 echo "All uploads complete!"
\ No newline at end of file
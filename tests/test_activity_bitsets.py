@@ -0,0 +1,73 @@
+import os
+import sys
+
+import numpy as np
+import pyarrow as pa
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+import activity_bitsets
+
+
+def test_pack_and_unpack_bitsets():
+    month_indexes = pa.array([[0, 9], [], None, [15, 3]], pa.list_(pa.int64()))
+    bitsets = activity_bitsets.pack_month_indexes(month_indexes, 2)
+    assert bitsets.to_pylist() == [b"\x01\x02", b"\x00\x00", b"\x00\x00", b"\x08\x80"]
+    # a shorter bitset of an earlier month and a null one are padded
+    bits = activity_bitsets.unpack_bitsets(pa.concat_arrays([bitsets, pa.array([b"\x10", None], pa.binary())]))
+    assert bits.shape == (6, 2)
+    assert activity_bitsets.first_month_indexes(bits).tolist() == [0, -1, -1, 3, 4, -1]
+    assert activity_bitsets.last_month_indexes(bits).tolist() == [9, -1, -1, 15, 4, -1]
+
+
+def test_add_month_indexes():
+    bitsets = pa.array([b"\x01", None, b"\x10", b"\x02"], pa.binary())
+    month_indexes = pa.array([[9], [0], None, [1, 15]], pa.list_(pa.int64()))
+    # the new months are ORed into the previous bitsets and every bitset gets the same length
+    added = activity_bitsets.add_month_indexes(bitsets, month_indexes, 2)
+    assert added.to_pylist() == [b"\x01\x02", b"\x01\x00", b"\x10\x00", b"\x02\x80"]
+
+
+def test_cohort_helpers_match_brute_force():
+    rng = np.random.default_rng(0)
+    month_count = 40
+    active = rng.random((300, month_count)) < np.linspace(0.05, 0.4, 300)[:, None]
+    active[-1, month_count - 1] = True
+    month_indexes = pa.array([np.flatnonzero(row).tolist() for row in active], pa.list_(pa.int64()))
+    bits = activity_bitsets.unpack_bitsets(activity_bitsets.pack_month_indexes(month_indexes, 5))
+    assert activity_bitsets.get_month_count(bits) == month_count
+
+    first_months = np.array([np.flatnonzero(row)[0] if row.any() else -1 for row in active])
+    assert activity_bitsets.first_month_indexes(bits).tolist() == first_months.tolist()
+    assert activity_bitsets.active_users_per_month(bits).tolist() == active.sum(axis=0).tolist()
+    assert activity_bitsets.new_users_per_month(bits).tolist() == [
+        int(np.sum(first_months == month)) for month in range(month_count)
+    ]
+
+    retention = activity_bitsets.retention(bits, max_offset=5)
+    for cohort in range(month_count):
+        for offset in range(6):
+            expected = sum(
+                1
+                for user in range(len(active))
+                if first_months[user] == cohort and cohort + offset < month_count and active[user, cohort + offset]
+            )
+            assert retention[cohort, offset] == expected
+
+    inactive_months = 3
+    reactivated = activity_bitsets.reactivated_users_per_month(bits, inactive_months)
+    churned = activity_bitsets.churned_users_per_month(bits, inactive_months)
+    for month in range(month_count):
+        previous = [np.flatnonzero(row[:month]) for row in active]
+        expected_reactivated = sum(
+            1
+            for user, row in enumerate(active)
+            if row[month] and len(previous[user]) and month - previous[user][-1] > inactive_months
+        )
+        assert reactivated[month] == expected_reactivated
+        if month + inactive_months >= month_count:
+            assert churned[month] == -1
+        else:
+            expected_churned = sum(
+                1 for row in active if row[month] and not row[month + 1 : month + 1 + inactive_months].any()
+            )
+            assert churned[month] == expected_churned
@@ -0,0 +1,127 @@
+import os
+import sys
+from datetime import UTC, date, datetime
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+import activity_bitsets
+import build_user_dim
+import changeset_osm_to_raw_data as raw_data
+import notes_osm_to_data as notes_data
+
+
+def write_datasets(path, changesets, comments, note_comments):
+    """Write the three datasets with (user_name, year, month) tuples as rows"""
+    changeset_rows = [
+        {"changeset_id": index, "year": year, "month": month, "edit_count": 10, "user_name": user_name, "tags": {}}
+        for index, (user_name, year, month) in enumerate(changesets)
+    ]
+    pq.write_to_dataset(
+        pa.Table.from_pylist(changeset_rows, schema=raw_data.CHANGESET_SCHEMA),
+        path / "changeset_data",
+        partition_cols=["year", "month"],
+    )
+    comment_rows = [
+        {"changeset_id": 1, "date": datetime(year, month, 3, tzinfo=UTC), "user_name": user_name, "text": "hi"}
+        for user_name, year, month in comments
+    ]
+    (path / "changeset_comments_data").mkdir(exist_ok=True)
+    pq.write_table(
+        pa.Table.from_pylist(comment_rows, schema=raw_data.DISCUSSION_SCHEMA),
+        path / "changeset_comments_data" / f"comments_{len(changeset_rows)}.parquet",
+    )
+    note_comment_rows = [
+        {"note_id": 1, "action": "commented", "timestamp": datetime(year, month, 3, tzinfo=UTC), "user_name": user_name}
+        for user_name, year, month in note_comments
+    ]
+    (path / "notes_comments_data").mkdir(exist_ok=True)
+    pq.write_table(
+        pa.Table.from_pylist(note_comment_rows, schema=notes_data.COMMENTS_SCHEMA),
+        path / "notes_comments_data" / "part-0.parquet",
+    )
+
+
+def update(path, last_month):
+    user_dim_path = path / "user_dim"
+    previous_user_dim = build_user_dim.read_user_dim(user_dim_path)
+    activity_sql = build_user_dim.get_activity_sql(
+        path / "changeset_data",
+        path / "changeset_comments_data",
+        path / "notes_comments_data",
+        last_month,
+        after_month=build_user_dim.get_last_month(previous_user_dim.schema),
+    )
+    user_dim = build_user_dim.update_user_dim(previous_user_dim, activity_sql, last_month)
+    build_user_dim.write_user_dim(user_dim_path, user_dim)
+    for name in ["changeset_comments_data", "notes_comments_data"]:
+        build_user_dim.add_user_id_column(path / name, user_dim)
+    return {row["user_name"]: row for row in user_dim.to_pylist()}
+
+
+def test_user_dim_ids_are_stable(tmp_path):
+    write_datasets(
+        tmp_path,
+        changesets=[("bob", 2020, 2), ("alice", 2020, 3), ("bob", 2021, 1)],
+        comments=[("carol", 2020, 1), ("alice", 2020, 5)],
+        note_comments=[(None, 2019, 1), ("alice", 2019, 12)],
+    )
+    users = update(tmp_path, (2021, 1))
+    assert {name: user["user_id"] for name, user in users.items()} == {"alice": 1, "carol": 2, "bob": 3}
+    assert users["alice"] == {
+        "user_id": 1,
+        "user_name": "alice",
+        "first_active_month": date(2019, 12, 1),
+        "last_active_month": date(2020, 5, 1),
+        "changeset_count": 1,
+        "edit_count": 10,
+        "changeset_comment_count": 1,
+        "note_comment_count": 1,
+        "changeset_months": users["alice"]["changeset_months"],
+    }
+    alice_bits = activity_bitsets.unpack_bitsets(pa.array([users["alice"]["changeset_months"]], pa.binary()))
+    assert activity_bitsets.first_month_indexes(alice_bits).tolist() == [activity_bitsets.month_index(2020, 3)]
+    assert activity_bitsets.last_month_indexes(alice_bits).tolist() == [activity_bitsets.month_index(2020, 3)]
+    assert build_user_dim.get_user_dim_last_month(tmp_path / "user_dim") == (2021, 1)
+
+    # a new month with new users, the comments are parsed again without the user_id column
+    write_datasets(
+        tmp_path,
+        changesets=[("dave", 2021, 2), ("bob", 2021, 2), ("erin", 2021, 3)],
+        comments=[("carol", 2020, 1), ("alice", 2020, 5), ("aaron", 2021, 2)],
+        note_comments=[(None, 2019, 1), ("alice", 2019, 12), ("zoe", 2021, 2), ("alice", 2021, 2)],
+    )
+    # only the new month is read, the older changeset partitions are skipped
+    (old_file,) = (tmp_path / "changeset_data" / "year=2021" / "month=1").glob("*.parquet")
+    old_file.write_bytes(b"not a parquet file")
+    users = update(tmp_path, (2021, 2))
+    assert {name: user["user_id"] for name, user in users.items()} == {
+        "alice": 1,
+        "carol": 2,
+        "bob": 3,
+        "aaron": 4,
+        "dave": 5,
+        "zoe": 6,
+    }
+    assert users["bob"]["changeset_count"] == 3
+    assert users["bob"]["first_active_month"] == date(2020, 2, 1)
+    assert users["bob"]["last_active_month"] == date(2021, 2, 1)
+    assert users["alice"]["note_comment_count"] == 2
+    assert users["alice"]["last_active_month"] == date(2021, 2, 1)
+    assert users["carol"]["changeset_comment_count"] == 1
+    # the new months are added to the previous bitsets, which are padded to the length of the last month
+    assert {len(user["changeset_months"]) for user in users.values()} == {
+        activity_bitsets.month_index(2021, 2) // 8 + 1
+    }
+    bits = activity_bitsets.unpack_bitsets(pa.array([user["changeset_months"] for user in users.values()]))
+    assert activity_bitsets.active_users_per_month(bits)[-13:].tolist() == [1, 1] + [0] * 9 + [1, 2]
+    bob_bits = activity_bitsets.unpack_bitsets(pa.array([users["bob"]["changeset_months"]], pa.binary()))
+    assert activity_bitsets.active_users_per_month(bob_bits)[-13:].tolist() == [1] + [0] * 10 + [1, 1]
+    assert build_user_dim.get_user_dim_last_month(tmp_path / "user_dim") == (2021, 2)
+
+    note_comments = pq.read_table(tmp_path / "notes_comments_data" / "part-0.parquet")
+    assert note_comments["user_id"].to_pylist() == [None, 1, 6, 1]
+    comments = pq.read_table(tmp_path / "changeset_comments_data", columns=["user_name", "user_id"]).to_pylist()
+    assert len(comments) == 3
+    assert all(row["user_id"] == users[row["user_name"]]["user_id"] for row in comments)
@@ -0,0 +1,398 @@
+import bz2
+import datetime
+import gzip
+import json
+import os
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+
+import pyarrow.parquet as pq
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+import build_bz2_block_index
+import changeset_osm_to_data
+import changeset_osm_to_raw_data as raw_data
+import changeset_raw_data_to_data
+import osm_input
+import transcode_to_zstd
+from checkpoint import resume_position
+from ingest_metrics import IngestMetrics
+
+FIXTURES_PATH = Path(__file__).parent / "fixtures"
+SCRIPTS_PATH = Path(__file__).parent.parent / "scripts"
+
+
+@pytest.fixture
+def changeset_bz2_path(tmp_path):
+    """Compress the changeset fixture like the discussions-latest.osm.bz2 dump."""
+    file_path = tmp_path / "changesets.osm.bz2"
+    file_path.write_bytes(bz2.compress((FIXTURES_PATH / "changesets.osm").read_bytes()))
+    return file_path
+
+
+def get_parser_kwargs(output_path, batch_size=3):
+    return {
+        "changeset_batch_size": batch_size,
+        "discussion_batch_size": batch_size,
+        "changeset_output_path": str(output_path / "changeset_data_raw"),
+        "discussion_output_path": str(output_path / "changeset_comments_data"),
+        "changeset_schema": raw_data.CHANGESET_SCHEMA,
+        "discussion_schema": raw_data.DISCUSSION_SCHEMA,
+    }
+
+
+def read_rows(dataset_path, sort_columns=("changeset_id",)):
+    """Read a (partitioned) parquet dataset as a list of rows in a deterministic order."""
+    rows = pq.read_table(dataset_path).to_pylist()
+    for row in rows:
+        if "year" in row:
+            row["year"], row["month"] = int(row["year"]), int(row["month"])
+    return sorted(rows, key=lambda row: tuple(str(row[column]) for column in sort_columns))
+
+
+def read_output(output_path):
+    return (
+        read_rows(output_path / "changeset_data_raw"),
+        read_rows(output_path / "changeset_comments_data", sort_columns=("changeset_id", "date")),
+    )
+
+
+def parse_serial(file_path, output_path, **kwargs):
+    changeset_parser = raw_data.ChangesetParser(**get_parser_kwargs(output_path), **kwargs)
+    changeset_parser.parse_file(file_path)
+    changeset_parser.finalize()
+    return changeset_parser
+
+
+def test_parse_file(changeset_bz2_path, tmp_path):
+    """Test the parsed values of the fixture file."""
+    parse_serial(changeset_bz2_path, tmp_path)
+    changesets, comments = read_output(tmp_path)
+
+    assert [row["changeset_id"] for row in changesets] == [1, 2, 3, 4, 5, 6, 7, 8]
+    assert changesets[1]["user_name"] == ""
+    assert changesets[1]["bottom_left_lon"] is None
+    assert (changesets[3]["year"], changesets[3]["month"]) == (2012, 12)
+    assert dict(changesets[2]["tags"])["comment"] == 'Roads & "paths" <b>'
+    assert dict(changesets[5]["tags"]) == {"created_by": "duplicate key, last one wins"}
+    assert changesets[6]["edit_count"] == 10000
+
+    assert [row["changeset_id"] for row in comments] == [3, 3, 5, 8]
+    assert comments[0]["text"] == 'Looks good, see <changeset id="4">'
+    assert comments[1]["text"] == ""
+    assert comments[2]["user_name"] == "Zoë 🗺"
+    assert comments[2]["text"] == "Multi\nline   comment\n"
+
+
+@pytest.mark.parametrize("compress", [gzip.compress, lambda data: data])
+def test_parse_file_compressions(tmp_path, compress):
+    """Test that gzip, seekable zstd and uncompressed dumps are parsed like the bz2 dump."""
+    bz2_path = write_large_changeset_dump(tmp_path / "changesets.osm.bz2", changeset_count=500)
+    parse_serial(bz2_path, tmp_path / "reference")
+    file_path = tmp_path / "changesets.osm"
+    file_path.write_bytes(compress(bz2.decompress(bz2_path.read_bytes())))
+    parse_serial(file_path, tmp_path / "other")
+    transcode_to_zstd.transcode_to_zstd(bz2_path, tmp_path / "changesets.osm.zst", frame_size=10_000)
+    parse_serial(tmp_path / "changesets.osm.zst", tmp_path / "zstd")
+    assert read_output(tmp_path / "other") == read_output(tmp_path / "zstd") == read_output(tmp_path / "reference")
+
+
+def test_parse_file_background_writer(changeset_bz2_path, tmp_path):
+    """Test that writing the batches on the background thread produces the same rows."""
+    parse_serial(changeset_bz2_path, tmp_path / "serial")
+    changeset_parser = parse_serial(changeset_bz2_path, tmp_path / "background", writer_queue_size=1)
+    assert changeset_parser.changeset_batch_count == 3
+    assert read_output(tmp_path / "background") == read_output(tmp_path / "serial")
+
+
+def test_parse_file_one_file_per_month(changeset_bz2_path, tmp_path):
+    """Test that every month is written into a single file with the same rows."""
+    parse_serial(changeset_bz2_path, tmp_path / "serial")
+    parse_serial(changeset_bz2_path, tmp_path / "monthly", writer_queue_size=1, one_file_per_month=True)
+    partition_files = list((tmp_path / "monthly" / "changeset_data_raw").glob("year=*/month=*/*.parquet"))
+    assert sorted(path.name for path in partition_files) == ["part-0.parquet"] * 6
+    assert read_output(tmp_path / "monthly") == read_output(tmp_path / "serial")
+
+
+@pytest.mark.parametrize("writer_queue_size", [0, 2])
+def test_metrics_report(changeset_bz2_path, tmp_path, writer_queue_size):
+    """Test that the metrics report counts the elements and bytes and splits the time between the stages."""
+    changeset_parser = parse_serial(
+        changeset_bz2_path, tmp_path, writer_queue_size=writer_queue_size, metrics=IngestMetrics(0.01)
+    )
+    changeset_parser.write_metrics_report(tmp_path / "metrics.json")
+    report = json.loads((tmp_path / "metrics.json").read_text())
+
+    assert report["elements"] == {"changesets": 8, "comments": 4}
+    assert report["compressed_bytes"] == changeset_bz2_path.stat().st_size
+    assert report["decompressed_bytes"] == (FIXTURES_PATH / "changesets.osm").stat().st_size
+    assert report["time_s"]["parquet_write_in_background"] == (writer_queue_size > 0)
+    assert min(report["time_s"][stage] for stage in ["decompression", "xml_parsing", "python_conversion"]) >= 0
+    assert report["peak_rss_mb"] > 0
+    parse_serial(changeset_bz2_path, tmp_path / "reference")
+    assert read_output(tmp_path) == read_output(tmp_path / "reference")
+
+
+@pytest.mark.parametrize("decompressor_args", [[], ["--decompression-workers", "2"], ["--decompressor", "bzip2 -dc"]])
+def test_main_reads_stdin(changeset_bz2_path, tmp_path, decompressor_args):
+    """Test piping the dump into the script instead of passing a file."""
+    if "--decompressor" in decompressor_args and shutil.which("bzip2") is None:
+        pytest.skip("needs the bzip2 command")
+    parse_serial(changeset_bz2_path, tmp_path / "reference")
+    output_path = tmp_path / "stdin"
+    with open(changeset_bz2_path, "rb") as stdin:
+        subprocess.run(
+            [
+                sys.executable,
+                SCRIPTS_PATH / "changeset_osm_to_raw_data.py",
+                "-",
+                output_path / "changeset_data_raw",
+                output_path / "changeset_comments_data",
+                *decompressor_args,
+            ],
+            stdin=stdin,
+            check=True,
+            capture_output=True,
+        )
+    assert read_output(output_path) == read_output(tmp_path / "reference")
+
+
+def test_iter_changeset_shards(changeset_bz2_path):
+    """Test that every shard only contains complete changesets."""
+    with bz2.open(changeset_bz2_path) as file_handle:
+        shards = list(raw_data.iter_changeset_shards(file_handle, shard_size=100))
+    assert len(shards) > 1
+    assert all(shard.startswith(b"<changeset ") for shard in shards)
+    assert sum(shard.count(b"<changeset ") for shard in shards) == 8
+    assert b"</osm>" not in shards[-1]
+
+
+def test_parse_file_sharded(changeset_bz2_path, tmp_path):
+    """Test that the sharded parsing produces the same rows as a serial run."""
+    parse_serial(changeset_bz2_path, tmp_path / "serial")
+    changeset_count, discussion_count = raw_data.parse_file_sharded(
+        changeset_bz2_path, 3, get_parser_kwargs(tmp_path / "sharded"), shard_size=500
+    )
+    assert (changeset_count, discussion_count) == (8, 4)
+    assert read_output(tmp_path / "sharded") == read_output(tmp_path / "serial")
+
+
+def write_replication_diff(replication_path, sequence, changesets_xml):
+    diff_path = replication_path / raw_data.replication_diff_path(sequence)
+    diff_path.parent.mkdir(parents=True, exist_ok=True)
+    diff_path.write_bytes(gzip.compress(f'<osm version="0.6">\n{changesets_xml}\n</osm>\n'.encode()))
+    (replication_path / "state.yaml").write_text(
+        f"---\nlast_run: 2025-10-07 00:00:00.000000000 +00:00\nsequence: {sequence}\n"
+    )
+
+
+def test_apply_replication_diffs(changeset_bz2_path, tmp_path):
+    """Test that replication diffs update the changesets and comments and only rewrite the affected partitions."""
+    parse_serial(changeset_bz2_path, tmp_path)
+    changeset_output_path = tmp_path / "changeset_data_raw"
+    unaffected_files = sorted(changeset_output_path.glob("year=2005/month=4/*.parquet"))
+    replication_path = tmp_path / "replication"
+
+    write_replication_diff(
+        replication_path,
+        999_999,
+        '<changeset id="9" created_at="2025-10-06T10:00:00Z" open="true" user="new_mapper" uid="9" '
+        'num_changes="0" comments_count="0"><tag k="created_by" v="iD 2.30"/></changeset>',
+    )
+    write_replication_diff(
+        replication_path,
+        1_000_000,
+        '<changeset id="3" created_at="2005-05-01T10:00:00Z" closed_at="2005-05-01T11:00:00Z" open="false" '
+        'user="mapper_a" uid="3" num_changes="15" comments_count="3"><discussion>'
+        '<comment uid="4" user="reviewer" date="2015-06-01T08:00:00Z"><text>first</text></comment>'
+        '<comment uid="3" user="mapper_a" date="2015-06-02T09:30:00Z"><text></text></comment>'
+        '<comment uid="5" user="mapper_b" date="2025-10-06T11:00:00Z"><text>third</text></comment>'
+        "</discussion></changeset>\n"
+        '<changeset id="9" created_at="2025-10-06T10:00:00Z" closed_at="2025-10-06T11:00:00Z" open="false" '
+        'user="new_mapper" uid="9" min_lat="1.0" min_lon="2.0" max_lat="1.0" max_lon="2.0" num_changes="4" '
+        'comments_count="0"><tag k="created_by" v="iD 2.30"/></changeset>',
+    )
+
+    with pytest.raises(FileNotFoundError):
+        raw_data.apply_replication_diffs(str(replication_path), changeset_output_path, tmp_path / "comments")
+    applied_count = raw_data.apply_replication_diffs(
+        str(replication_path), changeset_output_path, tmp_path / "changeset_comments_data", start_sequence=999_999
+    )
+    assert applied_count == 2
+    changesets, comments = read_output(tmp_path)
+
+    assert [row["changeset_id"] for row in changesets] == [1, 2, 3, 4, 5, 6, 7, 8, 9]
+    assert changesets[2]["tags"] == []
+    assert (changesets[8]["year"], changesets[8]["month"], changesets[8]["edit_count"]) == (2025, 10, 4)
+    assert changesets[8]["bottom_left_lon"] == 2.0
+    assert [(row["changeset_id"], row["text"]) for row in comments] == [
+        (3, "first"),
+        (3, ""),
+        (3, "third"),
+        (5, "Multi\nline   comment\n"),
+        (8, "Thanks!"),
+    ]
+    assert sorted(changeset_output_path.glob("year=2005/month=4/*.parquet")) == unaffected_files
+    assert [path.name for path in changeset_output_path.glob("year=2025/month=10/*.parquet")] == [
+        "part-r1000000-0.parquet"
+    ]
+
+    # nothing new to apply, the state file has the last sequence
+    assert raw_data.apply_replication_diffs(str(replication_path), changeset_output_path, tmp_path / "x") == 0
+    assert json.loads((changeset_output_path / raw_data.REPLICATION_STATE_FILE).read_text()) == {"sequence": 1_000_000}
+
+
+def write_large_changeset_dump(file_path, changeset_count=3000):
+    """Write a dump that spans multiple bz2 blocks with 100 changesets per month, every third one has two comments."""
+    changesets = []
+    for changeset_id in range(1, changeset_count + 1):
+        year, month = divmod(changeset_id // 100, 12)
+        discussion = ""
+        if changeset_id % 3 == 0:
+            discussion = "".join(
+                f'<comment user="reviewer" date="2015-06-0{index + 1}T08:00:00Z">'
+                f"<text>comment {index} on {changeset_id} {'text ' * 20}</text></comment>"
+                for index in range(2)
+            )
+            discussion = f"<discussion>{discussion}</discussion>"
+        changesets.append(
+            f'<changeset id="{changeset_id}" created_at="{2010 + year}-{month + 1:02d}-01T00:00:00Z" '
+            f'user="user_{changeset_id % 97}" num_changes="{changeset_id % 50}">'
+            f'<tag k="comment" v="changeset {changeset_id} {"padding " * 10}"/>{discussion}</changeset>\n'
+        )
+    xml = '<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n' + "".join(changesets) + "</osm>\n"
+    file_path.write_bytes(bz2.compress(xml.encode(), compresslevel=1))
+    return file_path
+
+
+class CrashingChangesetParser(raw_data.ChangesetParser):
+    """Stops like a killed process after the files of the given changeset batch were written."""
+
+    crash_after_batch = 4
+
+    def _save_checkpoint(self, stream, batch_checkpoint):
+        if stream == "changeset" and batch_checkpoint["batch_count"] == self.crash_after_batch:
+            raise KeyboardInterrupt
+        super()._save_checkpoint(stream, batch_checkpoint)
+
+
+@pytest.mark.parametrize(("decompression_workers", "zstd"), [(None, False), (2, False), (None, True)])
+def test_resume_from_checkpoint(tmp_path, monkeypatch, decompression_workers, zstd):
+    """Test that resuming an interrupted run produces the same rows as an uninterrupted one."""
+    # the default margin is larger than the whole test dump
+    monkeypatch.setattr(osm_input, "RESUME_MARGIN", 64 * 1024)
+    file_path = write_large_changeset_dump(tmp_path / "changesets.osm.bz2")
+    if zstd:
+        transcode_to_zstd.transcode_to_zstd(file_path, tmp_path / "changesets.osm.zst", frame_size=50_000)
+        file_path = tmp_path / "changesets.osm.zst"
+    parser_kwargs = get_parser_kwargs(tmp_path / "resumed", batch_size=500) | {"discussion_batch_size": 300}
+    checkpoint_path = tmp_path / "resumed" / "changeset_data_raw" / raw_data.CHECKPOINT_FILE
+
+    reference_parser = raw_data.ChangesetParser(**get_parser_kwargs(tmp_path / "reference", batch_size=500))
+    reference_parser.parse_file(file_path)
+    reference_parser.finalize()
+
+    with pytest.raises(KeyboardInterrupt):
+        CrashingChangesetParser(**parser_kwargs, checkpoint_path=checkpoint_path).parse_file(
+            file_path, decompression_workers
+        )
+    checkpoint = json.loads(checkpoint_path.read_text())
+    assert checkpoint["changeset"]["batch_count"] == 3
+    assert checkpoint["changeset"]["position"]["decompressed_offset"] > 0
+    assert checkpoint["discussion"]["batch_count"] > 0
+    assert (checkpoint["changeset"]["position"]["block_bit_offset"] is None) == (decompression_workers is None)
+    assert resume_position(checkpoint) is not None
+
+    changeset_parser = raw_data.ChangesetParser(**parser_kwargs, checkpoint_path=checkpoint_path)
+    changeset_parser.parse_file(file_path, decompression_workers, resume=True)
+    changeset_parser.finalize()
+    assert not checkpoint_path.exists()
+    assert changeset_parser.changeset_count == reference_parser.changeset_count == 3000
+    assert changeset_parser.discussion_count == reference_parser.discussion_count == 2000
+    assert read_output(tmp_path / "resumed") == read_output(tmp_path / "reference")
+
+
+def test_find_first_changeset():
+    """Test that the attributes of the first complete start tag are found in any order."""
+    created_at = datetime.datetime(2021, 5, 1, 12, tzinfo=datetime.UTC)
+    assert build_bz2_block_index.find_first_changeset(
+        b'min_lat="1"><tag k="a" v="b"/></changeset>\n'
+        b'<changeset created_at="2021-05-01T12:00:00Z" uid="7" id="42" open="false">'
+        b'<changeset id="43" created_at="2021-05-01T12:00:01Z">'
+    ) == (42, created_at)
+    assert build_bz2_block_index.find_first_changeset(b'</changeset>\n<changeset id="44" created_at="20') is None
+
+
+def test_batch_memory_budget(tmp_path, monkeypatch):
+    """Test that a memory budget splits the batches by their size instead of a row count."""
+    monkeypatch.setattr(raw_data, "MEMORY_CHECK_INTERVAL", 100)
+    file_path = write_large_changeset_dump(tmp_path / "changesets.osm.bz2")
+    for output_path, batch_memory_mb in [(tmp_path / "reference", None), (tmp_path / "budget", 0.1)]:
+        changeset_parser = raw_data.ChangesetParser(
+            **get_parser_kwargs(output_path, batch_size=sys.maxsize), batch_memory_mb=batch_memory_mb
+        )
+        changeset_parser.parse_file(file_path)
+        changeset_parser.finalize()
+
+    assert 1 < changeset_parser.changeset_batch_count < 30
+    assert 1 < changeset_parser.discussion_batch_count < 20
+    # the budget is checked every 100 rows, only the last batch can have another size
+    comment_files = (tmp_path / "budget" / "changeset_comments_data").glob("*.parquet")
+    assert sum(pq.read_metadata(path).num_rows % 100 != 0 for path in comment_files) <= 1
+    assert read_output(tmp_path / "budget") == read_output(tmp_path / "reference")
+
+
+def test_parse_file_enriched(tmp_path):
+    """Test that the fused parse and enrich mode writes the same changeset_data as enriching the raw output."""
+    file_path = write_large_changeset_dump(tmp_path / "changesets.osm.bz2", changeset_count=350)
+    parser_kwargs = get_parser_kwargs(tmp_path / "raw", batch_size=150)
+    changeset_parser = raw_data.ChangesetParser(**parser_kwargs)
+    changeset_parser.parse_file(file_path)
+    changeset_parser.finalize()
+    changeset_raw_data_to_data.create_organised_team_lookup_table()
+    expressions = changeset_raw_data_to_data.get_column_expressions()
+    raw_path = parser_kwargs["changeset_output_path"]
+    for year, month in changeset_raw_data_to_data.get_all_available_year_months(raw_path):
+        changeset_raw_data_to_data.enrich_table_year_month(raw_path, tmp_path / "two_step", year, month, expressions)
+
+    fused_kwargs = get_parser_kwargs(tmp_path / "fused", batch_size=150)
+    fused_kwargs["changeset_output_path"] = str(tmp_path / "fused" / "changeset_data")
+    assert changeset_osm_to_data.parse_file_enriched(file_path, fused_kwargs) == 350
+
+    fused_path = tmp_path / "fused" / "changeset_data"
+    assert not (tmp_path / "fused" / "changeset_data_raw").exists()
+    assert sorted(path.relative_to(fused_path) for path in fused_path.glob("**/*.parquet")) == sorted(
+        path.relative_to(tmp_path / "two_step") for path in (tmp_path / "two_step").glob("**/*.parquet")
+    )
+    assert read_rows(fused_path) == read_rows(tmp_path / "two_step")
+    assert read_rows(tmp_path / "fused" / "changeset_comments_data", ("changeset_id", "date")) == read_rows(
+        tmp_path / "raw" / "changeset_comments_data", ("changeset_id", "date")
+    )
+
+
+@pytest.mark.parametrize("seek_kwargs", [{"since": (2011, 3)}, {"min_changeset_id": 1450}])
+def test_parse_file_since(tmp_path, seek_kwargs):
+    """Test that parsing from the block index replaces the recent changesets like a full parse."""
+    old_file_path = write_large_changeset_dump(tmp_path / "old.osm.bz2", changeset_count=2000)
+    file_path = write_large_changeset_dump(tmp_path / "changesets.osm.bz2")
+    for dump_path, output_path in [(file_path, tmp_path / "reference"), (old_file_path, tmp_path / "since")]:
+        changeset_parser = raw_data.ChangesetParser(**get_parser_kwargs(output_path, batch_size=500))
+        changeset_parser.parse_file(dump_path)
+        changeset_parser.finalize()
+
+    block_index = build_bz2_block_index.build_block_index(file_path)
+    assert block_index.num_rows > 1
+    assert block_index["first_changeset_id"].to_pylist() == sorted(block_index["first_changeset_id"].to_pylist())
+    assert build_bz2_block_index.find_start_position(block_index, **seek_kwargs)["decompressed_offset"] > 0
+    index_path = tmp_path / "changesets.osm.bz2.index.parquet"
+    pq.write_table(block_index, index_path)
+
+    parsed_count = raw_data.parse_file_since(
+        file_path, index_path, get_parser_kwargs(tmp_path / "since"), **seek_kwargs
+    )
+    assert parsed_count == 3000 - (1399 if "since" in seek_kwargs else 1449)
+    assert read_output(tmp_path / "since") == read_output(tmp_path / "reference")
+    assert len(list((tmp_path / "since" / "changeset_data_raw").glob("year=2010/month=1/part-since*"))) == 0
@@ -1,13 +1,20 @@
+import json
 import os
 import sys
 from contextlib import contextmanager
 from unittest.mock import mock_open, patch
 
 import duckdb
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 import pytest
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+import changeset_osm_to_raw_data as raw_data
 import changeset_raw_data_to_data as enrich_table
+import changeset_sketches
+import spatial_key
 
 
 @contextmanager
@@ -33,6 +40,21 @@ def expressions():
     return enrich_table.get_column_expressions()
 
 
+def write_raw_changesets(tmp_path, rows):
+    """Write raw changesets to tmp_path / "raw", the columns that a row doesn't have get a default value.
+
+    The year-month partitions of the rows replace the existing ones.
+    """
+    defaults = {"year": 2021, "month": 1, "edit_count": 1, "user_name": "user", "tags": {}}
+    pq.write_to_dataset(
+        pa.Table.from_pylist([{**defaults, **row} for row in rows], schema=raw_data.CHANGESET_SCHEMA),
+        tmp_path / "raw",
+        partition_cols=["year", "month"],
+        existing_data_behavior="delete_matching",
+    )
+    return tmp_path / "raw"
+
+
 def run_query(db, select_expression):
     sql_query = f"SELECT {select_expression} FROM main"
     return [row[0] for row in db.execute(sql_query).fetchall()]
@@ -266,7 +288,7 @@ def test_expression_source(db):
         assert expected_results == results
 
 
-def test_expression_mobile_os(db, expressions):
+def test_expression_mobile_os(db):
     """Test mobile OS detection from created_by field."""
     db.execute("""
         CREATE OR REPLACE TABLE main AS SELECT * FROM VALUES 
@@ -292,7 +314,7 @@ def test_expression_mobile_os(db, expressions):
         None,  # null tags
     ]
 
-    results = run_query(db, expressions["mobile_os"])
+    results = run_query(db, enrich_table.get_mobile_os_case_statement())
     assert expected_results == results
 
 
@@ -399,3 +421,538 @@ def test_expression_corporation(expressions):
         ]
 
         assert expected_results == results
+
+
+@pytest.mark.parametrize("use_normalizer", [False, True])
+def test_lookup_tables_match_case_statements(use_normalizer):
+    """Test that joining the lookup tables gives the results of the CASE statements, including the rule order."""
+    # the same mocked rules are used for created_by and for imagery_used and source
+    mock_rules = {
+        # overlapping rules, the first matching one wins
+        "Vespucci": {"aliases": ["Vespucci Android"], "type": "mobile_editor"},
+        "iD": {"starts_with": ["iD "], "type": "desktop_editor"},
+        "iD fork": {"starts_with": ["iD fork"], "type": "tool"},
+        "JOSM": {"contains": ["JOSM"], "type": "desktop_editor"},
+        "JOSM plugin": {"ends_with": ["JOSM plugin"], "type": "tool"},
+        "Go Map!!": {"starts_with": ["Go Map!!"], "type": "mobile_editor"},
+        "web": {"starts_with": ["web_"], "type": "web_editor"},
+        "Bing": {"aliases": ["bing", "Bing aerial"], "starts_with": ["Bing "]},
+        "O'Map": {"aliases": ["O'Map 1"]},
+    }
+    created_by_values = [
+        "iD 2.20",
+        "iD fork 1.0",
+        "JOSM/1.5 (18629 en)",
+        "a JOSM plugin",
+        "Vespucci Android",
+        "Vespucci Android 18",
+        "Go Map!! 4.1 iOS",
+        "web_x",
+        "webAx",
+        "O'Map 1",
+        "Unknown ios editor",
+        "",
+        None,
+        "iD 2.20",
+    ]
+    tag_values = ["bing;Bing aerial", "survey / bing + iD 1", "Bing%20%Maps; ;web_a", "", None, "O'Map 1, unknown"]
+    tags = []
+    for index, created_by in enumerate(created_by_values):
+        changeset_tags = {"created_by": created_by, "imagery_used": tag_values[index % len(tag_values)]}
+        changeset_tags["source"] = tag_values[(index + 1) % len(tag_values)]
+        tags.append({key: value for key, value in changeset_tags.items() if value is not None})
+    table = pa.table(
+        {
+            "changeset_id": range(len(tags)),
+            "tags": pa.array([list(tag.items()) for tag in tags], pa.map_(pa.string(), pa.string())),
+        }
+    )
+    columns = ["created_by", "device_type", "mobile_os", "imagery_used", "source"]
+
+    with mock_json_files(mock_rules):
+        duckdb.register("lookup_changesets", table)
+        case_results = duckdb.sql(f"""
+            SELECT
+                {enrich_table.get_created_by_case_statement()} as created_by,
+                {enrich_table.get_device_type_case_statement()} as device_type,
+                {enrich_table.get_mobile_os_case_statement()} as mobile_os,
+                {enrich_table.get_imagery_used_case_statement()} as imagery_used,
+                {enrich_table.get_source_case_statement()} as source
+            FROM lookup_changesets main
+            ORDER BY main.changeset_id
+        """).fetchall()
+
+        lookup_expressions = enrich_table.get_lookup_expressions()
+        if use_normalizer:
+            normalizer = enrich_table.RecordBatchNormalizer()
+            # the later batches have known and new values
+            batches = [normalizer.add_columns(batch) for batch in table.to_batches(max_chunksize=6)]
+            duckdb.register("lookup_changesets", pa.Table.from_batches(batches))
+            lookup_expressions = enrich_table.get_lookup_expressions("main")
+            join_sql = ""
+        else:
+            enrich_table.create_lookup_tables("lookup_changesets")
+            join_sql = """
+                LEFT JOIN created_by_lookup ON main.tags['created_by'] IS NOT DISTINCT FROM created_by_lookup.raw_created_by
+                LEFT JOIN imagery_used_lookup ON main.tags['imagery_used'] IS NOT DISTINCT FROM imagery_used_lookup.raw_value
+                LEFT JOIN source_lookup ON main.tags['source'] IS NOT DISTINCT FROM source_lookup.raw_value
+            """
+        lookup_results = duckdb.sql(f"""
+            SELECT {", ".join(f"{lookup_expressions[column]} as {column}" for column in columns)}
+            FROM lookup_changesets main
+            {join_sql}
+            ORDER BY main.changeset_id
+        """).fetchall()
+        duckdb.unregister("lookup_changesets")
+
+    assert lookup_results == case_results
+    assert case_results[1][:3] == ("iD", "desktop_editor", None)
+    assert case_results[5][:3] == ("Vespucci Android 18", "other", "Android")
+    assert case_results[7][:3] == ("web", "other", None)
+    # _ is a LIKE wildcard in the rules
+    assert case_results[8][:3] == ("web", "other", None)
+    assert case_results[12][:3] == (None, "other", None)
+    assert case_results[0][3:] == (["Bing", "Bing"], ["survey", "Bing", "iD"])
+    assert case_results[2][3:] == (["Bing", "web"], None)
+
+
+def test_token_cache(tmp_path, monkeypatch):
+    """Test that the token cache only classifies new tokens and is rebuilt after a change of the rules."""
+    rules_path = tmp_path / enrich_table.IMAGERY_AND_SOURCE_RULES_FILE
+    rules_path.parent.mkdir()
+    rules_path.write_text('{"Bing": {"starts_with": ["Bing"]}}')
+    monkeypatch.chdir(tmp_path)
+    cache_path = tmp_path / "tokens.parquet"
+    token_lists = pa.array([["Bing aerial", "survey"], None, [], ["Bing"]], pa.list_(pa.string()))
+
+    token_cache = enrich_table.TokenCache(cache_path)
+    assert token_cache.normalize(token_lists.slice(1)).to_pylist() == [None, [], ["Bing"]]
+    assert token_cache.normalize(token_lists).to_pylist() == [["Bing", "survey"], None, [], ["Bing"]]
+    assert token_cache.new_token_count == 3
+    token_cache.save()
+
+    token_cache = enrich_table.TokenCache(cache_path)
+    assert token_cache.tokens.num_rows == 3
+    with patch.object(enrich_table, "sql_case_statement_from_rules") as case_statement:
+        assert token_cache.normalize(token_lists).to_pylist() == [["Bing", "survey"], None, [], ["Bing"]]
+    case_statement.assert_not_called()
+    assert token_cache.new_token_count == 0
+
+    rules_path.write_text('{"Survey": {"aliases": ["survey"]}}')
+    token_cache = enrich_table.TokenCache(cache_path)
+    assert token_cache.tokens.num_rows == 0
+    assert token_cache.normalize(token_lists).to_pylist() == [["Bing aerial", "Survey"], None, [], ["Bing"]]
+
+
+def test_enrich_year_months_parallel(tmp_path):
+    """Test that enriching in parallel worker processes writes byte-identical files."""
+    rows = [
+        {
+            "changeset_id": changeset_id,
+            "year": 2020 + changeset_id % 2,
+            "month": 1 + changeset_id % 3,
+            "edit_count": changeset_id,
+            "user_name": f"user{changeset_id % 7}",
+            "bottom_left_lon": 1.0,
+            "bottom_left_lat": 2.0,
+            "top_right_lon": 3.0,
+            "top_right_lat": 4.0,
+            "tags": {"created_by": f"JOSM/{changeset_id}", "source": "survey;Bing"},
+        }
+        for changeset_id in range(1, 601)
+    ]
+    write_raw_changesets(tmp_path, rows)
+    year_months = enrich_table.get_all_available_year_months(tmp_path / "raw")
+    assert len(year_months) == 6
+
+    enrich_table.create_organised_team_lookup_table()
+    expressions = enrich_table.get_column_expressions()
+    for year, month in year_months:
+        enrich_table.enrich_table_year_month(tmp_path / "raw", tmp_path / "serial", year, month, expressions)
+    enrich_table.enrich_year_months_parallel(tmp_path / "raw", tmp_path / "parallel", year_months, expressions, jobs=2)
+
+    serial_files = sorted(path.relative_to(tmp_path / "serial") for path in (tmp_path / "serial").glob("**/*.parquet"))
+    assert len(serial_files) == 6
+    assert serial_files == sorted(
+        path.relative_to(tmp_path / "parallel") for path in (tmp_path / "parallel").glob("**/*.parquet")
+    )
+    for file_path in serial_files:
+        assert (tmp_path / "serial" / file_path).read_bytes() == (tmp_path / "parallel" / file_path).read_bytes()
+
+    # the workers enrich with the given expressions and not with the default ones
+    custom_expressions = {"created_by": expressions["created_by"]}
+    enrich_table.enrich_year_months_parallel(
+        tmp_path / "raw", tmp_path / "custom", year_months, custom_expressions, jobs=2
+    )
+    custom_table = pq.read_table(next((tmp_path / "custom").glob("**/*.parquet")))
+    assert custom_table.column_names == ["changeset_id", "edit_count", "user_name", "created_by"]
+
+
+def test_enrich_only_stale_year_months(tmp_path):
+    """Test that only stale year-months and columns are enriched again, with the result of enriching everything."""
+    rows = [
+        {
+            "changeset_id": changeset_id,
+            "month": 1 + changeset_id % 3,
+            "edit_count": changeset_id,
+            "user_name": f"user{changeset_id % 7}",
+            "bottom_left_lon": 1.0,
+            "bottom_left_lat": 2.0,
+            "top_right_lon": 3.0,
+            "top_right_lat": 4.0,
+            "tags": {"created_by": f"JOSM/{changeset_id}", "source": "survey;Bing"},
+        }
+        for changeset_id in range(1, 301)
+    ]
+    write_raw_changesets(tmp_path, rows)
+    year_months = enrich_table.get_all_available_year_months(tmp_path / "raw")
+    enrich_table.create_organised_team_lookup_table()
+    expressions = enrich_table.get_column_expressions()
+    enrich_table.enrich_year_months(tmp_path / "raw", tmp_path / "data", year_months, expressions)
+    assert (tmp_path / "data" / "_manifest.json").exists()
+    assert enrich_table.enrich_year_months(
+        tmp_path / "raw", tmp_path / "data", year_months, expressions, only_stale=True
+    ) == ([], {})
+
+    # change the input of one year-month and the SQL of one column
+    (input_file,) = (tmp_path / "raw" / "year=2021" / "month=2").glob("*.parquet")
+    table = pq.read_table(input_file)
+    edit_count_index = table.schema.get_field_index("edit_count")
+    table = table.set_column(edit_count_index, "edit_count", pa.array([0] * table.num_rows, pa.int32()))
+    pq.write_table(table, input_file)
+    expressions = {**expressions, "bot": "main.edit_count % 2 = 0"}
+    enriched, rewritten = enrich_table.enrich_year_months(
+        tmp_path / "raw", tmp_path / "data", year_months, expressions, only_stale=True
+    )
+    assert enriched == [(2021, 2)]
+    assert rewritten == {(2021, 1): ["bot"], (2021, 3): ["bot"]}
+
+    enrich_table.enrich_year_months(tmp_path / "raw", tmp_path / "full", year_months, expressions)
+    for year, month in year_months:
+        (stale_file,) = (tmp_path / "data" / f"year={year}" / f"month={month}").glob("*.parquet")
+        (full_file,) = (tmp_path / "full" / f"year={year}" / f"month={month}").glob("*.parquet")
+        assert pq.read_table(stale_file).equals(pq.read_table(full_file))
+
+
+def test_enrich_only_stale_organised_teams(tmp_path, monkeypatch):
+    """Test that changing the teams gives the result of enriching everything, also when other columns are stale."""
+    rows = [{"changeset_id": changeset_id, "user_name": f"user{changeset_id % 7}"} for changeset_id in range(5000)]
+    write_raw_changesets(tmp_path, rows)
+    teams_file = tmp_path / "organised_teams.json"
+    monkeypatch.setattr(enrich_table, "ORGANISED_TEAMS_FILE", str(teams_file))
+    teams_file.write_text(json.dumps({"A": {"for_profit": False, "usernames": ["user1"]}}))
+    enrich_table.create_organised_team_lookup_table()
+    expressions = enrich_table.get_column_expressions()
+    enrich_table.enrich_year_months(tmp_path / "raw", tmp_path / "data", [(2021, 1)], expressions)
+
+    # the unmatched rows of the team lookup join are returned after the matched ones, so the row order changes
+    teams = {"A": {"for_profit": False, "usernames": ["user3"]}, "B": {"for_profit": True, "usernames": ["user5"]}}
+    teams_file.write_text(json.dumps(teams))
+    enrich_table.create_organised_team_lookup_table()
+    expressions = {**expressions, "bot": "main.changeset_id % 2 = 0"}
+    assert enrich_table.enrich_year_months(
+        tmp_path / "raw", tmp_path / "data", [(2021, 1)], expressions, only_stale=True
+    ) == ([(2021, 1)], {})
+    # the rows of a rewrite keep their order, the columns are joined by changeset_id
+    expressions = {**expressions, "bot": "main.changeset_id % 3 = 0"}
+    assert enrich_table.enrich_year_months(
+        tmp_path / "raw", tmp_path / "data", [(2021, 1)], expressions, only_stale=True
+    ) == ([], {(2021, 1): ["bot"]})
+
+    enrich_table.enrich_year_months(tmp_path / "raw", tmp_path / "full", [(2021, 1)], expressions)
+    rewritten = pq.read_table(tmp_path / "data" / "year=2021" / "month=1")
+    assert rewritten.equals(pq.read_table(tmp_path / "full" / "year=2021" / "month=1"))
+    assert rewritten.filter(pc.field("user_name") == "user5")["for_profit"].to_pylist() == [True] * 714
+
+
+def test_enrich_with_user_id(tmp_path):
+    """Test the user_id column of the user dimension, also in parallel workers."""
+    rows = [
+        {
+            "changeset_id": changeset_id,
+            "month": 1 + changeset_id % 2,
+            "user_name": f"user{changeset_id % 4}" if changeset_id % 5 else None,
+        }
+        for changeset_id in range(1, 31)
+    ]
+    write_raw_changesets(tmp_path, rows)
+    user_dim = pa.table({"user_id": pa.array([7, 3, 9, 1], pa.int32()), "user_name": [f"user{i}" for i in range(4)]})
+    (tmp_path / "user_dim").mkdir()
+    pq.write_table(user_dim, tmp_path / "user_dim" / "user_dim.parquet")
+    enrich_table.create_organised_team_lookup_table()
+    year_months = [(2021, 1), (2021, 2)]
+    expressions = enrich_table.get_column_expressions()
+    enrich_table.enrich_year_months(tmp_path / "raw", tmp_path / "data", year_months, expressions)
+
+    # adding the user_id column enriches the year-months again
+    enrich_table.create_user_lookup_table(tmp_path / "user_dim")
+    expressions = enrich_table.get_column_expressions(user_id=True)
+    assert enrich_table.enrich_year_months(
+        tmp_path / "raw", tmp_path / "data", year_months, expressions, only_stale=True
+    ) == (year_months, {})
+    enrich_table.enrich_year_months(
+        tmp_path / "raw", tmp_path / "parallel", year_months, expressions, jobs=2, user_dim_path=tmp_path / "user_dim"
+    )
+
+    user_ids = {"user0": 7, "user1": 3, "user2": 9, "user3": 1, None: None}
+    for year, month in year_months:
+        (data_file,) = (tmp_path / "data" / f"year={year}" / f"month={month}").glob("*.parquet")
+        enriched = pq.read_table(data_file)
+        assert sorted(enriched["changeset_id"].to_pylist()) == [
+            row["changeset_id"] for row in rows if row["month"] == month
+        ]
+        assert enriched["user_id"].to_pylist() == [
+            user_ids[user_name] for user_name in enriched["user_name"].to_pylist()
+        ]
+        (parallel_file,) = (tmp_path / "parallel" / f"year={year}" / f"month={month}").glob("*.parquet")
+        assert parallel_file.read_bytes() == data_file.read_bytes()
+
+
+def test_enrich_writes_rollups(tmp_path):
+    """Test that the rollup of an enriched year-month matches aggregating the enriched changesets."""
+    rows = [
+        {
+            "changeset_id": changeset_id,
+            "month": 1 + changeset_id % 2,
+            "edit_count": changeset_id,
+            "user_name": f"user{changeset_id % 3}",
+            "tags": {"created_by": "JOSM/1.5" if changeset_id % 4 else "iD 2.20", "hashtags": "#a;#b;#a"},
+        }
+        for changeset_id in range(1, 21)
+    ]
+    write_raw_changesets(tmp_path, rows)
+    enrich_table.create_organised_team_lookup_table()
+    enrich_table.enrich_year_months(
+        tmp_path / "raw",
+        tmp_path / "data",
+        [(2021, 1), (2021, 2)],
+        enrich_table.get_column_expressions(),
+        rollup_path=tmp_path / "rollups",
+    )
+    rollup = duckdb.sql(f"""
+        SELECT dimension, value, changesets, edits, contributors
+        FROM '{tmp_path}/rollups/year=*/month=*/*.parquet'
+        WHERE month = 1 AND dimension IN ('total', 'created_by', 'hashtags')
+        ORDER BY ALL
+    """).fetchall()
+    # the even changesets are in month 1, every fourth one was created with iD
+    assert rollup == [
+        ("created_by", "JOSM", 5, 2 + 6 + 10 + 14 + 18, 3),
+        ("created_by", "iD", 5, 4 + 8 + 12 + 16 + 20, 3),
+        ("hashtags", "#a", 10, 110, 3),
+        ("hashtags", "#b", 10, 110, 3),
+        ("total", None, 10, 110, 3),
+    ]
+
+
+def test_enrich_writes_mergeable_sketches(tmp_path):
+    """Test the merged HLL estimate against the exact distinct count and the bounds of the merged top-K."""
+    rows = [
+        {
+            "changeset_id": changeset_id,
+            "month": 1 + changeset_id % 3,
+            # about half of the users are active in more than one month
+            "user_name": f"user{changeset_id % 5000}",
+            "tags": {"created_by": f"editor{min(changeset_id % 7, changeset_id % 11)}"},
+        }
+        for changeset_id in range(8000)
+    ]
+    write_raw_changesets(tmp_path, rows)
+    enrich_table.create_organised_team_lookup_table()
+    year_months = enrich_table.get_all_available_year_months(tmp_path / "raw")
+    enrich_table.enrich_year_months(
+        tmp_path / "raw",
+        tmp_path / "data",
+        year_months,
+        enrich_table.get_column_expressions(),
+        sketch_path=tmp_path / "sketches",
+    )
+
+    ((sql_estimate,),) = duckdb.sql(
+        f"SELECT contributors FROM ({changeset_sketches.get_merged_contributors_sql(tmp_path / 'sketches')}) "
+        "WHERE dimension = 'total'"
+    ).fetchall()
+    sketches = duckdb.sql(f"""
+        SELECT register_index, register_rank
+        FROM '{tmp_path}/sketches/contributors_hll/year=*/month=*/*.parquet' WHERE dimension = 'total'
+    """).fetchall()
+    python_estimate = changeset_sketches.estimate_hll(changeset_sketches.merge_hll(sketches))
+    assert sql_estimate == pytest.approx(python_estimate)
+    assert abs(sql_estimate - 5000) < 3 * changeset_sketches.HLL_RELATIVE_ERROR * 5000
+
+    top_k = duckdb.sql(
+        changeset_sketches.get_merged_top_k_sql(tmp_path / "sketches", "created_by", "month IN (1, 2)", k=3)
+    ).fetchall()
+    exact = duckdb.sql(f"""
+        SELECT created_by, count(*) FROM '{tmp_path}/data/year=*/month=*/*.parquet'
+        WHERE month IN (1, 2) GROUP BY ALL ORDER BY 2 DESC, 1 LIMIT 3
+    """).fetchall()
+    assert [value for value, _, _ in top_k] == [value for value, _ in exact]
+    for (_, changesets, max_changesets), (_, exact_changesets) in zip(top_k, exact, strict=True):
+        assert changesets <= exact_changesets <= max_changesets
+
+
+def test_enrich_writes_bridge_tables(tmp_path):
+    """Test the bridge tables of the list columns, sorted by value."""
+    rows = [
+        {
+            "changeset_id": changeset_id,
+            "edit_count": changeset_id,
+            "user_name": f"user{changeset_id % 4}" if changeset_id % 5 else None,
+            "tags": {"hashtags": f"#z;#b{changeset_id % 3}", "source": "survey"},
+        }
+        for changeset_id in range(1, 31)
+    ]
+    write_raw_changesets(tmp_path, rows)
+    user_dim = pa.table({"user_id": pa.array([7, 3, 9, 1], pa.int32()), "user_name": [f"user{i}" for i in range(4)]})
+    (tmp_path / "user_dim").mkdir()
+    pq.write_table(user_dim, tmp_path / "user_dim" / "user_dim.parquet")
+    enrich_table.create_organised_team_lookup_table()
+    enrich_table.create_user_lookup_table(tmp_path / "user_dim")
+    enrich_table.enrich_year_months(
+        tmp_path / "raw",
+        tmp_path / "data",
+        [(2021, 1)],
+        enrich_table.get_column_expressions(user_id=True),
+        bridge_path=tmp_path / "bridges",
+    )
+
+    bridge = pq.read_table(tmp_path / "bridges" / "hashtags" / "year=2021" / "month=1" / "bridge.parquet")
+    assert bridge.column_names == ["changeset_id", "user_id", "edit_count", "value"]
+    assert bridge["value"].to_pylist() == sorted(bridge["value"].to_pylist())
+    expected = duckdb.sql(f"""
+        SELECT changeset_id, user_id, edit_count, unnest(hashtags) as value
+        FROM '{tmp_path}/data/year=*/month=*/*.parquet'
+        ORDER BY value, changeset_id
+    """).fetchall()
+    assert [tuple(row.values()) for row in bridge.to_pylist()] == expected
+    assert {value for *_, value in expected} == {"#z", "#b0", "#b1", "#b2"}
+    (source_file,) = (tmp_path / "bridges" / "source").glob("year=*/month=*/*.parquet")
+    assert pq.read_table(source_file).num_rows == len(rows)
+
+
+def test_enrich_with_enum_codes(tmp_path):
+    """Test that the coded columns decode to the string columns, that existing codes never change and that the
+    rollups and sketches have the values."""
+
+    def write_raw(quest_types):
+        rows = [
+            {
+                "changeset_id": changeset_id,
+                "month": 1 + changeset_id % 2,
+                "tags": {
+                    "created_by": ["JOSM/1.5", "StreetComplete 50.1", "unknown editor"][changeset_id % 3],
+                    "StreetComplete:quest_type": quest_types[changeset_id % len(quest_types)],
+                },
+            }
+            for changeset_id in range(12)
+        ]
+        write_raw_changesets(tmp_path, rows)
+
+    def enrich(output_name, enum_codes, jobs=1):
+        enrich_table.enrich_year_months(
+            tmp_path / "raw",
+            tmp_path / output_name,
+            [(2021, 1), (2021, 2)],
+            enrich_table.get_column_expressions(enum_codes=enum_codes),
+            jobs=jobs,
+            code_table_path=tmp_path / "codes" if enum_codes else None,
+            rollup_path=tmp_path / f"{output_name}_rollups",
+            sketch_path=tmp_path / f"{output_name}_sketches",
+        )
+        return pq.read_table(tmp_path / output_name)
+
+    enrich_table.create_organised_team_lookup_table()
+    write_raw(["AddRoadName", None])
+    enrich("coded", enum_codes=True)
+    codes = pq.read_table(tmp_path / "codes" / "codes.parquet").to_pylist()
+    write_raw(["AddSidewalk", "AddBuildingType", "AddRoadName"])
+    coded = enrich("coded", enum_codes=True)
+    strings = enrich("strings", enum_codes=False)
+
+    code_table = pq.read_table(tmp_path / "codes" / "codes.parquet").to_pylist()
+    assert code_table[: len(codes)] == codes
+    values = {(row["column"], row["code"]): row["value"] for row in code_table}
+    for column in ["created_by", "device_type", "mobile_os", "streetcomplete_quest", "organised_team"]:
+        assert coded[column].type == pa.int32()
+        decoded = [None if code is None else values[(column, code)] for code in coded[column].to_pylist()]
+        assert decoded == strings[column].to_pylist()
+    quest_codes = [row["value"] for row in code_table if row["column"] == "streetcomplete_quest"]
+    assert quest_codes == ["AddRoadName", "AddBuildingType", "AddSidewalk"]
+    for sketch_path in ["rollups", "sketches/contributors_hll", "sketches/top_k"]:
+        coded_sketch = pq.read_table(tmp_path / f"coded_{sketch_path}" / "year=2021" / "month=1")
+        assert coded_sketch.equals(pq.read_table(tmp_path / f"strings_{sketch_path}" / "year=2021" / "month=1"))
+    # the parallel workers encode with the ENUM types of the code table as well
+    assert enrich("parallel", enum_codes=True, jobs=2).equals(coded)
+
+    # a value without a code fails with an error that names it
+    write_raw(["AddMaxSpeed"])
+    enrich_table.create_enum_types(pq.read_table(tmp_path / "codes" / "codes.parquet"))
+    with pytest.raises(duckdb.InvalidInputException, match=r"streetcomplete_quest value without a code.*AddMaxSpeed"):
+        enrich_table.enrich_table_year_month(
+            tmp_path / "raw", tmp_path / "stale", 2021, 1, enrich_table.get_column_expressions(enum_codes=True)
+        )
+
+
+def test_enrich_sorted_by_spatial_key(tmp_path):
+    """Test that the sorted layout has the enriched rows sorted by spatial_key, without bbox last."""
+    rows = [
+        {
+            "changeset_id": changeset_id,
+            "edit_count": changeset_id,
+            "user_name": f"user{changeset_id % 5}",
+            "bottom_left_lon": None if changeset_id % 10 == 0 else (changeset_id * 37) % 360 - 180.0,
+            "bottom_left_lat": None if changeset_id % 10 == 0 else (changeset_id * 17) % 180 - 90.0,
+            "top_right_lon": None if changeset_id % 10 == 0 else (changeset_id * 37) % 360 - 179.0,
+            "top_right_lat": None if changeset_id % 10 == 0 else (changeset_id * 17) % 180 - 89.0,
+            "tags": {"created_by": "JOSM/1.5"},
+        }
+        for changeset_id in range(1, 101)
+    ]
+    write_raw_changesets(tmp_path, rows)
+    enrich_table.create_organised_team_lookup_table()
+    assert "spatial_key" not in enrich_table.get_column_expressions()
+    with pytest.raises(ValueError):
+        enrich_table.enrich_year_months(
+            tmp_path / "raw",
+            tmp_path / "sorted",
+            [(2021, 1)],
+            enrich_table.get_column_expressions(),
+            sort_by_spatial_key=True,
+        )
+    expressions = enrich_table.get_column_expressions(spatial_key=True)
+    enrich_table.enrich_year_months(tmp_path / "raw", tmp_path / "input_order", [(2021, 1)], expressions)
+    enrich_table.enrich_year_months(
+        tmp_path / "raw", tmp_path / "sorted", [(2021, 1)], expressions, sort_by_spatial_key=True
+    )
+    input_order = pq.read_table(tmp_path / "input_order" / "year=2021" / "month=1").to_pylist()
+    sorted_rows = pq.read_table(tmp_path / "sorted" / "year=2021" / "month=1").to_pylist()
+    expected_keys = {
+        row["changeset_id"]: None
+        if row["bottom_left_lon"] is None
+        else spatial_key.get_spatial_key(row["bottom_left_lon"] + 0.5, row["bottom_left_lat"] + 0.5)
+        for row in rows
+    }
+    assert {row["changeset_id"]: row["spatial_key"] for row in input_order} == expected_keys
+    assert sorted_rows == sorted(
+        input_order, key=lambda row: (row["spatial_key"] is None, row["spatial_key"] or 0, row["changeset_id"])
+    )
+
+    # switching the layout or a stale spatial_key enriches the year-month again, other stale columns are rewritten
+    assert enrich_table.enrich_year_months(
+        tmp_path / "raw", tmp_path / "sorted", [(2021, 1)], expressions, only_stale=True
+    ) == ([(2021, 1)], {})
+    enrich_table.enrich_year_months(
+        tmp_path / "raw", tmp_path / "sorted", [(2021, 1)], expressions, only_stale=True, sort_by_spatial_key=True
+    )
+    expressions = {**expressions, "bot": "main.edit_count % 2 = 0"}
+    assert enrich_table.enrich_year_months(
+        tmp_path / "raw", tmp_path / "sorted", [(2021, 1)], expressions, only_stale=True, sort_by_spatial_key=True
+    ) == ([], {(2021, 1): ["bot"]})
+    rewritten = pq.read_table(tmp_path / "sorted" / "year=2021" / "month=1").to_pylist()
+    assert [row["changeset_id"] for row in rewritten] == [row["changeset_id"] for row in sorted_rows]
+    assert [row["bot"] for row in rewritten] == [row["edit_count"] % 2 == 0 for row in rewritten]
+    expressions = {**expressions, "spatial_key": expressions["spatial_key"].replace("/ 2", "/ 2.0")}
+    assert enrich_table.enrich_year_months(
+        tmp_path / "raw", tmp_path / "sorted", [(2021, 1)], expressions, only_stale=True, sort_by_spatial_key=True
+    ) == ([(2021, 1)], {})
@@ -0,0 +1,71 @@
+import os
+import sys
+from datetime import UTC, datetime
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+import column_buffers
+
+
+def test_number_and_float_buffers():
+    """Test that typed buffers convert to the same arrays as pa.array on Python lists."""
+    edit_count = column_buffers.NumberBuffer("i", pa.int32())
+    lon = column_buffers.FloatBuffer()
+    for value, coordinate in [(1, -0.5), (0, None), (2_000_000, 180.0)]:
+        edit_count.append(value)
+        lon.append(coordinate)
+    assert edit_count.to_arrow().equals(pa.array([1, 0, 2_000_000], pa.int32()))
+    assert lon.to_arrow().equals(pa.array([-0.5, None, 180.0], pa.float64()))
+    assert len(lon) == 3
+    assert lon.nbytes() == 24
+
+
+def test_timestamp_and_string_buffers():
+    dates = [datetime(2005, 4, 9, 19, 54, 13, tzinfo=UTC), None, datetime(2025, 10, 6, 0, 20, 0, 123456, tzinfo=UTC)]
+    texts = ["", "Zoë 🗺", "multi\nline"]
+    timestamp = column_buffers.TimestampBuffer()
+    text = column_buffers.StringBuffer()
+    for value in dates:
+        timestamp.append(value)
+    for value in texts:
+        text.append(value)
+    assert timestamp.to_arrow().equals(pa.array(dates, pa.timestamp("us", tz="UTC")))
+    assert text.to_arrow().equals(pa.array(texts, pa.string()))
+
+
+def test_map_buffer():
+    """Test that flat key/value/offset buffers convert to the same map array as a list of dicts."""
+    tags = [{"created_by": "JOSM", "comment": "Roads"}, {}, {"": "empty key", "bot": "yes"}]
+    tags_buffer = column_buffers.MapBuffer()
+    for value in tags:
+        tags_buffer.append(value)
+    assert tags_buffer.to_arrow().equals(pa.array(tags, pa.map_(pa.string(), pa.string())))
+
+
+def test_buffers_larger_than_a_string_array(monkeypatch):
+    """Test that string and map columns with more string data than fits into one string array are chunked."""
+    monkeypatch.setattr(column_buffers, "MAX_STRING_ARRAY_NBYTES", 40)
+    texts = [f"text {index}" * (index % 4) for index in range(50)]
+    tags = [{f"key{index}": "value" * (index % 3), "created_by": "JOSM"} if index % 5 else {} for index in range(50)]
+    text_buffer = column_buffers.StringBuffer()
+    tags_buffer = column_buffers.MapBuffer()
+    for index, (text, tag) in enumerate(zip(texts, tags, strict=True)):
+        text_buffer.append(text)
+        tags_buffer.append(tag)
+        if index % 7 == 0:
+            text_buffer.compact()
+            tags_buffer.compact()
+    text_array = text_buffer.to_arrow()
+    tags_array = tags_buffer.to_arrow()
+    for array in [text_array, tags_array]:
+        assert isinstance(array, pa.ChunkedArray)
+        assert array.num_chunks > 1
+    assert text_array.to_pylist() == texts
+    assert tags_array.to_pylist() == [list(tag.items()) for tag in tags]
+    for chunk in text_array.chunks:
+        assert len(chunk) == 1 or pc.sum(pc.binary_length(chunk)).as_py() <= 40
+    for chunk in tags_array.chunks:
+        for strings in [chunk.keys, chunk.items]:
+            assert len(chunk) == 1 or pc.sum(pc.binary_length(strings)).as_py() <= 40
@@ -0,0 +1,109 @@
+import bz2
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pyarrow.parquet as pq
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+import notes_osm_to_data as notes_data
+
+FIXTURES_PATH = Path(__file__).parent / "fixtures"
+SCRIPTS_PATH = Path(__file__).parent.parent / "scripts"
+
+
+def get_parser_kwargs(output_path):
+    return {
+        "notes_batch_size": 1,
+        "comments_batch_size": 2,
+        "notes_output_path": str(output_path / "notes_data"),
+        "comments_output_path": str(output_path / "notes_comments_data"),
+        "notes_schema": notes_data.NOTES_SCHEMA,
+        "comments_schema": notes_data.COMMENTS_SCHEMA,
+    }
+
+
+def read_output(output_path):
+    return (
+        pq.read_table(output_path / "notes_data").sort_by("note_id").to_pylist(),
+        pq.read_table(output_path / "notes_comments_data")
+        .sort_by([("note_id", "ascending"), ("timestamp", "ascending")])
+        .to_pylist(),
+    )
+
+
+class CrashingNotesParser(notes_data.NotesParser):
+    """Stops like a killed process after the files of the second notes batch were written."""
+
+    def _save_checkpoint(self, stream, **values):
+        if stream == "notes" and self.notes_batch_count == 2:
+            raise KeyboardInterrupt
+        super()._save_checkpoint(stream, **values)
+
+
+def test_resume_from_checkpoint(tmp_path):
+    """Test that resuming an interrupted run produces the same rows as an uninterrupted one."""
+    file_path = tmp_path / "notes.osn.bz2"
+    file_path.write_bytes(bz2.compress((FIXTURES_PATH / "notes.osn").read_bytes()))
+    checkpoint_path = tmp_path / "resumed" / "notes_data" / notes_data.CHECKPOINT_FILE
+
+    notes_parser = notes_data.NotesParser(**get_parser_kwargs(tmp_path / "reference"))
+    notes_parser.parse_file(file_path)
+    notes_parser.finalize()
+
+    with pytest.raises(KeyboardInterrupt):
+        CrashingNotesParser(**get_parser_kwargs(tmp_path / "resumed"), checkpoint_path=checkpoint_path).parse_file(
+            file_path
+        )
+    notes_parser = notes_data.NotesParser(**get_parser_kwargs(tmp_path / "resumed"), checkpoint_path=checkpoint_path)
+    notes_parser.parse_file(file_path, resume=True)
+    notes_parser.finalize()
+
+    assert not checkpoint_path.exists()
+    assert read_output(tmp_path / "resumed") == read_output(tmp_path / "reference")
+
+
+def test_batch_memory_budget(tmp_path, monkeypatch):
+    """Test that a memory budget splits the batches by the size of their buffered columns."""
+    monkeypatch.setattr(notes_data, "MEMORY_CHECK_INTERVAL", 1)
+    file_path = tmp_path / "notes.osn.bz2"
+    file_path.write_bytes(bz2.compress((FIXTURES_PATH / "notes.osn").read_bytes()))
+    parser_kwargs = get_parser_kwargs(tmp_path / "reference") | {"notes_batch_size": 100, "comments_batch_size": 100}
+    notes_parser = notes_data.NotesParser(**parser_kwargs)
+    notes_parser.parse_file(file_path)
+    notes_parser.finalize()
+    assert (notes_parser.notes_batch_count, notes_parser.comments_batch_count) == (1, 1)
+
+    # a buffered note takes 48 bytes, the budget is reached with the third note of a batch
+    batch_memory_mb = 2.5 * 48 / 1024 / 1024
+    parser_kwargs = get_parser_kwargs(tmp_path / "budget") | {"notes_batch_size": 100, "comments_batch_size": 100}
+    notes_parser = notes_data.NotesParser(**parser_kwargs, batch_memory_mb=batch_memory_mb)
+    notes_parser.parse_file(file_path)
+    notes_parser.finalize()
+    assert notes_parser.notes_batch_count == 2
+    assert notes_parser.comments_batch_count > 1
+    assert read_output(tmp_path / "budget") == read_output(tmp_path / "reference")
+
+
+def test_main_reads_stdin(tmp_path):
+    """Test piping the notes dump into the script instead of passing a file."""
+    notes_parser = notes_data.NotesParser(**get_parser_kwargs(tmp_path / "reference"))
+    notes_parser.parse_file(FIXTURES_PATH / "notes.osn", decompressor="cat")
+    notes_parser.finalize()
+
+    output_path = tmp_path / "stdin"
+    subprocess.run(
+        [
+            sys.executable,
+            SCRIPTS_PATH / "notes_osm_to_data.py",
+            "-",
+            output_path / "notes_data",
+            output_path / "notes_comments_data",
+        ],
+        input=bz2.compress((FIXTURES_PATH / "notes.osn").read_bytes()),
+        check=True,
+        capture_output=True,
+    )
+    assert read_output(output_path) == read_output(tmp_path / "reference")
@@ -0,0 +1,95 @@
+import bz2
+import io
+import os
+import random
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+import osm_input
+
+
+@pytest.fixture(scope="module")
+def text():
+    """Create pseudo random text that is large enough to span many bz2 blocks at compression level 1."""
+    rng = random.Random(42)
+    words = ["".join(rng.choice("abcdefghij") for _ in range(rng.randint(2, 9))) for _ in range(5000)]
+    return " ".join(rng.choice(words) for _ in range(200_000)).encode()
+
+
+def read_parallel(data, workers=2, chunk_size=50_000):
+    with osm_input.ParallelBZ2Reader(io.BytesIO(data), workers, chunk_size=chunk_size) as reader:
+        return reader.read()
+
+
+def test_find_bz2_magic_bits_all_shifts():
+    """Test that the block magic is found at every bit offset within a byte."""
+    for shift in range(8):
+        value = (osm_input.BZ2_BLOCK_MAGIC << (64 - shift)) | (1 << (64 - shift)) - 1
+        data = b"\x00\x00" + value.to_bytes(14, "big")
+        assert osm_input.find_bz2_magic_bits(data, osm_input.BZ2_BLOCK_PATTERNS) == [16 + shift]
+
+
+@pytest.mark.parametrize("compresslevel", [1, 9])
+def test_parallel_bz2_reader_single_stream(text, compresslevel):
+    """Test that a single stream with one or many blocks is decompressed in the right order."""
+    assert read_parallel(bz2.compress(text, compresslevel)) == text
+
+
+def test_parallel_bz2_reader_multi_stream(text):
+    """Test concatenated streams (as written by pbzip2) including an empty stream."""
+    data = bz2.compress(text[:100_000], 1) + bz2.compress(b"", 1) + bz2.compress(text[100_000:], 3)
+    assert read_parallel(data, chunk_size=7777) == text
+
+
+def test_open_input(tmp_path, text):
+    """Test that the parallel and the plain bz2 reader return the same data."""
+    file_path = tmp_path / "text.bz2"
+    file_path.write_bytes(bz2.compress(text, 1))
+    with osm_input.open_input(file_path) as file_handle:
+        plain = file_handle.read()
+    with osm_input.open_input(file_path, decompression_workers=2) as file_handle:
+        parallel = file_handle.read()
+    assert plain == parallel == text
+
+
+@pytest.mark.parametrize("decompression_workers", [None, 2])
+def test_open_input_file_object(text, decompression_workers):
+    """Test reading from a file object that can't seek, like a pipe."""
+
+    class Pipe(io.RawIOBase):
+        def __init__(self, data, first_read_size=None):
+            self.data = io.BytesIO(data)
+            self.first_read_size = first_read_size
+
+        def readable(self):
+            return True
+
+        def readinto(self, buffer):
+            read_size, self.first_read_size = self.first_read_size or len(buffer), None
+            return self.data.readinto(memoryview(buffer)[:read_size])
+
+    with osm_input.open_input(Pipe(bz2.compress(text, 1)), decompression_workers) as file_handle:
+        assert file_handle.read() == text
+    # the first read of a pipe can return less than the 4 bytes of the signature
+    with osm_input.open_input(Pipe(bz2.compress(text, 1), first_read_size=1), decompression_workers) as file_handle:
+        assert file_handle.read() == text
+
+
+@pytest.mark.skipif(shutil.which("bzip2") is None, reason="needs the bzip2 command")
+def test_open_input_decompressor(tmp_path, text):
+    """Test decompressing a file and a file object without a file descriptor with an external command."""
+    file_path = tmp_path / "text.bz2"
+    file_path.write_bytes(bz2.compress(text, 1))
+    with osm_input.open_input(file_path, decompressor="bzip2 -dc") as file_handle:
+        assert file_handle.read() == text
+        assert file_handle.tell() == len(text)
+    with osm_input.open_input(io.BytesIO(file_path.read_bytes()), decompressor="bzip2 -dc") as file_handle:
+        assert file_handle.read() == text
+
+    with pytest.raises(subprocess.CalledProcessError):
+        with osm_input.open_input(io.BytesIO(b"not bz2"), decompressor="bzip2 -dc") as file_handle:
+            file_handle.read()
@@ -0,0 +1,89 @@
+import bz2
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+import changeset_osm_to_raw_data as raw_data
+import notes_osm_to_data as notes_data
+import osm_xml
+
+FIXTURES_PATH = Path(__file__).parent / "fixtures"
+
+
+def compress_fixture(fixture_name, tmp_path):
+    file_path = tmp_path / f"{fixture_name}.bz2"
+    file_path.write_bytes(bz2.compress((FIXTURES_PATH / fixture_name).read_bytes()))
+    return file_path
+
+
+def read_output_files(output_path):
+    """Return all written files with their content, so outputs can be compared byte by byte."""
+    return {
+        str(file_path.relative_to(output_path)): file_path.read_bytes()
+        for file_path in sorted(output_path.rglob("*.parquet"))
+    }
+
+
+def parse_changesets(file_path, output_path, xml_backend):
+    changeset_parser = raw_data.ChangesetParser(
+        changeset_batch_size=3,
+        discussion_batch_size=2,
+        changeset_output_path=str(output_path / "changeset_data_raw"),
+        discussion_output_path=str(output_path / "changeset_comments_data"),
+        changeset_schema=raw_data.CHANGESET_SCHEMA,
+        discussion_schema=raw_data.DISCUSSION_SCHEMA,
+        xml_backend=xml_backend,
+    )
+    changeset_parser.parse_file(file_path)
+    changeset_parser.finalize()
+    return read_output_files(output_path)
+
+
+def parse_notes(file_path, output_path, xml_backend):
+    notes_parser = notes_data.NotesParser(
+        notes_batch_size=3,
+        comments_batch_size=2,
+        notes_output_path=str(output_path / "notes_data"),
+        comments_output_path=str(output_path / "notes_comments_data"),
+        notes_schema=notes_data.NOTES_SCHEMA,
+        comments_schema=notes_data.COMMENTS_SCHEMA,
+        xml_backend=xml_backend,
+    )
+    notes_parser.parse_file(file_path)
+    notes_parser.finalize()
+    return read_output_files(output_path)
+
+
+def test_changeset_backends_conformance(tmp_path):
+    """Test that the expat backend writes the same Parquet files as the ElementTree reference."""
+    file_path = compress_fixture("changesets.osm", tmp_path)
+    reference = parse_changesets(file_path, tmp_path / "etree", "etree")
+    assert len(reference) > 2
+    assert parse_changesets(file_path, tmp_path / "expat", "expat") == reference
+
+
+def test_notes_backends_conformance(tmp_path):
+    """Test that the expat backend writes the same Parquet files as the ElementTree reference."""
+    file_path = compress_fixture("notes.osn", tmp_path)
+    reference = parse_notes(file_path, tmp_path / "etree", "etree")
+    assert len(reference) > 2
+    assert parse_notes(file_path, tmp_path / "expat", "expat") == reference
+
+
+@pytest.mark.parametrize("xml_backend", osm_xml.XML_BACKENDS)
+def test_iter_notes(xml_backend):
+    """Test the records of the notes fixture, which are the same for both backends."""
+    with (FIXTURES_PATH / "notes.osn").open("rb") as file_handle:
+        notes = list(osm_xml.iter_notes(file_handle, xml_backend))
+    assert [attribs["id"] for attribs, _ in notes] == ["1", "2", "3", "4"]
+    assert [text for _, text in notes[0][1]] == ['Test note with <html> & "quotes"', ""]
+    assert notes[1][1][0] == ({"action": "opened", "timestamp": "2014-01-01T00:00:00Z"}, "Anonymous\nmulti line note")
+    assert [attribs["action"] for attribs, _ in notes[2][1]] == ["opened", "closed", "reopened", "closed"]
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        osm_xml.iter_changesets(None, "lxml")
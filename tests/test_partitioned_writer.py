@@ -0,0 +1,39 @@
+import os
+import sys
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+from partitioned_writer import PartitionedParquetWriter
+
+SCHEMA = pa.schema([pa.field("id", pa.int64()), pa.field("year", pa.int16()), pa.field("month", pa.int8())])
+
+
+def make_table(ids, year_months):
+    years, months = zip(*year_months, strict=True)
+    return pa.table({"id": ids, "year": years, "month": months}, schema=SCHEMA)
+
+
+def test_partitioned_parquet_writer(tmp_path):
+    """Test that every month is one file with full row groups and a partition is closed when the input moved on."""
+    writer = PartitionedParquetWriter(tmp_path, SCHEMA, row_group_size=4)
+    writer.write_table(make_table(range(0, 6), [(2020, 12)] * 3 + [(2021, 1)] * 3))
+    writer.write_table(make_table(range(6, 12), [(2021, 1)] * 5 + [(2021, 2)]))
+    assert sorted(writer.open_partitions) == [(2021, 1), (2021, 2)]
+    writer.write_table(make_table(range(12, 15), [(2021, 2)] * 3))
+    assert sorted(writer.open_partitions) == [(2021, 2)]
+    # late rows of a closed partition go into another file
+    writer.write_table(make_table([15], [(2021, 1)]))
+    writer.close()
+
+    assert sorted(str(path.relative_to(tmp_path)) for path in tmp_path.glob("**/*.parquet")) == [
+        "year=2020/month=12/part-0.parquet",
+        "year=2021/month=1/part-0.parquet",
+        "year=2021/month=1/part-1.parquet",
+        "year=2021/month=2/part-0.parquet",
+    ]
+    january = pq.ParquetFile(tmp_path / "year=2021" / "month=1" / "part-0.parquet")
+    assert [january.metadata.row_group(i).num_rows for i in range(january.num_row_groups)] == [4, 4]
+    assert january.read()["id"].to_pylist() == [3, 4, 5, 6, 7, 8, 9, 10]
+    assert sorted(pq.read_table(tmp_path)["id"].to_pylist()) == list(range(16))
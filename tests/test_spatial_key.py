@@ -0,0 +1,49 @@
+import os
+import random
+import sys
+
+import duckdb
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+import spatial_key
+
+
+def get_cells(lon, lat):
+    key = spatial_key.get_spatial_key(lon, lat)
+    return (
+        sum(((key >> (2 * bit)) & 1) << bit for bit in range(spatial_key.SPATIAL_KEY_BITS)),
+        sum(((key >> (2 * bit + 1)) & 1) << bit for bit in range(spatial_key.SPATIAL_KEY_BITS)),
+    )
+
+
+def test_spatial_key_and_bbox_filter_match_brute_force():
+    rng = random.Random(0)
+    positions = [(rng.uniform(-180, 180), rng.uniform(-90, 90)) for _ in range(2000)]
+    positions += [(rng.gauss(10, 3), rng.gauss(51, 2)) for _ in range(2000)]
+    positions += [(-180.0, -90.0), (180.0, 90.0), (0.0, 0.0)]
+    connection = duckdb.connect()
+    connection.execute("CREATE TABLE positions (lon DOUBLE, lat DOUBLE)")
+    connection.executemany("INSERT INTO positions VALUES (?, ?)", positions)
+    connection.execute(f"""
+        CREATE TABLE keys AS SELECT {spatial_key.get_spatial_key_sql("lon", "lat")} as spatial_key FROM positions
+    """)
+    keys = [key for (key,) in connection.execute("SELECT spatial_key FROM keys").fetchall()]
+    assert keys == [spatial_key.get_spatial_key(lon, lat) for lon, lat in positions]
+    assert spatial_key.get_spatial_key(-180, -90) == 0
+    assert spatial_key.get_spatial_key(180, 90) == (1 << (2 * spatial_key.SPATIAL_KEY_BITS)) - 1
+
+    for bbox in [(5.87, 47.27, 15.04, 55.06), (-10, -10, 10, 10), (-180, -90, 180, 90), (9, 50, 9.5, 50.3)]:
+        min_x, min_y = get_cells(bbox[0], bbox[1])
+        max_x, max_y = get_cells(bbox[2], bbox[3])
+        expected = [
+            key
+            for key, (lon, lat) in zip(keys, positions, strict=True)
+            if min_x <= get_cells(lon, lat)[0] <= max_x and min_y <= get_cells(lon, lat)[1] <= max_y
+        ]
+        for max_ranges in [1, 4, spatial_key.MAX_KEY_RANGES]:
+            ranges = spatial_key.get_spatial_key_ranges(*bbox, max_ranges=max_ranges)
+            assert ranges == sorted(ranges)
+            assert all(any(first_key <= key <= last_key for first_key, last_key in ranges) for key in expected)
+            filter_sql = spatial_key.get_bbox_filter_sql(*bbox, max_ranges=max_ranges)
+            result = connection.execute(f"SELECT spatial_key FROM keys WHERE {filter_sql}").fetchall()
+            assert sorted(key for (key,) in result) == sorted(expected)
@@ -0,0 +1,71 @@
+import bz2
+import gzip
+import os
+import random
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+import osm_input
+import transcode_to_zstd
+
+
+@pytest.fixture(scope="module")
+def text():
+    rng = random.Random(7)
+    words = ["".join(rng.choice("abcdefghij") for _ in range(rng.randint(2, 9))) for _ in range(2000)]
+    return " ".join(rng.choice(words) for _ in range(50_000)).encode()
+
+
+@pytest.fixture
+def zstd_path(tmp_path, text):
+    bz2_path = tmp_path / "text.osm.bz2"
+    bz2_path.write_bytes(bz2.compress(text, 1))
+    frame_count = transcode_to_zstd.transcode_to_zstd(bz2_path, tmp_path / "text.osm.zst", frame_size=20_000)
+    assert frame_count == -(-len(text) // 20_000)
+    return tmp_path / "text.osm.zst"
+
+
+def test_seek_table(zstd_path, text):
+    """Test that the seek table has the offsets of all frames."""
+    with open(zstd_path, "rb") as file_obj:
+        frames = osm_input.read_zstd_seek_table(file_obj)
+    assert [decompressed_offset for _, decompressed_offset in frames] == list(range(0, len(text), 20_000))
+    assert osm_input.find_zstd_frame(frames, 45_000) == frames[2]
+    with open(zstd_path, "rb") as file_obj:
+        file_obj.seek(frames[2][0])
+        assert osm_input.detect_compression(file_obj.read(4)) == "zstd"
+
+
+@pytest.mark.parametrize("offset", [0, 45_000, 60_000])
+def test_open_input_zstd_position(zstd_path, text, offset):
+    """Test that reading from a position starts at its frame and returns the same data as reading everything."""
+    position = {"decompressed_offset": offset, "block_bit_offset": None}
+    with osm_input.open_input(zstd_path, position=position) as file_handle:
+        assert file_handle.tell() == offset
+        assert file_handle.read() == text[offset:]
+    with open(zstd_path, "rb") as file_obj:
+        frame_compressed_offset = osm_input.find_zstd_frame(osm_input.read_zstd_seek_table(file_obj), offset)[0]
+    compressed_size = osm_input.input_compressed_size(zstd_path, position=position)
+    assert compressed_size == zstd_path.stat().st_size - frame_compressed_offset
+
+
+def test_open_input_detects_compression(tmp_path, text, zstd_path):
+    """Test that gzip, zstd and uncompressed inputs are read by their signature and not their file name."""
+    (tmp_path / "gzip.osm").write_bytes(gzip.compress(text))
+    (tmp_path / "plain.osm.bz2").write_bytes(text)
+    for file_path in [tmp_path / "gzip.osm", tmp_path / "plain.osm.bz2", zstd_path]:
+        with osm_input.open_input(file_path) as file_handle:
+            assert file_handle.read() == text
+    position = {"decompressed_offset": 1000, "block_bit_offset": None}
+    with osm_input.open_input(tmp_path / "plain.osm.bz2", position=position) as file_handle:
+        assert file_handle.read() == text[1000:]
+
+
+@pytest.mark.skipif(shutil.which("zstd") is None, reason="needs the zstd command")
+def test_zstd_command_reads_seekable_file(zstd_path, text):
+    """Test that the seekable file is a standard zstd file."""
+    assert subprocess.run(["zstd", "-dc", zstd_path], capture_output=True, check=True).stdout == text